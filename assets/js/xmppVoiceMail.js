@@ -1,7 +1,8 @@
 (function($) {
-  var DAY, HOUR, LOG_REFRESH_TIME_IN_S, MINUTE, SECOND, apiErrorHandler, defaultView, formatTime, showErrorMessage, showMessage;
+  var DAY, HOUR, LOG_RETRY_TIME_IN_S, LOG_TIME_REFRESH_IN_S, MINUTE, SECOND, apiErrorHandler, defaultView, formatTime, showErrorMessage, showMessage;
   defaultView = "main";
-  LOG_REFRESH_TIME_IN_S = 10;
+  LOG_TIME_REFRESH_IN_S = 10;
+  LOG_RETRY_TIME_IN_S = 10;
   showMessage = function($messageEl, message) {
     $messageEl.removeClass("error");
     return $messageEl.html(message);
@@ -227,7 +228,39 @@
     url: '/api/admin/log',
     parse: function(response) {
       this.serverTime = new Date(response.now);
+      this.lastId = response.lastId;
       return response.logItems;
+    },
+    poll: function() {
+      var self;
+      self = this;
+      if (this.polling) {
+        return;
+      }
+      this.polling = true;
+      return $.ajax({
+        type: 'GET',
+        url: this.url,
+        data: {
+          since: this.lastId || 0,
+          wait: 1
+        },
+        success: function(response) {
+          self.polling = false;
+          self.serverTime = new Date(response.now);
+          self.lastId = response.lastId;
+          self.add(response.logItems);
+          self.trigger('connected');
+          return self.poll();
+        },
+        error: function(xhr, textStatus, errorThrown) {
+          self.polling = false;
+          self.trigger('error', self, xhr);
+          return setTimeout((function() {
+            return self.poll();
+          }), LOG_RETRY_TIME_IN_S * SECOND);
+        }
+      });
     }
   });
   window.LoginView = Backbone.View.extend({
@@ -269,17 +302,21 @@
   });
   window.LogView = Backbone.View.extend({
     initialize: function() {
-      _.bindAll(this, "render", "onCollectionEvent");
+      _.bindAll(this, "render", "onCollectionEvent", "refreshTimes");
       this.template = _.template($('#log-list-template').html());
       this.logEntryTemplate = _.template($('#log-entry-template').html());
       return this.collection.on('all', this.onCollectionEvent);
     },
-    onCollectionEvent: function(eventName) {
+    onCollectionEvent: function(eventName, model) {
       if (eventName === "error") {
         return showErrorMessage(this.$('.errorText'), "Connection lost");
       } else {
         showMessage(this.$('.errorText'), "");
-        return this.render();
+        if (eventName === "add") {
+          return this.renderLogEntry(model);
+        } else if (eventName === "reset") {
+          return this.render();
+        }
       }
     },
     render: function() {
@@ -290,28 +327,36 @@
       return this;
     },
     renderLogEntries: function() {
-      var $logEntries, now, self;
+      var self;
       self = this;
-      $logEntries = this.$('.logEntries');
-      $logEntries.empty();
-      now = this.collection.now;
+      this.$('.logEntries').empty();
       this.collection.each(function(log) {
-        var jsonLogEntry;
-        jsonLogEntry = log.toJSON();
-        jsonLogEntry.timeStr = formatTime(jsonLogEntry.time, now);
-        return $logEntries.append(self.logEntryTemplate(jsonLogEntry));
+        return self.renderLogEntry(log);
       });
       return this;
+    },
+    renderLogEntry: function(log) {
+      var jsonLogEntry;
+      jsonLogEntry = log.toJSON();
+      jsonLogEntry.timeStr = formatTime(jsonLogEntry.time);
+      return this.$('.logEntries').append(this.logEntryTemplate(jsonLogEntry));
+    },
+    refreshTimes: function() {
+      return this.$('.logTime[data-time]').each(function() {
+        return $(this).text(formatTime(Number($(this).attr('data-time'))));
+      });
     }
   });
   window.SmsWidgetView = Backbone.View.extend({
     events: {
       'click .sendMessageButton': 'sendSms',
-      'keypress input': 'sendSmsOnEnter'
+      'keypress input': 'sendSmsOnEnter',
+      'keyup .numberInput': 'suggestContacts'
     },
     initialize: function() {
-      _.bindAll(this, "render");
-      return this.template = _.template($('#sms-widget').html());
+      _.bindAll(this, "render", "showSuggestions");
+      this.template = _.template($('#sms-widget').html());
+      return this.suggestContacts = _.debounce(this.suggestContacts, 200);
     },
     render: function() {
       var self;
@@ -324,6 +369,41 @@
         return this.sendSms(event);
       }
     },
+    suggestContacts: function() {
+      var query, self;
+      self = this;
+      query = this.$('.numberInput').val();
+      if (query === this.lastQuery) {
+        return;
+      }
+      this.lastQuery = query;
+      if (!query) {
+        this.showSuggestions([]);
+        return;
+      }
+      return $.ajax({
+        type: 'GET',
+        url: '/api/admin/contacts/search',
+        data: {
+          q: query,
+          limit: 10
+        },
+        success: function(data, textStatus, xhr) {
+          return self.showSuggestions(data);
+        }
+      });
+    },
+    showSuggestions: function(contacts) {
+      var $suggestions, contact, _i, _len, _results;
+      $suggestions = this.$('.contactSuggestions');
+      $suggestions.empty();
+      _results = [];
+      for (_i = 0, _len = contacts.length; _i < _len; _i++) {
+        contact = contacts[_i];
+        _results.push($suggestions.append($('<option>').attr('value', contact.name).text(contact.phoneNumber)));
+      }
+      return _results;
+    },
     sendSms: function(event) {
       var data, self;
       event.preventDefault();
@@ -337,7 +417,6 @@
         url: '/api/sendSms',
         data: JSON.stringify(data),
         success: function() {
-          window.logEntries.fetch();
           return self.$(':text').val("");
         },
         error: function(xhr, textStatus, errorThrown) {
@@ -381,11 +460,13 @@
     },
     main: function() {
       window.contacts.fetch();
-      window.logEntries.fetch();
+      window.logEntries.fetch({
+        success: function() {
+          return window.logEntries.poll();
+        }
+      });
       if (!this.timer) {
-        this.timer = setInterval((function() {
-          return window.logEntries.fetch();
-        }), LOG_REFRESH_TIME_IN_S * SECOND);
+        this.timer = setInterval(this.logView.refreshTimes, LOG_TIME_REFRESH_IN_S * SECOND);
       }
       this.$main.empty();
       this.$main.append(this.contactEditorView.render().el);
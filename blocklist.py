@@ -0,0 +1,167 @@
+import threading
+import time
+
+from google.appengine.api import namespace_manager
+
+from util.generationcache import GenerationCache
+from util import requestcontext
+from util import structlog
+from util.phonenumberutils import toNormalizedNumber
+from models import BlockedNumber
+
+log = structlog.getLogger(__name__)
+
+_BLOCKLIST_GENERATION_MEMCACHE_KEY = 'Blocklist:GENERATION'
+_DROP_COUNT_MEMCACHE_KEY = 'Blocklist:Dropped:'
+
+# How often to check for blocklist changes made on other instances, in seconds.
+_BLOCKLIST_CHECK_INTERVAL = 30
+
+# How often to write drop counts to memcache, in seconds.
+_DROP_COUNT_FLUSH_INTERVAL = 10
+
+# How many senders to track for rate limiting before we start forgetting them.
+_MAX_TRACKED_SENDERS = 10000
+
+BLOCKED = "blocked"
+RATE_LIMITED = "rateLimited"
+
+class _NumberMatcher:
+    """ Matches numbers against a set of exact numbers and prefixes.
+
+    Exact numbers are a set lookup.  Prefixes are grouped by length, so
+    matching a number costs one set lookup per distinct prefix length.
+    """
+
+    def __init__(self, patterns):
+        self.setPatterns(patterns)
+
+    def setPatterns(self, patterns):
+        patterns = frozenset(patterns)
+        numbers = frozenset(p for p in patterns if not p.endswith("*"))
+        prefixes = frozenset(p[:-1] for p in patterns if p.endswith("*"))
+        prefixLengths = sorted(set(len(p) for p in prefixes))
+
+        # Replace everything at once, so other threads never see a half-updated matcher.
+        self._state = (patterns, numbers, prefixes, prefixLengths)
+
+    def getPatterns(self):
+        return self._state[0]
+
+    def matches(self, normalizedNumber):
+        patterns, numbers, prefixes, prefixLengths = self._state
+        if normalizedNumber in numbers:
+            return True
+        for length in prefixLengths:
+            if normalizedNumber[:length] in prefixes:
+                return True
+        return False
+
+def _buildMatcher(generation):
+    return _NumberMatcher([key.name() for key in BlockedNumber.getAll(keysOnly=True)])
+
+class Blocklist:
+    """ Decides whether to drop incoming calls and SMS messages from a number.
+
+    Numbers are dropped if they match a BlockedNumber, or if they send more
+    than rateLimit messages in rateWindow seconds.  Blocked numbers are held
+    in-process, and rate limits are tracked per instance, so checking a
+    number doesn't need any RPCs.  Counts of dropped messages are batched up
+    and written to memcache every few seconds.
+    """
+
+    def __init__(self, rateLimit=0, rateWindow=60):
+        """ Create a new Blocklist.
+
+        rateLimit is the number of messages a sender can send in rateWindow
+        seconds before we start dropping them.  0 disables rate limiting.
+        """
+        self._rateLimit = rateLimit
+        self._rateWindow = rateWindow
+        self._matchers = GenerationCache(_BLOCKLIST_GENERATION_MEMCACHE_KEY, _buildMatcher,
+                                         checkInterval=_BLOCKLIST_CHECK_INTERVAL)
+        self._lock = threading.Lock()
+        # Maps normalized numbers to [windowStart, messageCount].
+        self._senders = {}
+        # Maps namespaces to {reason: count} for drops not yet written to memcache.
+        self._dropCounts = {}
+        self._lastFlush = time.time()
+
+    def _overRateLimit(self, normalizedNumber, now):
+        with self._lock:
+            sender = self._senders.get(normalizedNumber)
+            if (not sender) or (now - sender[0] >= self._rateWindow):
+                if len(self._senders) >= _MAX_TRACKED_SENDERS:
+                    self._senders.clear()
+                sender = self._senders[normalizedNumber] = [now, 0]
+            sender[1] += 1
+            return sender[1] > self._rateLimit
+
+    def _recordDrop(self, reason, now):
+        namespace = namespace_manager.get_namespace()
+        with self._lock:
+            counts = self._dropCounts.setdefault(namespace, {})
+            counts[reason] = counts.get(reason, 0) + 1
+            if now - self._lastFlush < _DROP_COUNT_FLUSH_INTERVAL:
+                return
+            dropCounts = self._dropCounts
+            self._dropCounts = {}
+            self._lastFlush = now
+
+        for namespace, counts in dropCounts.items():
+            requestcontext.get().memcache.offset_multi(counts, key_prefix=_DROP_COUNT_MEMCACHE_KEY,
+                                        namespace=namespace, initial_value=0)
+
+    def check(self, number):
+        """ Returns the reason to drop a message from 'number', or None to let it through. """
+        now = time.time()
+        normalizedNumber = toNormalizedNumber(number)
+
+        reason = None
+        if self._matchers.get().matches(normalizedNumber):
+            reason = BLOCKED
+        elif self._rateLimit and self._overRateLimit(normalizedNumber, now):
+            reason = RATE_LIMITED
+
+        if reason:
+            log.info("blocklist.drop", number=normalizedNumber, reason=reason)
+            self._recordDrop(reason, now)
+        return reason
+
+    def getDropCounts(self):
+        """ Returns the number of messages dropped for each reason, across all instances. """
+        answer = requestcontext.get().memcache.get_multi([BLOCKED, RATE_LIMITED], key_prefix=_DROP_COUNT_MEMCACHE_KEY)
+        with self._lock:
+            for reason, count in self._dropCounts.get(namespace_manager.get_namespace(), {}).items():
+                answer[reason] = answer.get(reason, 0) + count
+        return answer
+
+    def getBlockedNumbers(self):
+        return BlockedNumber.getAll()
+
+    def _patternsChanged(self, updatePatterns):
+        def update(matcher, generation):
+            matcher.setPatterns(updatePatterns(matcher.getPatterns()))
+        self._matchers.changed(self._matchers.incrementGeneration(), update)
+
+    def block(self, pattern):
+        """ Block a number or prefix.  Returns the new BlockedNumber, or None if pattern is invalid. """
+        normalizedPattern = BlockedNumber.normalizePattern(pattern)
+        if not normalizedPattern:
+            return None
+
+        blockedNumber = BlockedNumber.create(normalizedPattern)
+        self._patternsChanged(lambda patterns: patterns | set([normalizedPattern]))
+        return blockedNumber
+
+    def unblock(self, pattern):
+        """ Unblock a number or prefix.  Returns the normalized pattern, or None if pattern is invalid. """
+        normalizedPattern = BlockedNumber.normalizePattern(pattern)
+        if not normalizedPattern:
+            return None
+
+        blockedNumber = BlockedNumber.getByPattern(normalizedPattern)
+        if blockedNumber:
+            blockedNumber.delete()
+            self._patternsChanged(lambda patterns: patterns - set([normalizedPattern]))
+        return normalizedPattern
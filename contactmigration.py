@@ -0,0 +1,41 @@
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import Contact, ContactIndexState
+from util import structlog
+
+log = structlog.getLogger(__name__)
+
+# URL of the task which gives a batch of contacts their index entities.
+MIGRATE_CONTACTS_TASK_URL = "/tasks/migrateContacts"
+
+# Contacts indexed by each task.
+_BATCH_SIZE = 100
+
+def queueMigration(ownerNumber, cursor=None):
+    """ Index the owner's contacts in the background, starting from 'cursor'. """
+    taskqueue.add(url=MIGRATE_CONTACTS_TASK_URL, params={"owner": ownerNumber, "cursor": cursor or ""})
+
+def migrateBatch(cursor=None, batchSize=_BATCH_SIZE):
+    """ Write the missing index entities for a batch of contacts in the current namespace.
+
+    Returns the cursor to carry on from, or None once every contact has been
+    looked at, at which point the namespace is marked as migrated.  Running
+    a batch again is harmless, so a failed task can just be retried.
+    """
+    startCursor = Cursor(urlsafe=cursor) if cursor else None
+    contacts, nextCursor, more = Contact.query().fetch_page(batchSize, start_cursor=startCursor)
+
+    futures = [contact.addMissingIndexesAsync() for contact in contacts]
+    for contact, future in zip(contacts, futures):
+        for index in future.get_result():
+            # Two contacts stored before there were index entities can share
+            # a name or number.  Only the first one found keeps it.
+            log.warn("contact.migrate.conflict", contact=contact.key.id(), index=index.key.kind(),
+                     value=index.key.id())
+
+    if more and nextCursor:
+        return nextCursor.urlsafe()
+
+    ContactIndexState.markMigrated()
+    return None
@@ -0,0 +1,89 @@
+import datetime
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from util.phonenumberutils import toNormalizedNumber
+from models import Conversation, ConversationMessage
+
+def _getKey(number):
+    return ndb.Key(Conversation, toNormalizedNumber(number))
+
+def _getCursor(cursor):
+    if not cursor:
+        return None
+    return Cursor(urlsafe=cursor)
+
+def _getPage(query, cursor, limit):
+    results, nextCursor, more = query.fetch_page(limit, start_cursor=_getCursor(cursor))
+    if not (more and nextCursor):
+        nextCursor = None
+    return results, nextCursor and nextCursor.urlsafe()
+
+@ndb.tasklet
+def recordMessageAsync(number, name, direction, message, unread):
+    """ Add a message to the conversation with 'number', and update its summary.
+
+    'unread' is True for messages to the owner, which count as unread until
+    the conversation is marked read.  A message from the owner means they've
+    seen the conversation, so it marks the conversation read.
+
+    Conversations are only history, so this logs errors rather than raising them.
+    """
+    conversationKey = _getKey(number)
+    now = datetime.datetime.utcnow()
+
+    @ndb.tasklet
+    def txn():
+        conversation = yield conversationKey.get_async()
+        if not conversation:
+            conversation = Conversation(key=conversationKey)
+        conversation.name = name
+        conversation.lastMessage = message
+        conversation.lastDirection = direction
+        conversation.lastTime = now
+        conversation.messageCount += 1
+        conversation.unreadCount = conversation.unreadCount + 1 if unread else 0
+
+        conversationMessage = ConversationMessage(parent=conversationKey, direction=direction,
+                                                  message=message, created=now)
+        yield ndb.put_multi_async([conversation, conversationMessage])
+
+    try:
+        yield ndb.transaction_async(txn)
+    except Exception:
+        logging.exception("Could not add message to conversation with " + number)
+
+def markRead(number):
+    """ Mark all messages in the conversation with 'number' as read.
+
+    Returns the Conversation, or None if there isn't one.
+    """
+    @ndb.transactional
+    def txn():
+        conversation = _getKey(number).get()
+        if conversation and conversation.unreadCount:
+            conversation.unreadCount = 0
+            conversation.put()
+        return conversation
+    return txn()
+
+def getConversation(number):
+    return _getKey(number).get()
+
+def getConversations(cursor=None, limit=20):
+    """ Returns (conversations, cursor), most recently active first.
+
+    cursor is None if there are no more conversations.
+    """
+    query = Conversation.query().order(-Conversation.lastTime)
+    return _getPage(query, cursor, limit)
+
+def getMessages(number, cursor=None, limit=20):
+    """ Returns (messages, cursor) for the conversation with 'number', newest first.
+
+    cursor is None if there are no more messages.
+    """
+    query = ConversationMessage.query(ancestor=_getKey(number)).order(-ConversationMessage.created)
+    return _getPage(query, cursor, limit)
@@ -0,0 +1,96 @@
+import collections
+import random
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from util.phonenumberutils import stripNumber
+from models import DigestItem
+
+# URL of the task which sends an email digest to the owner.
+SEND_DIGEST_TASK_URL = "/tasks/sendDigest"
+
+# Wait this long after a window closes before sending its digest, so items
+# stored right at the end of the window make it in.
+_SEND_DELAY = 5
+
+# Each window's items are spread over this many entity groups, since each
+# group only takes about one write a second.
+_SHARD_COUNT = 8
+
+# Maps owner number to the name of the last digest task we queued for them,
+# so we only ask the task queue once per window.
+_queuedTasks = {}
+
+def _getParentKey(window, shard):
+    """ Returns the key of one of the entity groups DigestItems in 'window' are stored under.
+
+    The digest task finds a window's items with an ancestor query on each
+    group, which sees every item stored before it ran.  A plain query could
+    miss one, and it would then wait for the next message to arrive.
+    """
+    return ndb.Key("DigestWindow", str(window) + ":" + str(shard))
+
+def getWindow(windowLength, now=None):
+    """ Returns the number of the digest window 'now' falls in. """
+    if now is None:
+        now = time.time()
+    return int(now // windowLength)
+
+def queueDigestItem(ownerNumber, windowLength, item):
+    """ Store a DigestItem in the current window, and make sure the window's digest will be sent.
+
+    There is one named task per owner per window, so however many items
+    arrive during the window, the owner gets one email.
+    """
+    now = time.time()
+    item.window = getWindow(windowLength, now)
+    item.key = ndb.Key(DigestItem, None, parent=_getParentKey(item.window, random.randrange(0, _SHARD_COUNT)))
+    item.put()
+
+    taskName = "digest-" + stripNumber(ownerNumber) + "-" + str(windowLength) + "-" + str(item.window)
+    if _queuedTasks.get(ownerNumber) == taskName:
+        return
+    try:
+        taskqueue.add(url=SEND_DIGEST_TASK_URL,
+                      name=taskName,
+                      params={"owner": ownerNumber, "window": item.window},
+                      countdown=(item.window + 1) * windowLength - now + _SEND_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # Another instance got here first.
+        pass
+    _queuedTasks[ownerNumber] = taskName
+
+def getItems(window):
+    """ Returns all the DigestItems in 'window' or earlier, oldest first.
+
+    Earlier windows are included in case an item was stored after its
+    window's digest went out.
+    """
+    futures = [DigestItem.query(ancestor=_getParentKey(window, shard)).fetch_async()
+               for shard in range(0, _SHARD_COUNT)]
+    # Items from earlier windows were stored long enough ago for a plain
+    # query to see them.
+    futures.append(DigestItem.query(DigestItem.window < window).fetch_async())
+
+    items = {}
+    for future in futures:
+        for item in future.get_result():
+            items[item.key] = item
+    return sorted(items.values(), key=lambda item: item.created)
+
+def groupItems(items):
+    """ Group DigestItems by who they're from.
+
+    Returns a list of (fromName, fromAddress, items) tuples, in the order
+    each sender first appears in 'items'.
+    """
+    groups = collections.OrderedDict()
+    for item in items:
+        key = (item.fromName, item.fromAddress)
+        groups.setdefault(key, []).append(item)
+    return [(fromName, fromAddress, senderItems) for (fromName, fromAddress), senderItems in groups.items()]
+
+def deleteItems(items):
+    ndb.delete_multi([item.key for item in items])
@@ -1,7 +1,6 @@
 #
 # By Mick Thompson (dthompson@gmail.com) and Jason Walton (dev@lucid.thedreaming.org)
 #
-import logging
 import os
 import json
 import sys
@@ -13,32 +12,94 @@ from webob.exc import HTTPUnauthorized, HTTPForbidden, HTTPException
 
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.mail_handlers import InboundMailHandler
-from google.appengine.api import xmpp, app_identity
+from google.appengine.api import xmpp, app_identity, namespace_manager, datastore_errors
 
 from util import phonenumberutils
+from util import structlog
+from util.latency import LatencyHistograms, LatencyMiddleware
+from util.requestcontext import RequestContextMiddleware
+from util.profiler import Profiler, ProfilerMiddleware, PROFILE_HEADER, MAX_DURATION
 from xmppvoicemail import XmppVoiceMail, Owner, XmppVoiceMailException, PermissionException, InvalidParametersException, SmsException
-from models import XmppUser, Contact
+from models import XmppUser, Contact, ContactIndexState, ContactExistsException, OwnerAccount, BroadcastList
+from owners import OwnerRegistry
+from blocklist import Blocklist
+import smsqueue
+import digest
+import recordings
+import conversations
+import messagesearch
+import contactmigration
+import trafficrollup
 import errors
 
 import config
 
-owner = Owner(config.TWILIO_NUMBER, config.USERJID, config.USER_EMAIL, config.LOG_SIZE)
-xmppVoiceMail = XmppVoiceMail(owner)
+log = structlog.getLogger(__name__)
 
-class CallHandler(webapp2.RequestHandler):
+owner = Owner(config.TWILIO_NUMBER, config.USERJID, config.USER_EMAIL, config.LOG_SIZE)
+owners = OwnerRegistry(owner, multiOwner=getattr(config, "MULTI_OWNER", False))
+xmppVoiceMail = owners.getDefault()
+blocklist = Blocklist(getattr(config, "SENDER_RATE_LIMIT", 0), getattr(config, "SENDER_RATE_WINDOW", 60))
+latencyHistograms = LatencyHistograms()
+
+profiler = None
+if getattr(config, "PROFILER", False):
+    profiler = Profiler(config.SESSION_SECRET_KEY)
+
+recordingCache = None
+if getattr(config, "RECORDING_PROXY", False):
+    recordingStore = recordings.getDefaultStore()
+    if recordingStore:
+        recordingCache = recordings.RecordingCache(recordingStore)
+
+# Longest time to hold a request for new log items, in seconds.  Well under
+# the 60 second request deadline.
+_LOG_WAIT_TIME = 25
+
+# Sent to Twilio for calls and messages we're dropping.
+_EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+def useOwner(voiceMail):
+    """ Switch the current request into the namespace of voiceMail's owner. """
+    namespace_manager.set_namespace(voiceMail.getOwner().namespace or "")
+    return voiceMail
+
+class TwilioHandler(webapp2.RequestHandler):
+    def getVoiceMail(self):
+        """ Returns the XmppVoiceMail for the Twilio number this request was sent to. """
+        toNumber = self.request.get("To") or self.request.get("Called")
+        voiceMail = owners.getByPhoneNumber(toNumber)
+        if not voiceMail:
+            log.warn("twilio.unknownNumber", to=toNumber)
+            self.abort(404)
+        return useOwner(voiceMail)
+
+    def dropBlockedSender(self, fromNumber):
+        """ Returns True, after writing an empty response, if 'fromNumber' is blocked. """
+        if blocklist.check(fromNumber):
+            self.response.headers['Content-Type'] = 'text/xml'
+            self.response.out.write(_EMPTY_TWIML)
+            return True
+        return False
+
+class CallHandler(TwilioHandler):
     # Handles an incoming voice call from Twilio.
     def post(self):
         fromNumber = self.request.get("From")
         callStatus = self.request.get("CallStatus")
 
-        xmppVoiceMail.handleIncomingCall(fromNumber, callStatus)
+        voiceMail = self.getVoiceMail()
+        if self.dropBlockedSender(fromNumber):
+            return
+
+        voiceMail.handleIncomingCall(fromNumber, callStatus)
 
         path = os.path.join(os.path.dirname(__file__), 'templates/receivecall.xml')
         template_vars = {"callbackurl": "/recording"}
         self.response.out.write(template.render(path, template_vars))
 
 
-class PostRecording(webapp2.RequestHandler):
+class PostRecording(TwilioHandler):
     # Handle incoming voide mail from Twilio.
     def post(self):
         recordingUrl = self.request.get("RecordingUrl")
@@ -46,13 +107,19 @@ class PostRecording(webapp2.RequestHandler):
         fromNumber = self.request.get("Caller")
         transcriptionText = self.request.get("TranscriptionText")
 
-        result = xmppVoiceMail.handleVoiceMail(fromNumber, transcriptionText, recordingUrl)
+        recordingSid = recordings.getRecordingSid(recordingUrl)
+        if recordingCache and recordingSid:
+            # Send the owner a link to our copy of the recording.
+            recordings.queueFetch(recordingSid)
+            recordingUrl = recordings.getProxyUrl(self.request.host_url, recordingUrl)
+
+        result = self.getVoiceMail().handleVoiceMail(fromNumber, transcriptionText, recordingUrl)
 
         if(result):
             self.response.out.write('')
 
 
-class SMSHandler(webapp2.RequestHandler):
+class SMSHandler(TwilioHandler):
     # Handles an incoming SMS message from Twilio.
     def get(self):
         self.post()
@@ -61,14 +128,19 @@ class SMSHandler(webapp2.RequestHandler):
         fromNumber = self.request.get("From")
         toNumber = self.request.get("To")
         body = self.request.get("Body")
+
+        voiceMail = self.getVoiceMail()
+        if self.dropBlockedSender(fromNumber):
+            return
         
-        xmppVoiceMail.handleIncomingSms(fromNumber, toNumber, body)
+        voiceMail.handleIncomingSms(fromNumber, toNumber, body)
 
         self.response.out.write("")
 
 
 class MailHandler(InboundMailHandler):
     def receive(self, mail_message):
+        xmppVoiceMail = useOwner(owners.getByEmail(mail_message.sender) or owners.getDefault())
         try:
             sender = mail_message.sender
             to = mail_message.to
@@ -90,7 +162,7 @@ class MailHandler(InboundMailHandler):
             xmppVoiceMail.sendEmailMessageToOwner("Error sending SMS: " + e.value)            
             
         except PermissionException as e:
-            logging.error(str(e))
+            log.error("mail.permissionDenied", sender=sender, error=e.value)
             
 class XMPPHandler(webapp2.RequestHandler):
     # Handle an incoming XMPP message
@@ -99,6 +171,7 @@ class XMPPHandler(webapp2.RequestHandler):
 
         try:
             sender = message.sender.split('/')[0]
+            xmppVoiceMail = useOwner(owners.getByJid(sender) or owners.getDefault())
             to = message.to.split("/")[0]
             messageBody = message.body
             xmppVoiceMail.handleIncomingXmpp(sender, to, messageBody)
@@ -111,7 +184,7 @@ class XMPPHandler(webapp2.RequestHandler):
             message.reply("Error sending SMS: " + e.value)
             
         except:
-            logging.exception(sys.exc_info()[0])
+            log.exception("xmpp.error", sender=message.sender)
             message.reply("Unexpected error:" + str(sys.exc_info()[0]))
 
 
@@ -121,19 +194,18 @@ class XmppPresenceHandler(webapp2.RequestHandler):
         userJid = self.request.get('from').split('/')[0]
         userAvailable = (available == 'available')
 
-        if userJid != owner.jid:
-            logging.warn("Got XMPP presence for unknown user " + userJid)
+        voiceMail = owners.getByJid(userJid)
+        if (not voiceMail) or (userJid != voiceMail.getOwner().jid):
+            log.warn("xmpp.presence.unknownUser", jid=userJid)
         else:
-            if userAvailable:
-                logging.info("User " + userJid + " became available.")
-            else:
-                logging.info("User " + userJid + " went away.")
+            useOwner(voiceMail)
+            log.info("xmpp.presence", jid=userJid, available=userAvailable)
 
             # Update the user in the DB.
             user = XmppUser.getByJid(userJid)
             if not user:
-                logging.info("Creating DB entry for user " + userJid)
-                user = XmppUser(jid=userJid, presence=userAvailable)
+                log.info("xmpp.user.create", jid=userJid)
+                user = XmppUser(id=userJid, jid=userJid, presence=userAvailable)
             else:
                 user.presence = userAvailable
 
@@ -145,18 +217,131 @@ class XmppSubscribeHandler(webapp2.RequestHandler):
         to = self.request.get('to').split('/')[0]
 
         contactName = to.split('@')[0]
-        
+
+        useOwner(owners.getByJid(sender) or owners.getDefault())
         contact = Contact.getByName(contactName)
         if not contact:
-            logging.error("Got subscription type " + subscriptionType + " for unknown contact " + to)
+            log.error("xmpp.subscription.unknownContact", type=subscriptionType, to=to)
         else:
-            logging.info("Got subscription type " + subscriptionType + " from " + sender + " to " + to)        
+            log.info("xmpp.subscription", type=subscriptionType, sender=sender, to=to)
             if subscriptionType.startswith("un"):
                 contact.subscribed = False
             else:
                 contact.subscribed = True
             Contact.update(contact)
 
+class TaskHandler(webapp2.RequestHandler):
+    """ Base class for handlers which are only run from the task queue. """
+    def dispatch(self):
+        # App Engine strips this header from requests that don't come from the task queue.
+        if not self.request.headers.get('X-AppEngine-QueueName'):
+            raise HTTPForbidden()
+        super(TaskHandler, self).dispatch()
+
+class SendSmsTask(TaskHandler):
+    """ Sends an SMS message which was delayed by the rate limiter, or is being retried. """
+    def post(self):
+        voiceMail = owners.getByPhoneNumber(self.request.get("owner"))
+        if not voiceMail:
+            log.error("task.unknownOwner", task="sendSms", owner=self.request.get("owner"))
+            return
+
+        useOwner(voiceMail).sendPendingSMS(self.request.get("id"))
+
+class SendDigestTask(TaskHandler):
+    """ Sends the owner an email digest of the messages they missed while offline. """
+    def post(self):
+        voiceMail = owners.getByPhoneNumber(self.request.get("owner"))
+        if not voiceMail:
+            log.error("task.unknownOwner", task="sendDigest", owner=self.request.get("owner"))
+            return
+
+        useOwner(voiceMail).sendDigest(int(self.request.get("window")))
+
+class IndexSearchTask(TaskHandler):
+    """ Adds logged messages to the search index. """
+    def post(self):
+        if messagesearch.indexPending():
+            # Still more to do.
+            messagesearch.queueIndexer()
+
+class MigrateContactsTask(TaskHandler):
+    """ Gives a batch of an owner's contacts their index entities, then queues the next batch. """
+    def post(self):
+        voiceMail = owners.getByPhoneNumber(self.request.get("owner"))
+        if not voiceMail:
+            log.error("task.unknownOwner", task="migrateContacts", owner=self.request.get("owner"))
+            return
+
+        useOwner(voiceMail)
+        cursor = contactmigration.migrateBatch(self.request.get("cursor") or None)
+        if cursor:
+            contactmigration.queueMigration(voiceMail.getOwner().phoneNumber, cursor)
+        else:
+            log.info("contacts.migrated", owner=voiceMail.getOwner().phoneNumber)
+
+class FetchRecordingTask(TaskHandler):
+    """ Copies a new voicemail recording from Twilio. """
+    def post(self):
+        if not recordingCache:
+            # The proxy was turned off after the task was queued.
+            return
+        recordingSid = self.request.get("sid")
+        try:
+            recordingCache.getSize(recordingSid)
+        except recordings.RecordingNotFoundException as e:
+            # Don't retry; we'll try again if someone asks for the recording.
+            log.warn("recording.fetchFailed", sid=recordingSid, error=str(e))
+
+# The admin UI's page, as bundled by tools/build_assets.py, and as checked in.
+_INDEX_PATHS = [os.path.join(os.path.dirname(__file__), 'assets/dist/index.html'),
+                os.path.join(os.path.dirname(__file__), 'assets/index.html')]
+
+class IndexHandler(webapp2.RequestHandler):
+    """ Serves the admin UI, falling back to the unbundled page if the assets weren't built. """
+    def get(self):
+        path = next(path for path in _INDEX_PATHS if os.path.exists(path))
+        with open(path) as indexFile:
+            self.response.headers['Cache-Control'] = 'no-cache'
+            self.response.write(indexFile.read())
+
+class RecordingHandler(webapp2.RequestHandler):
+    """ Serves a voicemail recording, from our copy rather than from Twilio. """
+    def get(self, recordingSid):
+        if (not recordingCache) or (not recordings.checkSignature(recordingSid, self.request.get("sig"))):
+            raise HTTPForbidden()
+
+        etag = '"' + recordingSid + '"'
+        self.response.headers['Cache-Control'] = recordings.CACHE_CONTROL
+        self.response.headers['ETag'] = etag
+        self.response.headers['Accept-Ranges'] = 'bytes'
+        if self.request.headers.get('If-None-Match') == etag:
+            self.response.set_status(304)
+            return
+
+        try:
+            size = recordingCache.getSize(recordingSid)
+        except recordings.RecordingNotFoundException as e:
+            log.warn("recording.fetchFailed", sid=recordingSid, error=str(e))
+            self.abort(404)
+
+        try:
+            byteRange = recordings.parseRange(self.request.headers.get('Range'), size)
+        except ValueError:
+            self.response.headers['Content-Range'] = 'bytes */%d' % size
+            self.response.set_status(416)
+            return
+
+        if byteRange:
+            start, end = byteRange
+            self.response.set_status(206)
+            self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        else:
+            start, end = 0, size - 1
+
+        self.response.headers['Content-Type'] = recordingCache.getContentType()
+        self.response.write(recordingCache.read(recordingSid, start, end - start + 1))
+
 class BaseApiHandler(webapp2.RequestHandler):
     def handle_exception(self, exception, debug):
         if isinstance(exception, errors.ValidationError) or isinstance(exception, errors.BadPasswordError):
@@ -168,7 +353,7 @@ class BaseApiHandler(webapp2.RequestHandler):
             self.response.set_status(exception.code)
         
         else:
-            logging.exception(exception)
+            log.exception("api.error", path=self.request.path)
             self.response.out.write(json.dumps({"errorType": exception.__class__.__name__, "error": str(exception)}));
             self.response.set_status(500)
 
@@ -177,6 +362,19 @@ class BaseApiHandler(webapp2.RequestHandler):
         # Returns a session using the default cookie key.
         return self.session_store.get_session()
 
+    def getLimit(self, default, maximum):
+        """ Returns the 'limit' parameter, or 'default', at most 'maximum'.
+
+        Raises ValidationError if limit isn't a positive number.
+        """
+        try:
+            limit = int(self.request.get("limit") or default)
+        except ValueError:
+            raise errors.ValidationError("Invalid limit.")
+        if limit <= 0:
+            raise errors.ValidationError("limit must be at least 1.")
+        return min(limit, maximum)
+
 class LoginHandler(BaseApiHandler):
     def dispatch(self):
         self.session_store = sessions.get_store(request=self.request)
@@ -204,6 +402,16 @@ class AuthenticatedApiHandler(BaseApiHandler):
         if not "xmppVoiceMailUser" in self.session:
             raise HTTPUnauthorized()
 
+        # In multi-owner mode, the 'owner' parameter picks which owner to manage.
+        ownerNumber = self.request.get("owner")
+        if ownerNumber:
+            self.xmppVoiceMail = owners.getByPhoneNumber(ownerNumber)
+            if not self.xmppVoiceMail:
+                raise errors.ValidationError("Unknown owner " + ownerNumber)
+        else:
+            self.xmppVoiceMail = owners.getDefault()
+        useOwner(self.xmppVoiceMail)
+
         try:        
             super(BaseApiHandler, self).dispatch()
         finally:
@@ -218,8 +426,7 @@ class AdminContactsHandler(AuthenticatedApiHandler):
         defaultSender = Contact.getDefaultSender()
         answer.append(defaultSender.toDict())
 
-        contacts = Contact.all()
-        contacts.filter('__key__ !=', defaultSender.key())
+        contacts = Contact.query(Contact.key != defaultSender.key)
         
         for contact in contacts:
             answer.append(contact.toDict())
@@ -230,33 +437,31 @@ class AdminContactsHandler(AuthenticatedApiHandler):
     def post(self):
         user = json.loads(self.request.body)
 
-        if not phonenumberutils.validateNumber(user['phoneNumber']):
+        parsedNumber = phonenumberutils.parseNumber(user['phoneNumber'])
+        if not parsedNumber:
             raise errors.ValidationError("Invalid phone number.")
             #return validationError(self.response, 'Invalid number ' + user['phoneNumber'])
         
         if not user['name']:
             raise errors.ValidationError("Name is required.")
         
-        # Make sure we're not duplicating another contact
-        existingContact = Contact.getByName(user['name'])
-        if existingContact:
-            raise errors.ValidationError('User already exists with name ' + user['name'])
-        
-        existingContact = Contact.getByPhoneNumber(user['phoneNumber'])
-        if existingContact:
-            raise errors.ValidationError('User ' + existingContact.name +
-              ' already exists with number ' + existingContact.phoneNumber)
-
-
-        logging.info("Creating contact " + user["name"])
+        log.info("contact.create", name=user["name"])
+        normalizedNumber, prettyNumber = parsedNumber
         contact = Contact(
             name = user['name'].lower(),
-            phoneNumber = phonenumberutils.toPrettyNumber(user['phoneNumber']),
-            normalizedPhoneNumber = phonenumberutils.toNormalizedNumber(user['phoneNumber']))
+            phoneNumber = prettyNumber,
+            normalizedPhoneNumber = normalizedNumber)
 
-        Contact.update(contact)
+        # update() makes sure we're not duplicating another contact.
+        try:
+            Contact.update(contact)
+        except ContactExistsException as e:
+            if e.propertyName == "name":
+                raise errors.ValidationError('User already exists with name ' + user['name'])
+            raise errors.ValidationError('User ' + e.contact.name +
+              ' already exists with number ' + e.contact.phoneNumber)
 
-        xmppVoiceMail.sendXmppInvite(contact.name)
+        self.xmppVoiceMail.sendXmppInvite(contact.name)
 
         self.response.headers['Content-Type'] = 'application/json'
         self.response.write(json.dumps(contact.toDict()))
@@ -266,23 +471,115 @@ class AdminContactsHandler(AuthenticatedApiHandler):
         if contact:
             if contact.isDefaultSender():
                 raise errors.ValidationError("Cannot delete default sender.")
-            logging.info("Deleting contact " + contact.name)
+            log.info("contact.delete", name=contact.name)
             contact.delete()
         
     # TODO: Add put support for edits.
+
+class AdminContactMigrationHandler(AuthenticatedApiHandler):
+    """ Gives contacts stored before contacts had index entities their index entities.
+
+    GET reports whether that's done; POST starts it.
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({"migrated": ContactIndexState.isMigrated()}))
+
+    def post(self):
+        log.info("contacts.migrate")
+        contactmigration.queueMigration(self.xmppVoiceMail.getOwner().phoneNumber)
+
+class AdminContactSearchHandler(AuthenticatedApiHandler):
+    """ Finds contacts by name prefix, or by the last digits of their number. """
+    def get(self):
+        query = self.request.get("q")
+        limit = self.getLimit(20, 100)
+
+        answer = []
+        if query:
+            answer = Contact.search(query, limit)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(answer))
         
 class AdminLogHandler(AuthenticatedApiHandler):
-    # Handle REST API calls for log entries    
+    # Handle REST API calls for log entries.
+    #
+    # With 'since', only returns items logged after that lastId.  With 'wait'
+    # as well, waits for new items if there aren't any yet.
     def get(self):
-        logItems = xmppVoiceMail.getLog()
+        since = self.request.get("since")
+        if since and not all(seq.isdigit() for seq in since.split(".")):
+            raise errors.ValidationError("Invalid since.")
+
+        if self.request.get("wait"):
+            logItems, lastId = self.xmppVoiceMail.waitForLog(since, _LOG_WAIT_TIME)
+        else:
+            logItems, lastId = self.xmppVoiceMail.getNewLog(since)
+
         logItemsJson = [logItem.toDict() for logItem in logItems]
         answer = {
             "now": time.mktime(time.gmtime()) * 1000,
+            "lastId": lastId,
             "logItems": logItemsJson
         }
         self.response.headers['Content-Type'] = 'application/json'
         self.response.write(json.dumps(answer))
 
+class AdminConversationsHandler(AuthenticatedApiHandler):
+    """ Lists conversations with a summary of each, or pages through the messages in one. """
+    def get(self, number=None):
+        limit = self.getLimit(20, 100)
+        cursor = self.request.get("cursor")
+
+        try:
+            if number:
+                conversation = conversations.getConversation(number)
+                if not conversation:
+                    self.abort(404)
+                messages, cursor = conversations.getMessages(number, cursor, limit)
+                answer = {
+                    "conversation": conversation.toDict(),
+                    "messages": [message.toDict() for message in messages],
+                    "cursor": cursor
+                }
+            else:
+                summaries, cursor = conversations.getConversations(cursor, limit)
+                answer = {
+                    "conversations": [summary.toDict() for summary in summaries],
+                    "cursor": cursor
+                }
+        except datastore_errors.BadValueError:
+            raise errors.ValidationError("Invalid cursor.")
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(answer))
+
+class AdminSearchHandler(AuthenticatedApiHandler):
+    """ Searches logged messages. """
+    def get(self):
+        limit = self.getLimit(20, 100)
+        before = self.request.get("before")
+        if before and not before.isdigit():
+            raise errors.ValidationError("Invalid cursor.")
+
+        results, cursor = messagesearch.search(self.request.get("q"), int(before or 0), limit)
+        answer = {
+            "results": [result.toDict() for result in results],
+            "cursor": cursor
+        }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(answer))
+
+class AdminConversationReadHandler(AuthenticatedApiHandler):
+    """ Marks a conversation as read. """
+    def post(self, number):
+        conversation = conversations.markRead(number)
+        if not conversation:
+            self.abort(404)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(conversation.toDict()))
 
 class InviteHandler(AuthenticatedApiHandler):
     """ Sends invites for all selected users. """
@@ -292,10 +589,10 @@ class InviteHandler(AuthenticatedApiHandler):
         idsToInvite = json.loads(self.request.body)
         invited = []
 
-        if owner.xmppEnabled():        
+        if self.xmppVoiceMail.getOwner().xmppEnabled():        
             for contactId in idsToInvite:
                 contact = Contact.getByIdString(contactId)
-                xmppVoiceMail.sendXmppInvite(contact.name)
+                self.xmppVoiceMail.sendXmppInvite(contact.name)
                 invited.append(contact.name)
 
         self.response.headers['Content-Type'] = 'application/json'
@@ -317,37 +614,275 @@ class SendSmsHandler(AuthenticatedApiHandler):
         else:
             if not phonenumberutils.validateNumber(data['to']):
                 raise errors.ValidationError("Invalid phone number.")
-            else:
-                toNumber = phonenumberutils.toNormalizedNumber(data['to'])
+            toNumber = phonenumberutils.toNormalizedNumber(data['to'])
         
-        xmppVoiceMail.sendSMS(contact, toNumber, data['message'])
+        self.xmppVoiceMail.sendSMS(contact, toNumber, data['message'])
 
         self.response.headers['Content-Type'] = 'application/json'
         self.response.out.write(json.dumps({'message': 'sent'}))
 
+class AdminBlocklistHandler(AuthenticatedApiHandler):
+    """ Lists, adds and removes blocked numbers and prefixes. """
+    def get(self):
+        answer = {
+            "blocked": [blockedNumber.toDict() for blockedNumber in blocklist.getBlockedNumbers()],
+            "dropCounts": blocklist.getDropCounts()
+        }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(answer))
+
+    def post(self):
+        data = json.loads(self.request.body)
+        blockedNumber = blocklist.block(data.get('pattern', ''))
+        if not blockedNumber:
+            raise errors.ValidationError("Enter a phone number, or a number prefix followed by '*'.")
+
+        log.info("blocklist.block", pattern=blockedNumber.getPattern())
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(blockedNumber.toDict()))
+
+    def delete(self, pattern):
+        normalizedPattern = blocklist.unblock(pattern)
+        if not normalizedPattern:
+            raise errors.ValidationError("Enter a phone number, or a number prefix followed by '*'.")
+        log.info("blocklist.unblock", pattern=normalizedPattern)
+
+class AdminBroadcastListsHandler(AuthenticatedApiHandler):
+    """ Lists, saves and deletes broadcast lists.
+
+    Send to a list by sending "listname: message" to the default sender.
+    """
+    def get(self):
+        answer = [broadcastList.toDict() for broadcastList in BroadcastList.getAll()]
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(answer))
+
+    def post(self):
+        data = json.loads(self.request.body)
+
+        name = (data.get('name') or '').strip().lower()
+        if not name:
+            raise errors.ValidationError("Name is required.")
+        if (',' in name) or (':' in name) or phonenumberutils.validateNumber(name):
+            raise errors.ValidationError("Invalid list name " + name)
+        if Contact.getByName(name):
+            raise errors.ValidationError("A contact already exists with name " + name)
+
+        members = []
+        for member in data.get('members') or []:
+            member = member.strip()
+            parsedNumber = phonenumberutils.parseNumber(member)
+            if parsedNumber:
+                member = parsedNumber[0]
+            else:
+                contact = Contact.getByName(member)
+                if not contact or contact.isDefaultSender():
+                    raise errors.ValidationError("Unknown number or contact " + member)
+                member = contact.name
+            if not member in members:
+                members.append(member)
+        if not members:
+            raise errors.ValidationError("A list needs at least one member.")
+
+        log.info("broadcastList.save", name=name, members=len(members))
+        broadcastList = BroadcastList(id=name, members=members)
+        broadcastList.put()
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(broadcastList.toDict()))
+
+    def delete(self, name):
+        broadcastList = BroadcastList.getByName(name)
+        if broadcastList:
+            log.info("broadcastList.delete", name=broadcastList.getName())
+            broadcastList.key.delete()
+
+class AdminSmsRateHandler(AuthenticatedApiHandler):
+    """ Reports how full the outbound SMS rate limiter's buckets are. """
+    def get(self):
+        toNumber = self.request.get("to")
+        if toNumber:
+            toNumber = phonenumberutils.toNormalizedNumber(toNumber)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(self.xmppVoiceMail.getSMSRateStatus(toNumber)))
+
+class AdminSmsGatewaysHandler(AuthenticatedApiHandler):
+    """ Reports each SMS gateway's latency, error rate and circuit breaker state. """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(self.xmppVoiceMail.getSMSGatewayStatus()))
+
+class AdminLatencyHandler(AuthenticatedApiHandler):
+    """ Reports p50, p95 and p99 latency for each route, across all instances. """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(latencyHistograms.getPercentiles()))
+
+class AdminMetricsHandler(AuthenticatedApiHandler):
+    """ Reports hourly message counts, from the traffic rollups.
+
+    Takes 'hours', 'groupBy' (a comma separated list of direction, channel
+    and contact), and 'direction', 'channel' or 'contact' to count only
+    matching messages.
+    """
+    def get(self):
+        try:
+            hours = int(self.request.get("hours") or 24)
+        except ValueError:
+            raise errors.ValidationError("Invalid hours.")
+        if not 0 < hours <= trafficrollup.MAX_HOURS:
+            raise errors.ValidationError("hours must be between 1 and " + str(trafficrollup.MAX_HOURS) + ".")
+
+        groupBy = trafficrollup.DIMENSIONS
+        if self.request.get("groupBy"):
+            groupBy = tuple(self.request.get("groupBy").split(","))
+            if not set(groupBy) <= set(trafficrollup.DIMENSIONS):
+                raise errors.ValidationError("Invalid groupBy.")
+
+        answer = trafficrollup.rollups.getSeries(hours, groupBy,
+                                                 direction=self.request.get("direction"),
+                                                 channel=self.request.get("channel"),
+                                                 contact=self.request.get("contact"))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(answer))
+
+class AdminProfileHandler(AuthenticatedApiHandler):
+    """ Turns profiling on and off, and reports where profiled requests spent their time.
+
+    GET takes 'limit', and 'sort' (totalTime or cumulativeTime).  POST takes
+    {"enabled", "sampleRate", "duration"}; with a sampleRate of 0, only
+    requests which send the profile header are profiled.
+    """
+    def _getProfiler(self):
+        if not profiler:
+            raise errors.ValidationError("Set PROFILER in config.py to allow profiling.")
+        return profiler
+
+    def get(self):
+        sortBy = self.request.get("sort") or "totalTime"
+        if not sortBy in ("totalTime", "cumulativeTime"):
+            raise errors.ValidationError("Invalid sort.")
+        limit = self.getLimit(50, 500)
+
+        answer = self._getProfiler().getStats(limit, sortBy)
+        answer["settings"] = self._getProfiler().getSettings()
+        answer["header"] = PROFILE_HEADER
+        answer["token"] = self._getProfiler().getToken()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(answer))
+
+    def post(self):
+        data = json.loads(self.request.body)
+        try:
+            sampleRate = float(data.get('sampleRate', 0))
+            duration = int(data.get('duration', 60 * 60))
+        except (TypeError, ValueError):
+            raise errors.ValidationError("Invalid sampleRate or duration.")
+        if not 0 <= sampleRate <= 1:
+            raise errors.ValidationError("sampleRate must be between 0 and 1.")
+        if not 0 < duration <= MAX_DURATION:
+            raise errors.ValidationError("duration must be between 1 and " + str(MAX_DURATION) + " seconds.")
+
+        enabled = bool(data.get('enabled'))
+        log.info("profiler.settings", enabled=enabled, sampleRate=sampleRate, duration=duration)
+        self._getProfiler().setSettings(enabled, sampleRate, duration)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(self._getProfiler().getSettings()))
+
+    def delete(self):
+        self._getProfiler().clearStats()
+
+class AdminOwnersHandler(AuthenticatedApiHandler):
+    """ Lists and creates owners for multi-owner mode. """
+    def get(self):
+        answer = [account.toDict() for account in OwnerAccount.getAll()]
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(answer))
+
+    def post(self):
+        if not owners.isMultiOwner():
+            raise errors.ValidationError("Set MULTI_OWNER in config.py to add owners.")
+
+        data = json.loads(self.request.body)
+        phoneNumber = data.get('phoneNumber')
+        if not (isinstance(phoneNumber, basestring) and phonenumberutils.validateNumber(phoneNumber)):
+            raise errors.ValidationError("Invalid phone number.")
+
+        for field, description in [('jid', "XMPP address"), ('emailAddress', "email address")]:
+            if not isinstance(data.get(field) or "", basestring):
+                raise errors.ValidationError("Invalid " + description + ".")
+        if not (data.get('jid') or data.get('emailAddress')):
+            raise errors.ValidationError("An XMPP address or email address is required.")
+
+        logSize = config.LOG_SIZE
+        if 'logSize' in data:
+            logSize = data['logSize']
+            if isinstance(logSize, basestring) and logSize.isdigit():
+                logSize = int(logSize)
+            if isinstance(logSize, bool) or not isinstance(logSize, (int, long)) or logSize < 1:
+                raise errors.ValidationError("logSize must be a positive whole number.")
+
+        log.info("owner.create", phoneNumber=phoneNumber)
+        account = OwnerAccount.create(
+            phoneNumber=phoneNumber,
+            jid=data.get('jid'),
+            emailAddress=data.get('emailAddress'),
+            logSize=logSize)
+        owners.clear()
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(account.toDict()))
+
 def handle_404(request, response, exception):
-    logging.exception(exception)
+    log.warn("notFound", path=request.path)
     response.write('Oops! I could swear this page was here!')
     response.set_status(404)
 
 def handle_500(request, response, exception):
-    logging.exception(exception)
+    log.exception("serverError", path=request.path)
     response.write('A server error occurred!')
     response.set_status(500)
         
 def main():
     routes = [
+        (r'/', IndexHandler),
+        (r'/index.html', IndexHandler),
         (r'/recording', PostRecording),
         (r'/call', CallHandler),
         (r'/sms', SMSHandler),
+        (recordings.RECORDING_URL + r'/(RE[0-9a-zA-Z]+)\.mp3', RecordingHandler),
         
         (r'/api/login', LoginHandler),
         (r'/api/admin/contacts', AdminContactsHandler),
+        (r'/api/admin/contacts/search', AdminContactSearchHandler),
+        (r'/api/admin/contacts/migrate', AdminContactMigrationHandler),
         (r'/api/admin/contacts/(.*)', AdminContactsHandler),
         (r'/api/admin/log', AdminLogHandler),
+        (r'/api/admin/search', AdminSearchHandler),
+        (r'/api/admin/conversations', AdminConversationsHandler),
+        (r'/api/admin/conversations/([^/]+)', AdminConversationsHandler),
+        (r'/api/admin/conversations/([^/]+)/read', AdminConversationReadHandler),
         (r'/api/invite', InviteHandler),
         (r'/api/sendSms', SendSmsHandler),
+        (r'/api/admin/owners', AdminOwnersHandler),
+        (r'/api/admin/smsRate', AdminSmsRateHandler),
+        (r'/api/admin/smsGateways', AdminSmsGatewaysHandler),
+        (r'/api/admin/latency', AdminLatencyHandler),
+        (r'/api/admin/metrics', AdminMetricsHandler),
+        (r'/api/admin/profile', AdminProfileHandler),
+        (r'/api/admin/blocklist', AdminBlocklistHandler),
+        (r'/api/admin/blocklist/(.*)', AdminBlocklistHandler),
+        (r'/api/admin/broadcastLists', AdminBroadcastListsHandler),
+        (r'/api/admin/broadcastLists/(.*)', AdminBroadcastListsHandler),
         
+        (smsqueue.SEND_SMS_TASK_URL, SendSmsTask),
+        (digest.SEND_DIGEST_TASK_URL, SendDigestTask),
+        (messagesearch.INDEX_TASK_URL, IndexSearchTask),
+        (recordings.FETCH_RECORDING_TASK_URL, FetchRecordingTask),
+        (contactmigration.MIGRATE_CONTACTS_TASK_URL, MigrateContactsTask),
+
         (r'/_ah/xmpp/message/chat/', XMPPHandler),
         (r'/_ah/xmpp/presence/(available|unavailable)/', XmppPresenceHandler),
         (r'/_ah/xmpp/subscription/(subscribe|subscribed|unsubscribe|unsubscribed)/', XmppSubscribeHandler),
@@ -369,7 +904,9 @@ def main():
     if not defaultSender.subscribed:
         xmppVoiceMail.sendXmppInvite(defaultSender.name)
        
-    return app
+    if profiler:
+        app = ProfilerMiddleware(app, profiler)
+    return RequestContextMiddleware(LatencyMiddleware(app, [route[0] for route in routes], latencyHistograms))
 
 app = main()
 
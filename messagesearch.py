@@ -0,0 +1,322 @@
+""" Full text search over logged messages.
+
+Messages are queued on a pull queue as they're logged, and a task adds them
+to the index in batches: each message becomes a SearchDocument with the next
+document id, and its id is appended to the postings of each of its terms.
+
+The index is only consistent because one indexer task runs at a time, which
+queue.yaml ensures with max_concurrent_requests: 1 on the searchindexer
+queue.  _indexItems() reads SearchIndexState and each SearchTerm, writes the
+new postings, and then saves SearchIndexState, without a transaction; a
+batch can touch more terms than a cross-group transaction allows.  Two
+indexers running at once would hand out the same document ids and overwrite
+each other's postings, so don't raise that setting.
+"""
+import bisect
+import datetime
+import json
+import logging
+import re
+import time
+
+from google.appengine.api import namespace_manager
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from util import postings
+from models import SearchDocument, SearchTerm, PostingChunk, SearchIndexState
+
+# URL of the task which adds waiting messages to the search index.
+INDEX_TASK_URL = "/tasks/indexSearch"
+
+# Pull queue of messages waiting to be indexed.
+_PENDING_QUEUE = "searchindex"
+
+# Queue the indexer runs on.  It only runs one task at a time, so document
+# ids are handed out in order, and each term's postings are only appended to
+# by one task.
+_INDEXER_QUEUE = "searchindexer"
+
+# While messages are arriving, the indexer runs this often, in seconds.
+_INDEX_INTERVAL = 10
+
+# Most messages indexed by one task, and how long it has to index them.
+_BATCH_SIZE = 200
+_LEASE_SECONDS = 60
+
+# Move a term's tail into a PostingChunk once it's this many bytes.
+CHUNK_SIZE = 32 * 1024
+
+# Most documents fetched at once to check for phrases.
+_MAX_PHRASE_BATCH = 200
+
+# Longer words aren't indexed.
+_MAX_TERM_LENGTH = 100
+
+_termRegex = re.compile(r"\w+", re.UNICODE)
+_queryRegex = re.compile(r'"([^"]*)"?|(\S+)')
+
+# Name of the last indexer task this instance queued.
+_lastIndexTask = None
+
+def tokenize(text):
+    """ Returns the terms in 'text', in order. """
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return [term for term in _termRegex.findall(text.lower()) if len(term) <= _MAX_TERM_LENGTH]
+
+def queueDocument(direction, contact, message):
+    """ Queue a logged message to be added to the search index.
+
+    Search is only a convenience, so errors are logged rather than raised.
+    """
+    payload = json.dumps({
+        "namespace": namespace_manager.get_namespace(),
+        "direction": direction,
+        "contact": contact,
+        "message": message,
+        "time": time.time()
+    })
+    try:
+        taskqueue.Queue(_PENDING_QUEUE).add(taskqueue.Task(payload=payload, method="PULL"))
+        _scheduleIndexer()
+    except taskqueue.Error:
+        logging.exception("Could not queue message for search")
+
+def _scheduleIndexer():
+    """ Make sure the indexer will run at the end of the current interval. """
+    global _lastIndexTask
+
+    now = time.time()
+    interval = int(now // _INDEX_INTERVAL)
+    taskName = "searchindex-" + str(interval)
+    if _lastIndexTask == taskName:
+        return
+    try:
+        taskqueue.add(url=INDEX_TASK_URL, name=taskName, queue_name=_INDEXER_QUEUE,
+                      countdown=(interval + 1) * _INDEX_INTERVAL - now)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # Another instance got here first.
+        pass
+    _lastIndexTask = taskName
+
+def queueIndexer():
+    """ Run the indexer again as soon as possible. """
+    taskqueue.add(url=INDEX_TASK_URL, queue_name=_INDEXER_QUEUE)
+
+def indexPending():
+    """ Add a batch of waiting messages to the search index.
+
+    Returns True if there may be more messages waiting.
+    """
+    queue = taskqueue.Queue(_PENDING_QUEUE)
+    tasks = queue.lease_tasks(_LEASE_SECONDS, _BATCH_SIZE)
+    if not tasks:
+        return False
+
+    itemsByNamespace = {}
+    for task in tasks:
+        try:
+            item = json.loads(task.payload)
+        except ValueError:
+            logging.error("Dropping unreadable search item: " + repr(task.payload))
+            continue
+        itemsByNamespace.setdefault(item.get("namespace", ""), []).append(item)
+
+    oldNamespace = namespace_manager.get_namespace()
+    try:
+        for namespace, items in itemsByNamespace.items():
+            namespace_manager.set_namespace(namespace)
+            _indexItems(items)
+    finally:
+        namespace_manager.set_namespace(oldNamespace)
+
+    queue.delete_tasks(tasks)
+    return len(tasks) == _BATCH_SIZE
+
+def _indexItems(items):
+    """ Store 'items' as SearchDocuments, and add them to the postings for their terms.
+
+    If this fails part way through, running it again with the same items
+    gives them the same ids, and skips postings which were already added.
+    Only one of these may run at a time; see the module docstring.
+    """
+    state = SearchIndexState.get_or_insert("state")
+    docId = state.nextDocId
+
+    toPut = []
+    termDocIds = {}
+    for item in items:
+        toPut.append(SearchDocument(id=docId,
+                                    contact=item.get("contact"),
+                                    direction=item.get("direction"),
+                                    message=item.get("message"),
+                                    created=datetime.datetime.utcfromtimestamp(item["time"])))
+        for term in set(tokenize(item.get("message")) + tokenize(item.get("contact"))):
+            termDocIds.setdefault(term, []).append(docId)
+        docId += 1
+
+    terms = termDocIds.keys()
+    for term, searchTerm in zip(terms, ndb.get_multi([ndb.Key(SearchTerm, term) for term in terms])):
+        if not searchTerm:
+            searchTerm = SearchTerm(id=term)
+
+        newDocIds = [termDocId for termDocId in termDocIds[term] if termDocId > searchTerm.lastDoc]
+        if not newDocIds:
+            continue
+
+        if searchTerm.tail:
+            searchTerm.tail += postings.encode(newDocIds, searchTerm.lastDoc)
+        else:
+            searchTerm.tail = postings.encode(newDocIds)
+            searchTerm.tailFirstDoc = newDocIds[0]
+        searchTerm.lastDoc = newDocIds[-1]
+        searchTerm.docCount += len(newDocIds)
+
+        if len(searchTerm.tail) >= CHUNK_SIZE:
+            chunkKey = searchTerm.getChunkKey(len(searchTerm.chunkFirstDocs))
+            toPut.append(PostingChunk(key=chunkKey, data=searchTerm.tail))
+            searchTerm.chunkFirstDocs.append(searchTerm.tailFirstDoc)
+            searchTerm.tail = ""
+            searchTerm.tailFirstDoc = 0
+
+        toPut.append(searchTerm)
+
+    ndb.put_multi(toPut)
+
+    state.nextDocId = docId
+    state.put()
+
+class _PostingReader:
+    """ Reads ranges of one term's postings, fetching each chunk at most once.
+    """
+    def __init__(self, searchTerm):
+        self._searchTerm = searchTerm
+        # Maps chunk number to its decoded ids; the tail is chunk None.
+        self._chunks = {}
+
+    def getFirstDoc(self):
+        return (self._searchTerm.chunkFirstDocs or [self._searchTerm.tailFirstDoc])[0]
+
+    def getRanges(self):
+        """ Returns (chunk, low, high) for each chunk and the tail, newest first. """
+        searchTerm = self._searchTerm
+        answer = []
+        if searchTerm.tail:
+            answer.append((None, searchTerm.tailFirstDoc, searchTerm.lastDoc))
+        nextFirstDoc = searchTerm.tailFirstDoc or (searchTerm.lastDoc + 1)
+        for chunk in range(len(searchTerm.chunkFirstDocs) - 1, -1, -1):
+            answer.append((chunk, searchTerm.chunkFirstDocs[chunk], nextFirstDoc - 1))
+            nextFirstDoc = searchTerm.chunkFirstDocs[chunk]
+        return answer
+
+    def read(self, low, high):
+        """ Returns the ids from low to high. """
+        ranges = [(chunk, chunkLow, chunkHigh) for chunk, chunkLow, chunkHigh in self.getRanges()
+                  if chunkLow <= high and chunkHigh >= low]
+
+        missing = [chunk for chunk, chunkLow, chunkHigh in ranges if not chunk in self._chunks]
+        if None in missing:
+            missing.remove(None)
+            self._chunks[None] = postings.decode(self._searchTerm.tail)
+        chunkKeys = [self._searchTerm.getChunkKey(chunk) for chunk in missing]
+        for chunk, chunkEntity in zip(missing, ndb.get_multi(chunkKeys)):
+            self._chunks[chunk] = postings.decode(chunkEntity.data) if chunkEntity else []
+
+        answer = []
+        for chunk, chunkLow, chunkHigh in reversed(ranges):
+            docIds = self._chunks[chunk]
+            answer.extend(docIds[bisect.bisect_left(docIds, low):bisect.bisect_right(docIds, high)])
+        return answer
+
+def parseQuery(query):
+    """ Returns (terms, phrases) for a search query.
+
+    'terms' are all the terms a message needs to match.  'phrases' are lists
+    of terms which have to appear together, from quoted strings in the query,
+    or from words like "don't" which are more than one term.
+    """
+    terms = []
+    phrases = []
+    for quoted, word in _queryRegex.findall(query or ""):
+        phraseTerms = tokenize(quoted or word)
+        if len(phraseTerms) > 1:
+            phrases.append(phraseTerms)
+        for term in phraseTerms:
+            if not term in terms:
+                terms.append(term)
+    return terms, phrases
+
+def _containsPhrase(terms, phrase):
+    length = len(phrase)
+    for start in range(0, len(terms) - length + 1):
+        if terms[start:start + length] == phrase:
+            return True
+    return False
+
+def _matchesPhrases(document, phrases):
+    messageTerms = tokenize(document.message)
+    contactTerms = tokenize(document.contact)
+    for phrase in phrases:
+        if not (_containsPhrase(messageTerms, phrase) or _containsPhrase(contactTerms, phrase)):
+            return False
+    return True
+
+def search(query, before=None, limit=20):
+    """ Find messages matching 'query', newest first.
+
+    Every word in the query has to be in the message or its contact's name,
+    and quoted phrases have to appear exactly.  Returns (documents, cursor);
+    pass cursor as 'before' to get the next page.  cursor is None once
+    there are no more results.
+    """
+    terms, phrases = parseQuery(query)
+    if not terms:
+        return [], None
+
+    searchTerms = ndb.get_multi([ndb.Key(SearchTerm, term) for term in terms])
+    if None in searchTerms:
+        return [], None
+
+    # Work back from the newest postings of the rarest term, one chunk at a
+    # time, and only look for the other terms within the ids it matches.
+    # Older chunks are never fetched if the newer ones have enough results.
+    searchTerms.sort(key=lambda searchTerm: searchTerm.docCount)
+    readers = [_PostingReader(searchTerm) for searchTerm in searchTerms]
+    # Many candidates may not have the phrase, so check more of them at once.
+    batchSize = min(limit * 10, _MAX_PHRASE_BATCH) if phrases else limit
+
+    results = []
+    for chunk, low, high in readers[0].getRanges():
+        if before:
+            high = min(high, before - 1)
+        if low > high:
+            continue
+
+        candidates = readers[0].read(low, high)
+        for reader in readers[1:]:
+            if not candidates:
+                break
+            candidates = postings.intersect(candidates, reader.read(candidates[0], candidates[-1]))
+
+        # Fetch candidates, newest first, and check their phrases.
+        end = len(candidates)
+        while end > 0 and len(results) < limit:
+            start = max(0, end - batchSize)
+            documentKeys = [ndb.Key(SearchDocument, docId) for docId in reversed(candidates[start:end])]
+            end = start
+            for document in ndb.get_multi(documentKeys):
+                if document and _matchesPhrases(document, phrases):
+                    results.append(document)
+                    if len(results) == limit:
+                        break
+
+        if len(results) == limit:
+            break
+
+    cursor = None
+    if len(results) == limit and results[-1].key.id() > readers[0].getFirstDoc():
+        cursor = results[-1].key.id()
+    return results, cursor
@@ -1,9 +1,17 @@
+import calendar
+import time
+
+from google.appengine.api import namespace_manager
 from google.appengine.ext import db
-from google.appengine.api import memcache
+from google.appengine.ext import ndb
 
 from util import phonenumberutils
+from util.prefixindex import PrefixIndex
+from util.bloomfilter import BloomFilter
+from util.generationcache import GenerationCache
+from util import requestcontext
 
-_memcache = memcache.Client()
+import config
 
 def _getObjectByIdString(clazz, idString):
     if isinstance(idString, int):
@@ -15,40 +23,559 @@ def _getObjectByIdString(clazz, idString):
         return clazz.get_by_id(objectId)
     
     else:
-        return clazz.get_by_key_name(idString)
+        return clazz.get_by_id(idString)
+
+class OwnerAccount(db.Model):
+    """An owner of an XmppVoiceMail, used in multi-owner mode.
+
+    OwnerAccounts are always stored in the default namespace, keyed by the
+    owner's normalized phone number.  Everything else belonging to an owner
+    (contacts, presence, the log) is stored in the owner's own namespace.
+    """
+    phoneNumber = db.StringProperty(required=True)
+    jid = db.StringProperty()
+    emailAddress = db.StringProperty()
+    logSize = db.IntegerProperty(default=10, required=True)
+
+    def getNamespace(self):
+        return "owner" + phonenumberutils.stripNumber(self.key().name())
+
+    def toDict(self):
+        return {
+            "id": self.key().name(),
+            "phoneNumber": self.phoneNumber,
+            "jid": self.jid,
+            "emailAddress": self.emailAddress,
+            "logSize": self.logSize
+        }
+
+    @staticmethod
+    def create(phoneNumber, jid, emailAddress, logSize):
+        """ Create or replace the OwnerAccount for the given phone number. """
+        key = db.Key.from_path("OwnerAccount", phonenumberutils.toNormalizedNumber(phoneNumber), namespace="")
+        account = OwnerAccount(key=key,
+            phoneNumber=phoneNumber,
+            jid=jid,
+            emailAddress=emailAddress.lower() if emailAddress else None,
+            logSize=logSize)
+        account.put()
+        return account
+
+    @staticmethod
+    def getAll():
+        return OwnerAccount.all(namespace="")
+
+    @staticmethod
+    def getByPhoneNumber(phoneNumber):
+        normalizedNumber = phonenumberutils.toNormalizedNumber(phoneNumber)
+        return db.get(db.Key.from_path("OwnerAccount", normalizedNumber, namespace=""))
+
+    @staticmethod
+    def getByJid(jid):
+        return OwnerAccount.all(namespace="").filter("jid =", jid).get()
+
+    @staticmethod
+    def getByEmail(emailAddress):
+        return OwnerAccount.all(namespace="").filter("emailAddress =", emailAddress.lower()).get()
+
+class BlockedNumber(db.Model):
+    """A number, or a prefix of numbers, to drop calls and SMS messages from.
+
+    The key name is the pattern: a normalized number like "+16135551234", or
+    a normalized prefix followed by "*", like "+1900*".  All BlockedNumbers
+    share a parent, so reading the whole list is strongly consistent.
+    """
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def _parentKey():
+        return db.Key.from_path("BlockedNumberList", "default")
+
+    def getPattern(self):
+        return self.key().name()
+
+    def toDict(self):
+        return {
+            "id": self.getPattern(),
+            "pattern": self.getPattern()
+        }
+
+    @staticmethod
+    def getAll(keysOnly=False):
+        return BlockedNumber.all(keys_only=keysOnly).ancestor(BlockedNumber._parentKey())
+
+    @staticmethod
+    def getByPattern(pattern):
+        return BlockedNumber.get_by_key_name(pattern, parent=BlockedNumber._parentKey())
+
+    @staticmethod
+    def create(pattern):
+        blockedNumber = BlockedNumber(key_name=pattern, parent=BlockedNumber._parentKey())
+        blockedNumber.put()
+        return blockedNumber
+
+    @staticmethod
+    def normalizePattern(pattern):
+        """ Returns the normalized form of a pattern, or None if it isn't valid. """
+        pattern = pattern.strip()
+        if pattern.endswith("*"):
+            digits = phonenumberutils.stripNumber(pattern[:-1])
+            return ("+" + digits + "*") if digits else None
+        parsedNumber = phonenumberutils.parseNumber(pattern)
+        return parsedNumber[0] if parsedNumber else None
+
+class PendingSms(db.Model):
+    """An outgoing SMS message waiting in the queue to be sent or retried.
+    """
+    ownerNumber = db.StringProperty(required=True)
+    toNumber = db.StringProperty(required=True)
+    body = db.TextProperty(required=True)
+    attempts = db.IntegerProperty(default=0, required=True)
+    lastError = db.TextProperty()
+    created = db.DateTimeProperty(auto_now_add=True)
+
+class DigestItem(ndb.Model):
+    """A message for the owner, waiting to be sent in an email digest.
+
+    'window' is the digest the message belongs in, and fromName and
+    fromAddress are who it would have been emailed from on its own.
+    """
+    window = ndb.IntegerProperty(required=True)
+    fromName = ndb.StringProperty(required=True, indexed=False)
+    fromAddress = ndb.StringProperty(required=True, indexed=False)
+    message = ndb.TextProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class BroadcastList(ndb.Model):
+    """A named group of recipients the owner can send one SMS to all at once.
+
+    The id is the list's name, in lower case.  Each member is a normalized
+    phone number or a contact's name.  Contact names are looked up when a
+    message is sent, so the list follows changes to the contact's number.
+    """
+    members = ndb.StringProperty(repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    def getName(self):
+        return self.key.id()
+
+    def toDict(self):
+        return {
+            "id": self.getName(),
+            "name": self.getName(),
+            "members": self.members
+        }
 
-class XmppUser(db.Model):
+    @staticmethod
+    def getAll():
+        return BroadcastList.query().order(BroadcastList.created).fetch()
+
+    @staticmethod
+    def getByNameAsync(name):
+        return BroadcastList.get_by_id_async(name.lower())
+
+    @staticmethod
+    def getByName(name):
+        return BroadcastList.getByNameAsync(name).get_result()
+
+def _toMillis(dateTime):
+    return calendar.timegm(dateTime.utctimetuple()) * 1000
+
+class Conversation(ndb.Model):
+    """Summary of the messages to and from one phone number.
+
+    Keyed by normalized phone number.  The messages themselves are
+    ConversationMessage children, and this is updated in the same transaction
+    as each one is added, so it never has to be worked out from them.
+    """
+    # Only read in transactions and by the admin API, so not worth the memcache traffic.
+    _use_memcache = False
+
+    name = ndb.StringProperty(indexed=False)
+    lastMessage = ndb.TextProperty()
+    lastDirection = ndb.StringProperty(indexed=False)
+    lastTime = ndb.DateTimeProperty()
+    messageCount = ndb.IntegerProperty(default=0, indexed=False)
+    unreadCount = ndb.IntegerProperty(default=0, indexed=False)
+
+    def toDict(self):
+        return {
+            "id": self.key.id(),
+            "phoneNumber": self.key.id(),
+            "name": self.name,
+            "lastMessage": self.lastMessage,
+            "lastDirection": self.lastDirection,
+            "lastTime": _toMillis(self.lastTime),
+            "messageCount": self.messageCount,
+            "unreadCount": self.unreadCount
+        }
+
+class ConversationMessage(ndb.Model):
+    """A message to or from the owner, in a Conversation.
+    """
+    _use_memcache = False
+
+    direction = ndb.StringProperty(required=True, indexed=False)
+    message = ndb.TextProperty(required=True)
+    created = ndb.DateTimeProperty(required=True)
+
+    def toDict(self):
+        return {
+            "time": _toMillis(self.created),
+            "direction": self.direction,
+            "message": self.message
+        }
+
+class SearchDocument(ndb.Model):
+    """A logged message, as stored for search.
+
+    Keyed by document id; the indexer hands these out in order.
+    """
+    _use_memcache = False
+
+    contact = ndb.StringProperty(indexed=False)
+    direction = ndb.StringProperty(indexed=False)
+    message = ndb.TextProperty()
+    created = ndb.DateTimeProperty(indexed=False)
+
+    def toDict(self):
+        return {
+            "id": self.key.id(),
+            "time": _toMillis(self.created),
+            "direction": self.direction,
+            "contact": self.contact,
+            "message": self.message
+        }
+
+class SearchTerm(ndb.Model):
+    """The posting list for one term in the search index, keyed by the term.
+
+    New postings (see util.postings) are added to 'tail'.  When the tail gets
+    big enough it's moved into a PostingChunk, so no entity grows without
+    limit.  chunkFirstDocs has the first document id in each chunk, so a
+    search only fetches the chunks which cover the ids it's interested in.
+    """
+    _use_memcache = False
+
+    docCount = ndb.IntegerProperty(default=0, indexed=False)
+    lastDoc = ndb.IntegerProperty(default=0, indexed=False)
+    chunkFirstDocs = ndb.IntegerProperty(repeated=True, indexed=False)
+    tail = ndb.BlobProperty(default="")
+    tailFirstDoc = ndb.IntegerProperty(default=0, indexed=False)
+
+    def getChunkKey(self, chunk):
+        return ndb.Key(PostingChunk, self.key.id() + ":" + str(chunk))
+
+class PostingChunk(ndb.Model):
+    """A full chunk of postings for a SearchTerm.
+    """
+    _use_memcache = False
+
+    data = ndb.BlobProperty(required=True)
+
+class SearchIndexState(ndb.Model):
+    """The next document id to hand out; there's one per namespace.
+    """
+    nextDocId = ndb.IntegerProperty(default=1, indexed=False)
+
+class TrafficRollup(ndb.Model):
+    """Message counts for one hour, written by the instances using one shard.
+
+    Keyed by "<hour>:<shard>", where hour is hours since the epoch.  'counts'
+    maps "direction|channel|contact" to the number of messages.  Readers add
+    up every shard for an hour.
+    """
+    _use_memcache = False
+
+    hour = ndb.IntegerProperty(required=True)
+    counts = ndb.JsonProperty()
+
+class XmppUser(ndb.Model):
     """Tracks presence of user.
+
+    Users are stored with their jid as the key name.  Users stored before that
+    have generated ids, and are found by querying on jid.
     """
-    jid = db.StringProperty(required=True)
-    presence = db.BooleanProperty(required=True)
+    jid = ndb.StringProperty(required=True)
+    presence = ndb.BooleanProperty(required=True)
+
+    @staticmethod
+    @ndb.tasklet
+    def getByJidAsync(jid):
+        user = yield XmppUser.get_by_id_async(jid)
+        if not user:
+            user = yield XmppUser.query(XmppUser.jid == jid).get_async()
+        raise ndb.Return(user)
 
     @staticmethod
     def getByJid(jid):
-        q = db.GqlQuery("SELECT * FROM XmppUser WHERE jid = :1", jid)
-        return q.get()
+        return XmppUser.getByJidAsync(jid).get_result()
 
-_DEFAULT_SENDER_MEMCACHE_KEY = 'Contact:DEFAULT_SENDER'
-_CONTACT_BY_NUMBER_MEMCACHE_KEY = 'Contact:Number:'
-_CONTACT_BY_NAME_MEMCACHE_KEY = 'Contact:Name:'
+class ContactNameIndex(ndb.Model):
+    """Points from a lowercase contact name, stored as the key name, to the contact with that name.
+    """
+    contact = ndb.KeyProperty(indexed=False)
+
+    @staticmethod
+    def getValue(contact):
+        return contact.name.lower()
 
-class Contact(db.Model):
+class ContactNumberIndex(ndb.Model):
+    """Points from a normalized phone number, stored as the key name, to the contact with that number.
+    """
+    contact = ndb.KeyProperty(indexed=False)
+
+    @staticmethod
+    def getValue(contact):
+        return contact.normalizedPhoneNumber
+
+class ContactIndexState(ndb.Model):
+    """Records whether every contact in a namespace has its index entities.
+
+    Stored with the key name "state".  Until it's set, a name or number with
+    no index entity could still belong to a contact stored before there were
+    index entities, so has to be looked for with a query.  contactmigration
+    sets it once it has indexed every old contact.
+    """
+    migrated = ndb.BooleanProperty(default=False, indexed=False)
+
+    @staticmethod
+    @ndb.tasklet
+    def isMigratedAsync():
+        namespace = namespace_manager.get_namespace()
+        if namespace in _migratedNamespaces:
+            raise ndb.Return(True)
+        now = time.time()
+        if now - _unmigratedNamespaces.get(namespace, 0) < _CONTACT_INDEX_STATE_CHECK_INTERVAL:
+            raise ndb.Return(False)
+        state = yield ContactIndexState.get_by_id_async(_CONTACT_INDEX_STATE_ID)
+        if state and state.migrated:
+            _migratedNamespaces.add(namespace)
+            raise ndb.Return(True)
+        _unmigratedNamespaces[namespace] = now
+        raise ndb.Return(False)
+
+    @staticmethod
+    def isMigrated():
+        return ContactIndexState.isMigratedAsync().get_result()
+
+    @staticmethod
+    def markMigrated():
+        ContactIndexState(id=_CONTACT_INDEX_STATE_ID, migrated=True).put()
+        _migratedNamespaces.add(namespace_manager.get_namespace())
+        _unmigratedNamespaces.pop(namespace_manager.get_namespace(), None)
+
+class ContactExistsException(Exception):
+    """ Thrown when saving a contact whose name or number belongs to another contact.
+
+    'contact' is the other contact, and 'propertyName' is "name" or "phoneNumber".
+    """
+    def __init__(self, contact, propertyName):
+        super(ContactExistsException, self).__init__(
+            "Contact " + contact.name + " already has that " + propertyName)
+        self.contact = contact
+        self.propertyName = propertyName
+
+_DEFAULT_SENDER_ID = 'DEFAULT_SENDER'
+_CONTACT_INDEX_STATE_ID = 'state'
+_CONTACT_NOT_FOUND_MEMCACHE_KEY = 'Contact:NotFound:'
+_CONTACT_GENERATION_MEMCACHE_KEY = 'Contact:GENERATION'
+_CONTACT_NUMBER_FILTER_MEMCACHE_KEY = 'Contact:NumberFilter:'
+
+# How long to remember that a name or number has no contact, in seconds.
+_CONTACT_NOT_FOUND_CACHE_TIME = 60
+
+# After a contact is created, how long to stop readers from remembering that
+# its name or number has no contact, in case they looked before it was
+# created.  In seconds.
+_CONTACT_NOT_FOUND_LOCK_TIME = 10
+
+# Queries can miss contacts stored in the last few seconds, so a number filter
+# built from one isn't trusted to rule numbers out for this many seconds.
+_NUMBER_FILTER_SETTLE_TIME = 10
+
+# Namespaces where every contact is known to have its index entities.  Once
+# set, ContactIndexState.migrated is never cleared, so this never goes stale.
+_migratedNamespaces = set()
+
+# Maps namespaces which weren't migrated to when we last checked, so misses
+# don't read ContactIndexState every time.  How long to trust that, in seconds.
+_unmigratedNamespaces = {}
+_CONTACT_INDEX_STATE_CHECK_INTERVAL = 60
+
+@ndb.tasklet
+def _getIndexedContactAsync(index):
+    """ Returns the contact 'index' points at, or None if that contact no longer has the indexed name or number. """
+    contact = yield index.contact.get_async()
+    if contact and index.getValue(contact) == index.key.id():
+        raise ndb.Return(contact)
+    raise ndb.Return(None)
+
+def _reversedDigits(phoneNumber):
+    return phonenumberutils.stripNumber(phoneNumber)[::-1]
+
+class _ContactSearchIndex:
+    """ In-memory search index over all the contacts in one namespace.
+
+    Contacts can be found by a prefix of their name, or by the trailing digits
+    of their phone number (stored reversed, so a suffix search becomes a
+    prefix search.)
+    """
+
+    def __init__(self, contacts):
+        self._contacts = {}
+        nameEntries = []
+        numberEntries = []
+        for contact in contacts:
+            summary = contact.toDict()
+            self._contacts[summary['id']] = summary
+            nameEntries.append((contact.name.lower(), summary['id']))
+            numberEntries.append((_reversedDigits(contact.normalizedPhoneNumber), summary['id']))
+        self._names = PrefixIndex(nameEntries)
+        self._numbers = PrefixIndex(numberEntries)
+
+    def add(self, contact):
+        summary = contact.toDict()
+        self._contacts[summary['id']] = summary
+        self._names.add(contact.name.lower(), summary['id'])
+        self._numbers.add(_reversedDigits(contact.normalizedPhoneNumber), summary['id'])
+
+    def remove(self, contact):
+        contactId = contact.key.id()
+        self._names.remove(contact.name.lower(), contactId)
+        self._numbers.remove(_reversedDigits(contact.normalizedPhoneNumber), contactId)
+        self._contacts.pop(contactId, None)
+
+    def search(self, query, limit):
+        query = query.strip().lower()
+        ids = self._names.search(query, limit)
+
+        # Only search numbers if this looks like a number.
+        digits = phonenumberutils.stripNumber(query)
+        if digits and not any(c.isalpha() for c in query):
+            ids += self._numbers.search(digits[::-1], limit)
+
+        answer = []
+        seen = set()
+        for contactId in ids:
+            summary = self._contacts.get(contactId)
+            if summary and contactId not in seen:
+                seen.add(contactId)
+                answer.append(summary)
+                if len(answer) >= limit:
+                    break
+        return answer
+
+def _buildContactIndex(generation):
+    contacts = Contact.query(Contact.key != ndb.Key(Contact, _DEFAULT_SENDER_ID))
+    return _ContactSearchIndex(contacts)
+
+class _NumberFilter:
+    """ A BloomFilter of every contact's normalized number.
+
+    The filter is built from a query, which is only eventually consistent, so
+    it can leave out a contact stored just before.  Until settleTime,
+    excludes() doesn't rule any number out; after that, the filter is rebuilt
+    once, from a query which sees everything stored before this generation.
+    """
+
+    def __init__(self, filterKey):
+        # The memcache key for the generation this filter is up to date with.
+        self.filterKey = filterKey
+        # Numbers added since the filter was built, to keep if it's rebuilt.
+        self._added = []
+        self._build()
+
+    def _build(self):
+        query = Contact.query(projection=[Contact.normalizedPhoneNumber])
+        numbers = [contact.normalizedPhoneNumber for contact in query] + self._added
+
+        # Leave room for contacts added later, since we update the filter in place.
+        bloomFilter = BloomFilter(max(len(numbers) * 2, 1000))
+        for number in numbers:
+            bloomFilter.add(number)
+        self._bloomFilter = bloomFilter
+        self.settleTime = time.time() + _NUMBER_FILTER_SETTLE_TIME
+
+    def add(self, number):
+        self._added.append(number)
+        self._bloomFilter.add(number)
+
+    def excludes(self, number):
+        """ Returns True if 'number' is definitely not a contact's number. """
+        if number in self._bloomFilter:
+            return False
+        if self.settleTime:
+            if time.time() < self.settleTime:
+                return False
+            self._build()
+            self.settleTime = None
+            requestcontext.get().memcache.set(self.filterKey, self)
+            return number not in self._bloomFilter
+        return True
+
+def _buildNumberFilter(generation):
+    """ Builds the _NumberFilter for 'generation'.
+
+    The filter is shared with other instances through memcache, so only one
+    instance needs to read every contact for each generation.
+    """
+    filterKey = _CONTACT_NUMBER_FILTER_MEMCACHE_KEY + str(generation)
+    client = requestcontext.get().memcache
+    numberFilter = client.get(filterKey)
+    if numberFilter is None:
+        numberFilter = _NumberFilter(filterKey)
+        client.add(filterKey, numberFilter)
+    return numberFilter
+
+_contactIndexes = GenerationCache(_CONTACT_GENERATION_MEMCACHE_KEY, _buildContactIndex)
+_numberFilters = GenerationCache(_CONTACT_GENERATION_MEMCACHE_KEY, _buildNumberFilter)
+
+def _contactChanged(oldContact, newContact):
+    """ Update cached contact data after a contact is created, updated, or deleted. """
+    def updateIndex(index, generation):
+        if oldContact:
+            index.remove(oldContact)
+        if newContact:
+            index.add(newContact)
+
+    def updateNumberFilter(numberFilter, generation):
+        # Numbers can't be removed from a BloomFilter, but a stale number just
+        # costs a datastore lookup.
+        if newContact:
+            numberFilter.add(newContact.normalizedPhoneNumber)
+        numberFilter.filterKey = _CONTACT_NUMBER_FILTER_MEMCACHE_KEY + str(generation)
+        requestcontext.get().memcache.set(numberFilter.filterKey, numberFilter)
+
+    generation = _contactIndexes.incrementGeneration()
+    _contactIndexes.changed(generation, updateIndex)
+    _numberFilters.changed(generation, updateNumberFilter)
+
+class Contact(ndb.Model):
     """Stores information about a contact.
+
+    Contacts are found by name and by number through ContactNameIndex and
+    ContactNumberIndex entities, so lookups are gets which ndb can cache.
+    The index entities are written in the same transaction as the contact,
+    which is what stops two contacts having the same name or number.
+    Contacts stored before the index entities existed are found by querying
+    (and their index entities written then) until contactmigration has
+    indexed them all.
     """
-    name = db.StringProperty(required=True)
+    name = ndb.StringProperty(required=True)
     """
     Storing phoneNumber and normalizedPhoneNumber violates the DRY principle,
     but there's no way to recover an E.164 number's formatting from the
     normalized number, and it's easier to search by normalized number, so
     here we are.
     """
-    phoneNumber = db.StringProperty(required=True)
-    normalizedPhoneNumber = db.StringProperty(required=True)
-    subscribed = db.BooleanProperty(default=False, required=True)
+    phoneNumber = ndb.StringProperty(required=True)
+    normalizedPhoneNumber = ndb.StringProperty(required=True)
+    subscribed = ndb.BooleanProperty(default=False, required=True)
     
     def toDict(self):
         return {
-            "id": self.key().id_or_name(),
+            "id": self.key.id(),
             "name": self.name,
             "phoneNumber": self.phoneNumber,
             "subscribed": self.subscribed,
@@ -56,16 +583,79 @@ class Contact(db.Model):
         }
         
     def isDefaultSender(self):
-        return self.key().id_or_name() == "DEFAULT_SENDER"
-    
-    def _addToMemcache(self):
-        _memcache.set(_CONTACT_BY_NUMBER_MEMCACHE_KEY + self.normalizedPhoneNumber, self)
-        _memcache.set(_CONTACT_BY_NAME_MEMCACHE_KEY + self.name.lower(), self)
+        return self.key is not None and self.key.id() == _DEFAULT_SENDER_ID
+
+    @classmethod
+    def _post_get_hook(cls, key, future):
+        contact = future.get_result()
+        # A contact from the context cache already knows its stored values,
+        # and may have been changed since.
+        if contact and not hasattr(contact, "_storedName"):
+            contact._rememberStoredValues()
+
+    def _rememberStoredValues(self):
+        """ Remember the name and number this contact has in the datastore.
+
+        Lets update() skip the transaction when neither has changed.
+        Contacts from queries don't know them, and always take the
+        transaction.
+        """
+        self._storedName = self.name
+        self._storedNumber = self.normalizedPhoneNumber
+
+    def _getIndexes(self):
+        return [indexClass(id=indexClass.getValue(self), contact=self.key)
+                for indexClass in (ContactNameIndex, ContactNumberIndex)]
+
+    def _getIndexKeys(self):
+        return [index.key for index in self._getIndexes()]
+
+    @ndb.tasklet
+    def addMissingIndexesAsync(self):
+        """ Write whichever of this contact's index entities don't exist yet.
+
+        An index entity which points at another contact that still has the
+        same name or number is left alone.  Returns the index entities which
+        belong to other contacts.
+        """
+        @ndb.tasklet
+        def txn(index):
+            stored = yield index.key.get_async()
+            if stored and stored.contact != self.key:
+                holder = yield _getIndexedContactAsync(stored)
+                if holder:
+                    raise ndb.Return(False)
+            if not stored or stored.contact != self.key:
+                yield index.put_async()
+            raise ndb.Return(True)
+
+        indexes = self._getIndexes()
+        stored = yield ndb.get_multi_async([index.key for index in indexes])
+        missing = [index for index, storedIndex in zip(indexes, stored)
+                   if not storedIndex or storedIndex.contact != self.key]
+        added = yield [ndb.transaction_async(lambda index=index: txn(index), xg=True) for index in missing]
+        raise ndb.Return([index for index, ok in zip(missing, added) if not ok])
+
+    def delete(self):
+        """ Delete this contact from the datastore, and the search index. """
+        @ndb.transactional(xg=True)
+        def txn():
+            # Leave alone index entities which belong to another contact.
+            indexes = ndb.get_multi(self._getIndexKeys(), use_cache=False, use_memcache=False)
+            ndb.delete_multi([self.key] + [index.key for index in indexes if index and index.contact == self.key])
+        txn()
+        _contactChanged(self, None)
+
+    @staticmethod
+    def search(query, limit=20):
+        """ Find contacts by name or number.
+
+        Returns a list of contacts (as dicts, as returned by toDict()) whose
+        name starts with 'query', or whose phone number ends in the digits in
+        'query'.  The default sender is never returned.
+        """
+        return _contactIndexes.get().search(query, limit)
 
-    def _removeFromMemcache(self):
-        _memcache.delete(_CONTACT_BY_NUMBER_MEMCACHE_KEY + self.normalizedPhoneNumber)
-        _memcache.delete(_CONTACT_BY_NAME_MEMCACHE_KEY + self.name.lower())
-    
     @staticmethod
     def getByIdString(idString):
         """
@@ -75,76 +665,163 @@ class Contact(db.Model):
         as a key name.
         """
         return _getObjectByIdString(Contact, idString)
-    
+
     @staticmethod
-    def getByPhoneNumber(phoneNumber):
+    @ndb.tasklet
+    def _getByIndexAsync(indexClass, propertyName, value):
+        """ Find the contact whose 'propertyName' is 'value', using indexClass. """
+        ctx = ndb.get_context()
+        notFoundKey = _CONTACT_NOT_FOUND_MEMCACHE_KEY + indexClass.__name__ + ":" + value
+
+        index = yield indexClass.get_by_id_async(value)
+        if index:
+            contact = yield _getIndexedContactAsync(index)
+            if contact:
+                raise ndb.Return(contact)
+        migrated = yield ContactIndexState.isMigratedAsync()
+        if migrated:
+            # Every contact has index entities, so there's no such contact.
+            raise ndb.Return(None)
+        if not index:
+            notFound = yield ctx.memcache_get(notFoundKey)
+            if notFound:
+                raise ndb.Return(None)
+
+        # Contacts stored before there were index entities can only be found by querying.
+        contact = yield Contact.query(Contact._properties[propertyName] == value).get_async()
+        if contact:
+            yield contact.addMissingIndexesAsync()
+        else:
+            # Remember that there's no contact, so we don't query again for
+            # every message from a stranger.
+            yield ctx.memcache_add(notFoundKey, True, time=_CONTACT_NOT_FOUND_CACHE_TIME)
+        raise ndb.Return(contact)
+
+    @staticmethod
+    def getByPhoneNumberAsync(phoneNumber):
         normalizedNumber = phonenumberutils.toNormalizedNumber(phoneNumber)
 
-        # First try to get from memcache
-        answer = _memcache.get(_CONTACT_BY_NUMBER_MEMCACHE_KEY + normalizedNumber)
+        if getattr(config, "CONTACT_NUMBER_FILTER", False) and \
+           _numberFilters.get().excludes(normalizedNumber):
+            # Definitely not a contact; don't bother asking the DB.
+            future = ndb.Future()
+            future.set_result(None)
+            return future
+
+        return Contact._getByIndexAsync(ContactNumberIndex, "normalizedPhoneNumber", normalizedNumber)
+
+    @staticmethod
+    def getByPhoneNumber(phoneNumber):
+        return Contact.getByPhoneNumberAsync(phoneNumber).get_result()
+
+    @staticmethod
+    def getByNameAsync(name):
+        return Contact._getByIndexAsync(ContactNameIndex, "name", name.lower())
 
-        if not answer:
-            # Fall back to the DB
-            q = db.GqlQuery("SELECT * FROM Contact WHERE normalizedPhoneNumber = :1", normalizedNumber)
-            answer = q.get()
-            if answer:
-                answer._addToMemcache()
-                
-        return answer
-        
     @staticmethod
     def getByName(name):
-        # First try to get from memcache
-        answer = _memcache.get(_CONTACT_BY_NAME_MEMCACHE_KEY + name.lower())
-        
-        if not answer:
-            # Fall back to the DB
-            q = db.GqlQuery("SELECT * FROM Contact WHERE name = :1", name.lower())
-            answer = q.get()
-            if answer:
-                answer._addToMemcache()
-                
-        return answer
-    
+        return Contact.getByNameAsync(name).get_result()
+
     @staticmethod
     def update(contact):
-        """ Update or create a Contact in the datastore. """
-        if contact.is_saved() and contact.isDefaultSender():
-            _memcache.set(key=_DEFAULT_SENDER_MEMCACHE_KEY, value=contact)
+        """ Update or create a Contact in the datastore.
+
+        Raises ContactExistsException if another contact has the same name or number.
+        """
+        if contact.key and contact.isDefaultSender():
             # Update the contact in the DB
             contact.put()
-                    
-        else:
-            # Fetch the old contact from the DB
-            oldContact = None
-            if contact.is_saved():
-                oldContact = Contact.get(contact.key())
-            
-            # Update the contact in the DB
-            contact.normalizedPhoneNumber = phonenumberutils.toNormalizedNumber(contact.phoneNumber) 
+            return
+
+        contact.normalizedPhoneNumber = phonenumberutils.toNormalizedNumber(contact.phoneNumber)
+
+        # If the name and number haven't changed since we read the contact,
+        # neither have its index entities.
+        storedName = getattr(contact, "_storedName", None)
+        storedNumber = getattr(contact, "_storedNumber", None)
+        if contact.key and (storedName == contact.name) and (storedNumber == contact.normalizedPhoneNumber):
             contact.put()
-            
-            # Remove the old contact from memcache
-            if oldContact:
-                oldContact._removeFromMemcache()
-                
-            # Put the new contact into memcache
-            contact._addToMemcache()
-            
-            
-    
+            _contactChanged(contact, contact)
+            return
+
+        if not ContactIndexState.isMigrated():
+            # Make sure any old contacts with this name or number have index
+            # entities, so the transaction below will see them.
+            ndb.Future.wait_all([
+                Contact._getByIndexAsync(ContactNameIndex, "name", contact.name.lower()),
+                Contact._getByIndexAsync(ContactNumberIndex, "normalizedPhoneNumber", contact.normalizedPhoneNumber)])
+
+        if not contact.key:
+            # Allocate the ID up front, so the index entities can point at it.
+            start, end = Contact.allocate_ids(1)
+            contact.key = ndb.Key(Contact, start)
+            storedKey = None
+        else:
+            storedKey = contact.key
+
+        @ndb.transactional(xg=True)
+        def txn():
+            # Someone else may have changed the stored contact, so ask the DB
+            # which index entities point at it.
+            newIndexes = contact._getIndexes()
+            keys = [index.key for index in newIndexes]
+            if storedKey:
+                keys.append(storedKey)
+            stored = ndb.get_multi(keys, use_cache=False, use_memcache=False)
+
+            for index, propertyName in zip(stored[:len(newIndexes)], ("name", "phoneNumber")):
+                if index and index.contact != contact.key:
+                    holder = _getIndexedContactAsync(index).get_result()
+                    if holder:
+                        raise ContactExistsException(holder, propertyName)
+
+            storedContact = stored[len(newIndexes)] if storedKey else None
+            oldIndexKeys = storedContact._getIndexKeys() if storedContact else []
+            ndb.put_multi([contact] + newIndexes)
+            ndb.delete_multi([key for key in oldIndexKeys if not key in keys])
+            return storedContact
+
+        storedContact = txn()
+        contact._rememberStoredValues()
+
+        # Readers may have remembered there was no contact with the new name or number.
+        ctx = ndb.get_context()
+        futures = [ctx.memcache_delete(_CONTACT_NOT_FOUND_MEMCACHE_KEY + key.kind() + ":" + key.id(),
+                                       seconds=_CONTACT_NOT_FOUND_LOCK_TIME)
+                   for key in contact._getIndexKeys()]
+        ndb.Future.wait_all(futures)
+
+        _contactChanged(storedContact, contact)
+
+    @staticmethod
+    @ndb.tasklet
+    def getDefaultSenderAsync():
+        """ Returns the contact used to talk to xmppVoiceMail itself, creating it if required. """
+        key = ndb.Key(Contact, _DEFAULT_SENDER_ID)
+        contact = yield key.get_async()
+        if contact:
+            raise ndb.Return(contact)
+
+        # If there are no contacts yet, there are none without index entities.
+        anyContact = yield Contact.query().get_async(keys_only=True)
+
+        @ndb.tasklet
+        def txn():
+            contact = yield key.get_async()
+            if not contact:
+                contact = Contact(key=key,
+                    name="xmppVoiceMail".lower(),
+                    phoneNumber="*",
+                    normalizedPhoneNumber="*")
+                toPut = [contact] + contact._getIndexes()
+                if not anyContact:
+                    toPut.append(ContactIndexState(id=_CONTACT_INDEX_STATE_ID, migrated=True))
+                yield ndb.put_multi_async(toPut)
+            raise ndb.Return(contact)
+
+        contact = yield ndb.transaction_async(txn, xg=True)
+        raise ndb.Return(contact)
+
     @staticmethod
     def getDefaultSender():
-        # TODO: Think about using some caching here, since we get this guy
-        # all the time.
-        defaultSender = _memcache.get(_DEFAULT_SENDER_MEMCACHE_KEY)
-        if defaultSender is not None:
-            return defaultSender
-        else:
-            defaultSender = Contact.get_or_insert("DEFAULT_SENDER",
-                name="xmppVoiceMail".lower(),
-                phoneNumber="*",
-                normalizedPhoneNumber="*")
-            _memcache.add(key=_DEFAULT_SENDER_MEMCACHE_KEY, value=defaultSender)
-            return defaultSender
-        
+        return Contact.getDefaultSenderAsync().get_result()
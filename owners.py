@@ -0,0 +1,104 @@
+import collections
+import email.utils
+import threading
+import time
+
+from util.phonenumberutils import toNormalizedNumber
+from xmppvoicemail import XmppVoiceMail, Owner
+from models import OwnerAccount
+
+# How long to cache an owner in-process before re-reading it, in seconds.
+_OWNER_CACHE_TIME = 300
+
+# How long to remember that there's no owner for a number, JID or address.
+# Owners added on another instance can't clear our cache, so this is short.
+_MISSING_OWNER_CACHE_TIME = 5
+
+class OwnerRegistry:
+    """ Finds the XmppVoiceMail which should handle a request.
+
+    In single-owner mode, every request is handled by the default owner from
+    config.py.  In multi-owner mode, additional owners are stored as
+    OwnerAccount entities, and each owner's contacts, presence and log live in
+    the owner's own namespace.
+
+    XmppVoiceMail objects are cached in-process, so once an owner has been
+    seen, finding the owner for a request is a dictionary lookup no matter
+    how many owners there are.
+    """
+
+    def __init__(self, defaultOwner, multiOwner=False, cacheSize=1000):
+        self._default = XmppVoiceMail(defaultOwner)
+        self._defaultNumber = toNormalizedNumber(defaultOwner.phoneNumber)
+        self._multiOwner = multiOwner
+        self._cacheSize = cacheSize
+        self._lock = threading.Lock()
+        # Maps (lookupType, value) to (expiryTime, XmppVoiceMail or None).
+        self._cache = collections.OrderedDict()
+
+    def isMultiOwner(self):
+        return self._multiOwner
+
+    def getDefault(self):
+        return self._default
+
+    def _lookup(self, cacheKey, loader):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.pop(cacheKey, None)
+            if entry and entry[0] > now:
+                # Re-insert to mark this as most recently used.
+                self._cache[cacheKey] = entry
+                return entry[1]
+
+        voiceMail = None
+        account = loader()
+        if account:
+            owner = Owner(account.phoneNumber, account.jid, account.emailAddress,
+                          account.logSize, account.getNamespace())
+            voiceMail = XmppVoiceMail(owner)
+
+        with self._lock:
+            cacheTime = _OWNER_CACHE_TIME if voiceMail else _MISSING_OWNER_CACHE_TIME
+            self._cache[cacheKey] = (now + cacheTime, voiceMail)
+            while len(self._cache) > self._cacheSize:
+                self._cache.popitem(last=False)
+
+        return voiceMail
+
+    def clear(self):
+        """ Drop all cached owners, so they will be re-read from the datastore. """
+        with self._lock:
+            self._cache.clear()
+
+    def getByPhoneNumber(self, phoneNumber):
+        """ Returns the XmppVoiceMail for the given Twilio number, or None. """
+        if not self._multiOwner:
+            return self._default
+
+        normalizedNumber = toNormalizedNumber(phoneNumber or "")
+        if normalizedNumber == self._defaultNumber:
+            return self._default
+
+        return self._lookup(("number", normalizedNumber),
+                            lambda: OwnerAccount.getByPhoneNumber(normalizedNumber))
+
+    def getByJid(self, jid):
+        """ Returns the XmppVoiceMail for the owner with the given JID, or None. """
+        if (not self._multiOwner) or (jid == self._default.getOwner().jid):
+            return self._default
+
+        return self._lookup(("jid", jid), lambda: OwnerAccount.getByJid(jid))
+
+    def getByEmail(self, sender):
+        """ Returns the XmppVoiceMail for the owner with the given email address, or None.
+
+        'sender' may include a display name, as in '"Name" <user@domain.com>'.
+        """
+        emailAddress = email.utils.parseaddr(sender)[1].lower()
+        defaultOwner = self._default.getOwner()
+        if (not self._multiOwner) or \
+           (defaultOwner.emailEnabled() and emailAddress == defaultOwner.emailAddress.lower()):
+            return self._default
+
+        return self._lookup(("email", emailAddress), lambda: OwnerAccount.getByEmail(emailAddress))
@@ -0,0 +1,203 @@
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import re
+import threading
+
+from google.appengine.api import app_identity
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+
+try:
+    import cloudstorage
+except ImportError:
+    cloudstorage = None
+
+import config
+
+# URL recordings are served from; followed by the recording SID and a signature.
+RECORDING_URL = "/recordings"
+
+# URL of the task which copies a new recording from Twilio.
+FETCH_RECORDING_TASK_URL = "/tasks/fetchRecording"
+
+# Recordings never change, so browsers can keep them as long as they like.
+CACHE_CONTROL = "private, max-age=31536000"
+
+_TWILIO_RECORDING_URL = "https://api.twilio.com/2010-04-01/Accounts/%s/Recordings/%s.mp3"
+_CONTENT_TYPE = "audio/mpeg"
+
+_recordingUrlRegex = re.compile(r"/Recordings/(RE[0-9a-zA-Z]+)(\.\w+)?$")
+_recordingSidRegex = re.compile(r"^RE[0-9a-zA-Z]+$")
+_rangeRegex = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class RecordingNotFoundException(Exception):
+    """ Thrown when a recording isn't stored, and can't be fetched from Twilio.
+    """
+    pass
+
+def getRecordingSid(recordingUrl):
+    """ Returns the SID of the recording at Twilio's recordingUrl, or None if it isn't a recording URL. """
+    match = _recordingUrlRegex.search(recordingUrl or "")
+    if not match:
+        return None
+    return match.group(1)
+
+def sign(recordingSid):
+    """ Returns the signature which lets someone listen to recordingSid. """
+    digest = hmac.new(config.SESSION_SECRET_KEY, recordingSid, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest)[:22]
+
+def checkSignature(recordingSid, signature):
+    """ Returns True if signature was created by sign(recordingSid). """
+    return bool(_recordingSidRegex.match(recordingSid)) and \
+        hmac.compare_digest(sign(recordingSid), str(signature or ""))
+
+def getProxyUrl(hostUrl, recordingUrl):
+    """ Returns the URL to serve Twilio's recordingUrl from this app.
+
+    Returns recordingUrl if it isn't a recording we know how to proxy.
+    """
+    recordingSid = getRecordingSid(recordingUrl)
+    if not recordingSid:
+        return recordingUrl
+    return hostUrl + RECORDING_URL + "/" + recordingSid + ".mp3?sig=" + sign(recordingSid)
+
+def queueFetch(recordingSid):
+    """ Copy a recording from Twilio in the background, so it's ready before anyone asks for it. """
+    taskqueue.add(url=FETCH_RECORDING_TASK_URL, params={"sid": recordingSid})
+
+def parseRange(rangeHeader, size):
+    """ Parse an HTTP Range header for a file of 'size' bytes.
+
+    Returns (start, end), where end is inclusive, or None if the whole file
+    should be sent.  Raises ValueError if the range can't be satisfied.
+    Multiple ranges aren't supported, so we send the whole file for them.
+    """
+    if not rangeHeader:
+        return None
+    match = _rangeRegex.match(rangeHeader.strip())
+    if not match:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # The last 'end' bytes.
+        start = max(0, size - int(end))
+        end = size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return (start, end)
+
+class FileRecordingStore:
+    """ Stores recordings in a directory on the local filesystem.
+
+    Used for tests and development; App Engine can't write to its filesystem.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+
+    def _getPath(self, recordingSid):
+        return os.path.join(self._directory, recordingSid)
+
+    def getSize(self, recordingSid):
+        """ Returns the size of a stored recording, or None if it isn't stored. """
+        try:
+            return os.path.getsize(self._getPath(recordingSid))
+        except OSError:
+            return None
+
+    def read(self, recordingSid, start, length):
+        with open(self._getPath(recordingSid), "rb") as recordingFile:
+            recordingFile.seek(start)
+            return recordingFile.read(length)
+
+    def write(self, recordingSid, data, contentType):
+        # Write to a temporary file first, so readers never see half a recording.
+        tempPath = self._getPath(recordingSid) + ".tmp" + str(threading.current_thread().ident)
+        with open(tempPath, "wb") as recordingFile:
+            recordingFile.write(data)
+        os.rename(tempPath, self._getPath(recordingSid))
+
+class CloudStorageRecordingStore:
+    """ Stores recordings in a Google Cloud Storage bucket.
+
+    If bucket is None, the app's default bucket is used.
+    """
+    def __init__(self, bucket=None):
+        self._bucket = bucket
+
+    def _getFilename(self, recordingSid):
+        if not self._bucket:
+            self._bucket = app_identity.get_default_gcs_bucket_name()
+        return "/" + self._bucket + "/recordings/" + recordingSid
+
+    def getSize(self, recordingSid):
+        """ Returns the size of a stored recording, or None if it isn't stored. """
+        try:
+            return cloudstorage.stat(self._getFilename(recordingSid)).st_size
+        except cloudstorage.NotFoundError:
+            return None
+
+    def read(self, recordingSid, start, length):
+        with cloudstorage.open(self._getFilename(recordingSid)) as recordingFile:
+            recordingFile.seek(start)
+            return recordingFile.read(length)
+
+    def write(self, recordingSid, data, contentType):
+        with cloudstorage.open(self._getFilename(recordingSid), "w", content_type=contentType) as recordingFile:
+            recordingFile.write(data)
+
+def getDefaultStore():
+    """ Returns a CloudStorageRecordingStore for RECORDING_BUCKET, or None if we can't store recordings. """
+    if not cloudstorage:
+        logging.warn("cloudstorage library is not installed; recordings won't be cached.")
+        return None
+    return CloudStorageRecordingStore(getattr(config, "RECORDING_BUCKET", None))
+
+def fetchFromTwilio(recordingSid):
+    """ Download a recording from Twilio.  Raises RecordingNotFoundException if we can't. """
+    url = _TWILIO_RECORDING_URL % (config.TWILIO_ACID, recordingSid)
+    try:
+        result = urlfetch.fetch(url=url,
+                                deadline=30,
+                                headers={"Authorization": "Basic %s" % (base64.encodestring(config.TWILIO_ACID + ":" + config.TWILIO_AUTH)[:-1]).replace('\n', '') })
+    except urlfetch.Error as e:
+        raise RecordingNotFoundException("Could not reach Twilio: " + str(e))
+    if result.status_code != 200:
+        raise RecordingNotFoundException("Twilio returned " + str(result.status_code) + " for " + recordingSid)
+    return result.content
+
+class RecordingCache:
+    """ Serves recordings from a store, copying them from Twilio the first time they're needed.
+    """
+    def __init__(self, store, fetch=fetchFromTwilio):
+        self._store = store
+        self._fetch = fetch
+
+    def getSize(self, recordingSid):
+        """ Returns the size of a recording, fetching it from Twilio if it isn't stored yet.
+
+        Raises RecordingNotFoundException if the recording can't be found.
+        """
+        size = self._store.getSize(recordingSid)
+        if size is None:
+            logging.info("Fetching recording " + recordingSid + " from Twilio")
+            data = self._fetch(recordingSid)
+            self._store.write(recordingSid, data, _CONTENT_TYPE)
+            size = len(data)
+        return size
+
+    def read(self, recordingSid, start, length):
+        return self._store.read(recordingSid, start, length)
+
+    def getContentType(self):
+        return _CONTENT_TYPE
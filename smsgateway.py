@@ -0,0 +1,321 @@
+""" Sends SMS messages through one or more SMS gateways.
+
+An SmsRouter keeps track of how long each gateway takes to send a message,
+and how often it fails, and sends each message through the gateway which
+should get it delivered soonest.  If that gateway turns the message down,
+the message goes to the next one.  A gateway which fails several times in a
+row gets no more messages for a while (its circuit breaker is open); after
+that, one message is sent through it to see if it has recovered.
+
+If a gateway times out, or the connection fails, it may have sent the
+message anyway, so the message is not passed on to another gateway.  The
+error is still retryable, and the caller's later retry can deliver the
+message twice.
+
+The estimates are kept by each instance, and start again when the instance
+starts.
+"""
+import base64
+import random
+import threading
+import time
+import urllib
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+from util import structlog
+
+import config
+
+log = structlog.getLogger(__name__)
+
+# Weight given to each new measurement in the moving averages.
+_SMOOTHING = 0.2
+
+# Send a message through a gateway we haven't used for this many seconds,
+# to see if it has got faster.
+_PROBE_INTERVAL = 60
+
+# Open a gateway's circuit breaker after this many failures in a row, for
+# this many seconds.
+_FAILURE_THRESHOLD = 3
+_OPEN_TIME = 30
+
+# Give up on a gateway request after this many seconds.
+_DEADLINE = 10
+
+_CLOSED = "closed"
+_OPEN = "open"
+_HALF_OPEN = "halfOpen"
+
+class GatewayError(Exception):
+    """ Thrown when a gateway doesn't send a message.
+
+    statusCode is the HTTP status the gateway returned, or None if we didn't
+    get a response.  maybeSent is True if the gateway might have sent the
+    message anyway, as it can when a request times out.
+    """
+    def __init__(self, statusCode, message, maybeSent=False):
+        super(GatewayError, self).__init__(message)
+        self.statusCode = statusCode
+        self.errorMessage = message
+        self.maybeSent = maybeSent
+
+    def isRetryable(self):
+        """ Returns True if sending the message again, or through another gateway, might work. """
+        return (self.statusCode is None) or (self.statusCode == 429) or (self.statusCode >= 500)
+
+class TwilioGateway:
+    """ Sends messages through a Twilio account.
+
+    Messages come from the owner's number, unless 'fromNumber' is given,
+    for accounts which don't own the owner's number.
+    """
+
+    def __init__(self, name, accountSid, authToken, fromNumber=None, deadline=_DEADLINE):
+        self.name = name
+        self._url = "https://api.twilio.com/2010-04-01/Accounts/" + accountSid + "/SMS/Messages"
+        self._authorization = "Basic " + base64.b64encode(accountSid + ":" + authToken)
+        self._fromNumber = fromNumber
+        self._deadline = deadline
+
+    @ndb.tasklet
+    def sendAsync(self, fromNumber, toNumber, body):
+        formData = urllib.urlencode({
+            "From": self._fromNumber or fromNumber,
+            "To": toNumber,
+            "Body": body
+        })
+        log.debug("twilio.request", gateway=self.name, url=self._url)
+
+        try:
+            result = yield ndb.get_context().urlfetch(url=self._url,
+                                                      payload=formData,
+                                                      method=urlfetch.POST,
+                                                      headers={'Content-Type': 'application/x-www-form-urlencoded',
+                                                               "Authorization": self._authorization},
+                                                      deadline=self._deadline)
+        except urlfetch.Error as e:
+            # Twilio may have got the request before the connection failed.
+            raise GatewayError(None, "Could not reach Twilio: " + str(e), maybeSent=True)
+        log.debug("twilio.response", gateway=self.name, status=result.status_code, content=result.content)
+
+        if (result.status_code < 200) or (result.status_code >= 300):
+            raise GatewayError(result.status_code, result.content)
+
+class FakeGateway:
+    """ Pretends to send messages, for tests and the development server.
+
+    Each message takes 'latency' seconds, and fails with 'statusCode' for
+    'errorRate' of messages.  Both can be changed at any time.  Messages
+    which are "sent" are kept in 'sent', as (fromNumber, toNumber, body).
+    """
+
+    def __init__(self, name, latency=0, errorRate=0, statusCode=503, seed=None):
+        self.name = name
+        self.latency = latency
+        self.errorRate = errorRate
+        self.statusCode = statusCode
+        self.attempts = 0
+        self.sent = []
+        self._random = random.Random(seed)
+
+    @ndb.tasklet
+    def sendAsync(self, fromNumber, toNumber, body):
+        self.attempts += 1
+        if self.latency:
+            yield ndb.sleep(self.latency)
+        if self._random.random() < self.errorRate:
+            raise GatewayError(self.statusCode, "Fake gateway " + self.name + " failed")
+        self.sent.append((fromNumber, toNumber, body))
+
+class GatewayHealth:
+    """ Moving averages of one gateway's latency and error rate, and its circuit breaker. """
+
+    def __init__(self, smoothing=_SMOOTHING, failureThreshold=_FAILURE_THRESHOLD, openTime=_OPEN_TIME,
+                 probeInterval=_PROBE_INTERVAL):
+        self._smoothing = smoothing
+        self._failureThreshold = failureThreshold
+        self._openTime = openTime
+        self._probeInterval = probeInterval
+        self._lock = threading.Lock()
+        # None until we've sent something through the gateway.
+        self.latency = None
+        self.errorRate = 0.0
+        self.state = _CLOSED
+        self._consecutiveFailures = 0
+        self._openUntil = 0
+        self._lastUsed = 0
+
+    def getExpectedTime(self):
+        """ Returns how long we expect it to take to get a message through, counting retries. """
+        return (self.latency or 0) / max(1 - self.errorRate, 0.01)
+
+    def isTrialDue(self, now):
+        """ Returns True if the breaker is open, but it's time to see if the gateway has recovered.
+
+        A trial which never finished, because its request died, counts as
+        failed once openTime has passed, and another one is due.
+        """
+        return self.state != _CLOSED and now >= self._openUntil
+
+    def isProbeDue(self, now):
+        """ Returns True if our estimates for this gateway are missing or old, and worth checking. """
+        if self.state == _CLOSED:
+            return now - self._lastUsed >= self._probeInterval
+        return self.isTrialDue(now)
+
+    def allowRequest(self, now):
+        """ Returns True if a message may be sent through this gateway now.
+
+        Once the breaker has been open for long enough, this allows one
+        message through, and no more until that one has finished.
+        """
+        with self._lock:
+            if self.state == _CLOSED:
+                return True
+            if self.isTrialDue(now):
+                self.state = _HALF_OPEN
+                self._openUntil = now + self._openTime
+                return True
+            return False
+
+    def record(self, latency, failed, now):
+        """ Record how long a message took, and whether the gateway failed.
+
+        Returns True if this opened the circuit breaker.
+        """
+        with self._lock:
+            self._lastUsed = now
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self._smoothing * (latency - self.latency)
+            self.errorRate += self._smoothing * ((1.0 if failed else 0.0) - self.errorRate)
+            if not failed:
+                self._consecutiveFailures = 0
+                self.state = _CLOSED
+                return False
+
+            self._consecutiveFailures += 1
+            if self.state == _HALF_OPEN or self._consecutiveFailures >= self._failureThreshold:
+                opened = self.state != _OPEN
+                self.state = _OPEN
+                self._openUntil = now + self._openTime
+                return opened
+            return False
+
+    def getStatus(self):
+        return {
+            "latency": self.latency,
+            "errorRate": self.errorRate,
+            "state": self.state
+        }
+
+class SmsRouter:
+    """ Sends each message through the healthiest of several gateways. """
+
+    def __init__(self, gateways, clock=time.time, **healthOptions):
+        """ Create a new SmsRouter.
+
+        'gateways' are tried in order until we know which is healthiest.
+        healthOptions are passed on to each gateway's GatewayHealth.
+        """
+        self._gateways = [(gateway, GatewayHealth(**healthOptions)) for gateway in gateways]
+        self._clock = clock
+
+    def _rank(self):
+        """ Returns the gateways in the order to try them.
+
+        A gateway we haven't used for a while, or whose breaker has been open
+        long enough, goes first, to see how it's doing now.  The rest go
+        fastest first.
+        """
+        now = self._clock()
+        order = sorted(range(0, len(self._gateways)),
+                       key=lambda i: (not self._gateways[i][1].isProbeDue(now),
+                                      self._gateways[i][1].getExpectedTime(),
+                                      i))
+        return [self._gateways[i] for i in order]
+
+    @ndb.tasklet
+    def sendAsync(self, fromNumber, toNumber, body):
+        """ Send a message, failing over to other gateways as needed.
+
+        Returns the name of the gateway which sent it.  Raises GatewayError
+        if the message can't be sent.
+        """
+        lastError = None
+        for gateway, health in self._rank():
+            if not health.allowRequest(self._clock()):
+                continue
+
+            start = self._clock()
+            try:
+                yield gateway.sendAsync(fromNumber, toNumber, body)
+            except GatewayError as e:
+                # A non-retryable error is about the message, not the gateway.
+                failed = e.isRetryable()
+                if health.record(self._clock() - start, failed, self._clock()):
+                    log.warn("sms.gateway.open", gateway=gateway.name, error=e.errorMessage)
+                if (not failed) or e.maybeSent:
+                    raise
+                log.warn("sms.gateway.failed", gateway=gateway.name, to=toNumber, error=e.errorMessage)
+                lastError = e
+                continue
+            except Exception:
+                health.record(self._clock() - start, True, self._clock())
+                raise
+
+            health.record(self._clock() - start, False, self._clock())
+            raise ndb.Return(gateway.name)
+
+        raise lastError or GatewayError(None, "No SMS gateway is available")
+
+    def getStatus(self):
+        """ Returns each gateway's name, latency, error rate and breaker state, in the order they'd be tried. """
+        answer = []
+        for gateway, health in self._rank():
+            status = health.getStatus()
+            status["name"] = gateway.name
+            answer.append(status)
+        return answer
+
+def createGateway(settings):
+    """ Create a gateway from one of the dicts in config.SMS_GATEWAYS. """
+    gatewayType = settings.get("type", "twilio")
+    name = settings.get("name", gatewayType)
+    if gatewayType == "twilio":
+        return TwilioGateway(name, settings["accountSid"], settings["authToken"],
+                             fromNumber=settings.get("fromNumber"),
+                             deadline=settings.get("deadline", _DEADLINE))
+    elif gatewayType == "fake":
+        return FakeGateway(name, latency=settings.get("latency", 0), errorRate=settings.get("errorRate", 0))
+    raise ValueError("Unknown SMS gateway type " + gatewayType)
+
+def createRouter(developmentServer=False):
+    """ Create an SmsRouter for the gateways in config.py.
+
+    Without SMS_GATEWAYS, this sends through the Twilio account in
+    TWILIO_ACID and TWILIO_AUTH, or on the development server, sends nothing.
+    """
+    gatewaySettings = getattr(config, "SMS_GATEWAYS", None)
+    if gatewaySettings:
+        gateways = [createGateway(settings) for settings in gatewaySettings]
+    elif developmentServer:
+        gateways = [FakeGateway("development")]
+    else:
+        gateways = [TwilioGateway("twilio", config.TWILIO_ACID, config.TWILIO_AUTH)]
+    return SmsRouter(gateways)
+
+_defaultRouter = None
+_defaultRouterLock = threading.Lock()
+
+def getDefaultRouter(developmentServer=False):
+    """ Returns the SmsRouter shared by every owner on this instance. """
+    global _defaultRouter
+    with _defaultRouterLock:
+        if _defaultRouter is None:
+            _defaultRouter = createRouter(developmentServer)
+        return _defaultRouter
@@ -0,0 +1,78 @@
+import random
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from util.tokenbucket import MemCacheTokenBucket, reserveAll
+from util.phonenumberutils import toNormalizedNumber
+
+# URL of the task which sends queued SMS messages.
+SEND_SMS_TASK_URL = "/tasks/sendSms"
+
+# Give up on a message after this many failed attempts to send it.
+MAX_SEND_ATTEMPTS = 6
+
+# Delay before the first retry, and the longest we'll wait between retries, in seconds.
+_RETRY_BASE_DELAY = 30
+_RETRY_MAX_DELAY = 60 * 60
+
+class SmsRateLimiter:
+    """ Limits how fast we send SMS messages from one number.
+
+    There is one token bucket for all messages sent from the number, and one
+    for each destination number.  A message needs a token from both.
+    """
+
+    def __init__(self, fromNumber, rate, burst, perNumberRate, perNumberBurst):
+        """ Create a new SmsRateLimiter.
+
+        'rate' is how many messages per second we can send in total, and
+        'burst' is how many messages we can send at once before we have to
+        slow down to 'rate'.  perNumberRate and perNumberBurst are the same,
+        but for each destination number.
+        """
+        self._keyPrefix = "Sms:" + toNormalizedNumber(fromNumber)
+        self._globalBucket = MemCacheTokenBucket(self._keyPrefix, rate, burst)
+        self._perNumberRate = perNumberRate
+        self._perNumberBurst = perNumberBurst
+
+    def _getBucket(self, toNumber):
+        return MemCacheTokenBucket(self._keyPrefix + ":" + toNormalizedNumber(toNumber),
+                                   self._perNumberRate, self._perNumberBurst)
+
+    def reserve(self, toNumber):
+        """ Reserve a slot to send an SMS to 'toNumber'.
+
+        Returns 0 if the message can be sent now, or the number of seconds to
+        wait before sending it.
+        """
+        return reserveAll([self._globalBucket, self._getBucket(toNumber)])
+
+    def getStatus(self, toNumber=None):
+        """ Returns the state of the global bucket, and of toNumber's bucket if given. """
+        answer = {"global": self._globalBucket.getStatus()}
+        if toNumber:
+            answer["destination"] = self._getBucket(toNumber).getStatus()
+        return answer
+
+def getRetryDelay(attempts):
+    """ Returns how long to wait before retrying a message which has failed 'attempts' times.
+
+    The delay doubles with each attempt, and is randomized by up to half so
+    messages which failed together don't all retry together.
+    """
+    delay = min(_RETRY_MAX_DELAY, _RETRY_BASE_DELAY * (2 ** (attempts - 1)))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+def queueSms(pendingSms, delay):
+    """ Store a PendingSms, and queue a task to send it in 'delay' seconds.
+
+    The task is only queued if pendingSms is stored successfully.
+    """
+    def txn():
+        pendingSms.put()
+        taskqueue.add(url=SEND_SMS_TASK_URL,
+                      params={"owner": pendingSms.ownerNumber, "id": pendingSms.key().id()},
+                      countdown=delay,
+                      transactional=True)
+    db.run_in_transaction(txn)
@@ -0,0 +1,56 @@
+import unittest
+
+from google.appengine.ext import testbed
+
+import blocklist
+from blocklist import Blocklist
+
+class BlocklistTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_exactAndPrefix(self):
+        numbers = Blocklist()
+        self.assertEqual(None, numbers.check("+16135551234"))
+
+        self.assertTrue(numbers.block("(613)555-1234"))
+        self.assertTrue(numbers.block("+1900*"))
+        self.assertEqual(None, numbers.block("garbage"))
+
+        self.assertEqual(blocklist.BLOCKED, numbers.check("+16135551234"))
+        self.assertEqual(blocklist.BLOCKED, numbers.check("19005550000"))
+        self.assertEqual(None, numbers.check("+16135551235"))
+
+        self.assertEqual("+16135551234", numbers.unblock("613-555-1234"))
+        self.assertEqual(None, numbers.check("+16135551234"))
+        self.assertEqual("+1900*", numbers.unblock(" 1900* "))
+        self.assertEqual(None, numbers.check("19005550000"))
+        self.assertEqual(None, numbers.unblock("garbage"))
+
+    def test_changesSeenByOtherInstances(self):
+        numbers = Blocklist()
+        otherInstance = Blocklist()
+        self.assertEqual(None, otherInstance.check("+16135551234"))
+
+        numbers.block("+16135551234")
+        otherInstance._matchers._entries[''][1] = 0
+        self.assertEqual(blocklist.BLOCKED, otherInstance.check("+16135551234"))
+
+    def test_rateLimit(self):
+        numbers = Blocklist(rateLimit=3, rateWindow=60)
+        for i in range(0, 3):
+            self.assertEqual(None, numbers.check("+16135551234"))
+        self.assertEqual(blocklist.RATE_LIMITED, numbers.check("+16135551234"))
+        self.assertEqual(None, numbers.check("+16135559999"))
+
+        self.assertEqual(1, numbers.getDropCounts()[blocklist.RATE_LIMITED])
+
+if __name__ == '__main__':
+    unittest.main()
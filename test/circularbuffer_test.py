@@ -1,6 +1,8 @@
+import itertools
 import unittest
 
 from google.appengine.ext import testbed
+from google.appengine.api import memcache
 
 
 import util.circularbuffer
@@ -47,6 +49,86 @@ class CircularBufferTestCases(unittest.TestCase):
         for i in range(0, self.BUFFER_SIZE):
             self.assertEquals(i + 2, items[i])
 
+    def test_maxItemsToGet(self):
+        buf = util.circularbuffer.MemCacheCircularBuffer(self.BUFFER_SIZE)
+        for i in range(0, self.BUFFER_SIZE):
+            buf.addItem(i)
+
+        items = buf.getItems(3)
+        self.assertEquals([7, 8, 9], items)
+
+    def test_counterEvicted(self):
+        buf = util.circularbuffer.MemCacheCircularBuffer(self.BUFFER_SIZE, "evicted")
+        for i in range(0, self.BUFFER_SIZE + 5):
+            buf.addItem(i)
+
+        # Simulate the counter being evicted from MemCache.
+        memcache.delete(buf._counterKey(0), namespace="CircularBuffer")
+
+        buf.addItem(100)
+        buf.addItem(101)
+
+        items = buf.getItems()
+        self.assertEquals(self.BUFFER_SIZE, len(items))
+        self.assertEquals(range(7, self.BUFFER_SIZE + 5) + [100, 101], items)
+
+    def test_shardsMergedInOrder(self):
+        # Two buffers sharing the same key prefix, each writing to both shards.
+        buf1 = util.circularbuffer.MemCacheCircularBuffer(self.BUFFER_SIZE, "sharded", shardCount=2)
+        buf2 = util.circularbuffer.MemCacheCircularBuffer(self.BUFFER_SIZE, "sharded", shardCount=2)
+        buf1._nextShard = itertools.count(0)
+        buf2._nextShard = itertools.count(1)
+
+        for i in range(0, self.BUFFER_SIZE + 2):
+            if i % 2:
+                buf2.addItem(i)
+            else:
+                buf1.addItem(i)
+
+        items = buf1.getItems()
+        self.assertEquals(self.BUFFER_SIZE, len(items))
+        self.assertEquals(range(2, self.BUFFER_SIZE + 2), items)
+        self.assertEquals(items, buf2.getItems())
+
+    def test_shardsShareBufferSize(self):
+        buf = util.circularbuffer.MemCacheCircularBuffer(self.BUFFER_SIZE, "shared", shardCount=4)
+        for i in range(0, 25):
+            buf.addItem(i)
+
+        self.assertEquals(range(15, 25), buf.getItems())
+        # Each shard keeps 3 items, so only 12 slots are ever used.
+        slots = [buf._slotKey(shard, slot) for shard in range(0, 4) for slot in range(0, self.BUFFER_SIZE)]
+        self.assertEquals(12, len(memcache.get_multi(slots, namespace="CircularBuffer")))
+
+    def test_newItemsAfterCursor(self):
+        buf = util.circularbuffer.MemCacheCircularBuffer(self.BUFFER_SIZE, "cursor", shardCount=2)
+        self.assertEquals(([], (0, 0)), buf.getNewItems())
+        self.assertFalse(buf.hasNewItems())
+
+        for i in range(0, 3):
+            buf.addItem(i)
+        items, cursor = buf.getNewItems()
+        self.assertEquals([0, 1, 2], items)
+        self.assertFalse(buf.hasNewItems(cursor))
+
+        buf.addItem(3)
+        buf.addItem(4)
+        self.assertTrue(buf.hasNewItems(cursor))
+        items, newCursor = buf.getNewItems(cursor)
+        self.assertEquals([3, 4], items)
+        self.assertEquals(([], newCursor), buf.getNewItems(newCursor))
+        # A cursor from before the shard count changed still works.
+        self.assertEquals([3, 4], buf.getNewItems(list(cursor) + [7])[0])
+
+    def test_shardsWithSkewedClocks(self):
+        buf = util.circularbuffer.MemCacheCircularBuffer(self.BUFFER_SIZE, "skewed", shardCount=2)
+        # Shard 0 was written by two instances, the second with a slow clock.
+        memcache.set(buf._slotKey(0, 1), (10.0, 1, "a"), namespace="CircularBuffer")
+        memcache.set(buf._slotKey(0, 2), (5.0, 2, "b"), namespace="CircularBuffer")
+        memcache.set(buf._slotKey(1, 1), (7.0, 1, "c"), namespace="CircularBuffer")
+
+        self.assertEquals(["b", "c", "a"], buf.getItems())
+
             
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
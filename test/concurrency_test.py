@@ -0,0 +1,154 @@
+import os
+import threading
+import unittest
+
+from google.appengine.api import app_identity
+from google.appengine.api import xmpp
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from xmppvoicemail import Owner, XmppVoiceMail
+from models import Contact
+from util import phonenumberutils
+from util import requestcontext
+import smsqueue
+import conversations
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+THREAD_COUNT = 8
+MESSAGES_PER_THREAD = 10
+
+class CommunicationsFixture:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.xmppMessages = []
+        self.sms = []
+
+    def sendXmppMessage(self, fromJid, toJid, message):
+        with self._lock:
+            self.xmppMessages.append((fromJid, message))
+        return xmpp.NO_ERROR
+
+    def getXmppPresence(self, jid, fromJid):
+        return True
+
+    @ndb.tasklet
+    def sendSMSAsync(self, fromNumber, toNumber, body):
+        with self._lock:
+            self.sms.append((toNumber, body))
+
+class ConcurrencyTestCases(unittest.TestCase):
+    """ Hammers one shared XmppVoiceMail from many threads at once, as a
+    threadsafe instance would.
+    """
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().clear_cache()
+        requestcontext.start()
+
+        self.ownerJid = "user@gmail.com"
+        owner = Owner("+16135554444", self.ownerJid, "user@test.com",
+                      logSize=2 * THREAD_COUNT * MESSAGES_PER_THREAD)
+        self.xmppvoicemail = XmppVoiceMail(owner)
+        self.communications = self.xmppvoicemail._communications = CommunicationsFixture()
+        self.xmppvoicemail._rateLimiter = smsqueue.SmsRateLimiter(owner.phoneNumber,
+            rate=1000, burst=1000, perNumberRate=1000, perNumberBurst=1000)
+
+        defaultSender = Contact.getDefaultSender()
+        defaultSender.subscribed = True
+        Contact.update(defaultSender)
+
+        # Even threads talk to a contact, odd threads to a stranger.
+        for thread in range(0, THREAD_COUNT, 2):
+            Contact.update(Contact(
+                name="contact" + str(thread),
+                phoneNumber=self.getNumber(thread),
+                normalizedPhoneNumber=self.getNumber(thread),
+                subscribed=True))
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def getNumber(self, thread):
+        return "+1613555%04d" % thread
+
+    def getContactName(self, thread):
+        if thread % 2 == 0:
+            return "contact" + str(thread)
+        return phonenumberutils.toPrettyNumber(self.getNumber(thread))
+
+    def talk(self, thread, counters, errors):
+        """ Exchange messages with one number, as a series of separate requests. """
+        try:
+            appId = app_identity.get_application_id()
+            for message in range(0, MESSAGES_PER_THREAD):
+                requestcontext.start()
+                self.xmppvoicemail.handleIncomingSms(self.getNumber(thread), "+16135554444",
+                                                     "to %d-%d" % (thread, message))
+                counters.append(dict(requestcontext.end().counters))
+
+                requestcontext.start()
+                if thread % 2 == 0:
+                    to, body = self.getContactName(thread), "from %d-%d" % (thread, message)
+                else:
+                    to, body = "xmppvoicemail", "%s: from %d-%d" % (self.getNumber(thread), thread, message)
+                self.xmppvoicemail.handleIncomingXmpp(self.ownerJid, to + "@" + appId + ".appspotchat.com", body)
+                counters.append(dict(requestcontext.end().counters))
+        except Exception as e:
+            errors.append(e)
+
+    def test_concurrentRequests(self):
+        counters = []
+        errors = []
+        threads = [threading.Thread(target=self.talk, args=(thread, counters, errors))
+                   for thread in range(0, THREAD_COUNT)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+        # Each request only counted its own work.
+        self.assertEqual(THREAD_COUNT * MESSAGES_PER_THREAD, counters.count({"logItems": 1}))
+        self.assertEqual(THREAD_COUNT * MESSAGES_PER_THREAD, counters.count({"logItems": 1, "smsSent": 1}))
+
+        # Nothing was lost, and every message went to and from the right place.
+        log = self.xmppvoicemail.getLog()
+        self.assertEqual(2 * THREAD_COUNT * MESSAGES_PER_THREAD, len(log))
+        self.assertEqual(len(log), len(set(item.message for item in log)))
+
+        for thread in range(0, THREAD_COUNT):
+            number = self.getNumber(thread)
+            name = self.getContactName(thread)
+            if thread % 2 == 0:
+                fromJid = name + "@" + app_identity.get_application_id() + ".appspotchat.com"
+                prefix = ""
+            else:
+                fromJid = "xmppvoicemail@" + app_identity.get_application_id() + ".appspotchat.com"
+                prefix = name + ": "
+
+            expectedTo = ["to %d-%d" % (thread, message) for message in range(0, MESSAGES_PER_THREAD)]
+            expectedFrom = ["from %d-%d" % (thread, message) for message in range(0, MESSAGES_PER_THREAD)]
+
+            self.assertEqual([prefix + body for body in expectedTo],
+                             [message for jid, message in self.communications.xmppMessages
+                              if message.endswith(tuple(expectedTo)) and jid == fromJid])
+            self.assertEqual(expectedFrom,
+                             [body for toNumber, body in self.communications.sms if toNumber == number])
+
+            contactLog = [item for item in log if item.message in expectedTo + expectedFrom]
+            self.assertEqual(2 * MESSAGES_PER_THREAD, len(contactLog))
+            for item in contactLog:
+                if thread % 2 == 0 or item.direction == "to":
+                    self.assertEqual(name, item.contact)
+
+            self.assertEqual(2 * MESSAGES_PER_THREAD, conversations.getConversation(number).messageCount)
+
+if __name__ == '__main__':
+    unittest.main()
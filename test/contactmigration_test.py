@@ -0,0 +1,66 @@
+import unittest
+
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import contactmigration
+import models
+from models import Contact, ContactIndexState, ContactNameIndex, ContactNumberIndex
+
+class DbContact(db.Model):
+    """ A Contact as stored before there were index entities. """
+    name = db.StringProperty(required=True)
+    phoneNumber = db.StringProperty(required=True)
+    normalizedPhoneNumber = db.StringProperty(required=True)
+    subscribed = db.BooleanProperty(default=False, required=True)
+
+    @classmethod
+    def kind(cls):
+        return "Contact"
+
+class ContactMigrationTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        models._migratedNamespaces.clear()
+        models._unmigratedNamespaces.clear()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_migrateInBatches(self):
+        contacts = []
+        for name, number in [("mom", "+16135551234"), ("dad", "+16135555678"),
+                             ("mike", "+16135559999"), ("mike", "+16135550000")]:
+            contact = DbContact(name=name, phoneNumber=number, normalizedPhoneNumber=number)
+            contact.put()
+            contacts.append(contact)
+
+        cursor = contactmigration.migrateBatch(batchSize=3)
+        self.assertNotEqual(None, cursor)
+        self.assertFalse(ContactIndexState.isMigrated())
+
+        # Running a batch again does no harm.
+        self.assertEqual(cursor, contactmigration.migrateBatch(batchSize=3))
+        self.assertEqual(None, contactmigration.migrateBatch(cursor, batchSize=3))
+        self.assertTrue(ContactIndexState.isMigrated())
+
+        for contact in contacts[:3]:
+            key = ndb.Key.from_old_key(contact.key())
+            self.assertEqual(key, ContactNumberIndex.get_by_id(contact.normalizedPhoneNumber).contact)
+        # The first "mike" keeps the name.
+        self.assertEqual(ndb.Key.from_old_key(contacts[2].key()), ContactNameIndex.get_by_id("mike").contact)
+        self.assertEqual(ndb.Key.from_old_key(contacts[3].key()),
+                         ContactNumberIndex.get_by_id("+16135550000").contact)
+
+        # Contacts are found through their index entities.
+        self.assertEqual("dad", Contact.getByName("dad").name)
+        self.assertEqual(None, Contact.getByName("nobody"))
+
+if __name__ == '__main__':
+    unittest.main()
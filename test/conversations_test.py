@@ -0,0 +1,63 @@
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import conversations
+
+class ConversationsTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def record(self, number, direction, message):
+        conversations.recordMessageAsync(number, "mom", direction, message,
+                                         unread=(direction == "to")).get_result()
+
+    def test_pagination(self):
+        for i in range(0, 5):
+            self.record("+16135551234", "to", "Message " + str(i))
+        self.record("+16135559999", "to", "Someone else")
+
+        messages, cursor = conversations.getMessages("(613)555-1234", limit=3)
+        self.assertEqual(["Message 4", "Message 3", "Message 2"], [message.message for message in messages])
+        self.assertTrue(cursor)
+
+        messages, cursor = conversations.getMessages("(613)555-1234", cursor, limit=3)
+        self.assertEqual(["Message 1", "Message 0"], [message.message for message in messages])
+        self.assertEqual(None, cursor)
+
+    def test_summary(self):
+        self.record("+16135551234", "to", "Hello")
+        self.record("+16135551234", "to", "Are you there?")
+        self.record("+16135559999", "to", "Hi")
+
+        conversation = conversations.getConversation("+16135551234")
+        self.assertEqual(2, conversation.unreadCount)
+        self.assertEqual(2, conversation.messageCount)
+        self.assertEqual("Are you there?", conversation.lastMessage)
+
+        # Replying marks the conversation read.
+        self.record("+16135551234", "from", "Yes")
+        conversation = conversations.getConversation("+16135551234")
+        self.assertEqual(0, conversation.unreadCount)
+        self.assertEqual(3, conversation.messageCount)
+        self.assertEqual("from", conversation.lastDirection)
+
+        summaries, cursor = conversations.getConversations()
+        self.assertEqual(["+16135551234", "+16135559999"], [summary.key.id() for summary in summaries])
+        self.assertEqual(None, cursor)
+
+        self.assertEqual(0, conversations.markRead("+16135559999").unreadCount)
+        self.assertEqual(0, conversations.getConversation("+16135559999").unreadCount)
+        self.assertEqual(None, conversations.markRead("+16135550000"))
+
+if __name__ == '__main__':
+    unittest.main()
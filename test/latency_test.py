@@ -0,0 +1,64 @@
+import unittest
+
+from google.appengine.ext import testbed
+
+from util.latency import LatencyHistograms, LatencyMiddleware, OTHER_ROUTE
+
+def _okApp(environ, start_response):
+    start_response("200 OK", [])
+    return ["OK"]
+
+class LatencyTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_percentiles(self):
+        histograms = LatencyHistograms()
+        for i in range(0, 98):
+            histograms.record("/sms", "200", 10)
+        histograms.record("/sms", "200", 500)
+        histograms.record("/sms", "200", 5000)
+        histograms.record("/call", "500", 1)
+
+        percentiles = histograms.getPercentiles()
+        self.assertEqual(2, len(percentiles))
+
+        sms = percentiles[0]
+        self.assertEqual("/sms", sms["route"])
+        self.assertEqual("200", sms["status"])
+        self.assertEqual(100, sms["count"])
+        self.assertTrue(10 <= sms["p50"] < 13, sms["p50"])
+        self.assertTrue(10 <= sms["p95"] < 13, sms["p95"])
+        self.assertTrue(500 <= sms["p99"] < 625, sms["p99"])
+
+    def test_countsMergedAcrossInstances(self):
+        instance1 = LatencyHistograms()
+        instance2 = LatencyHistograms()
+        instance1.record("/sms", "200", 10)
+        instance2.record("/sms", "200", 10)
+        instance1.flush()
+
+        percentiles = instance2.getPercentiles()
+        self.assertEqual(1, len(percentiles))
+        self.assertEqual(2, percentiles[0]["count"])
+
+    def test_middlewareRecordsRoute(self):
+        histograms = LatencyHistograms()
+        app = LatencyMiddleware(_okApp, [r'/api/admin/contacts', r'/api/admin/contacts/(.*)'], histograms)
+
+        statuses = []
+        for path in ["/api/admin/contacts/1", "/api/admin/contacts/2", "/nothere"]:
+            self.assertEqual(["OK"], app({"PATH_INFO": path}, lambda status, headers, exc_info=None: statuses.append(status)))
+        self.assertEqual(["200 OK"] * 3, statuses)
+
+        counts = dict((item["route"], item["count"]) for item in histograms.getPercentiles())
+        self.assertEqual({r'/api/admin/contacts/(.*)': 2, OTHER_ROUTE: 1}, counts)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import messagesearch
+from models import SearchTerm
+from util import postings
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+class MessageSearchTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().clear_cache()
+        messagesearch._lastIndexTask = None
+        self.chunkSize = messagesearch.CHUNK_SIZE
+
+    def tearDown(self):
+        messagesearch.CHUNK_SIZE = self.chunkSize
+        self.testbed.deactivate()
+
+    def index(self, messages, contact="mom"):
+        for message in messages:
+            messagesearch.queueDocument("to", contact, message)
+        while messagesearch.indexPending():
+            pass
+
+    def search(self, query, before=None, limit=20):
+        results, cursor = messagesearch.search(query, before, limit)
+        return [result.message for result in results], cursor
+
+    def test_postings(self):
+        docIds = [1, 2, 130, 20000, 2 ** 40]
+        self.assertEqual(docIds, postings.decode(postings.encode(docIds)))
+        self.assertEqual(4, len(postings.encode([1, 2, 130])))
+        self.assertEqual(3, len(postings.encode([20000], 130)))
+        self.assertEqual([5, 9], postings.decode(postings.encode([5, 9], 3), 3))
+        self.assertRaises(ValueError, postings.encode, [3, 3])
+
+        self.assertEqual([2, 9], postings.intersect([1, 2, 5, 9], [2, 3, 9]))
+        self.assertEqual([50, 99], postings.intersect([50, 99], range(0, 1000)))
+
+    def test_indexerScheduledOnce(self):
+        messagesearch.queueDocument("to", "mom", "Hello")
+        messagesearch.queueDocument("to", "mom", "Hello again")
+
+        taskqueueStub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.assertEqual(1, len(taskqueueStub.get_filtered_tasks(url=messagesearch.INDEX_TASK_URL)))
+
+    def test_termsAndPhrases(self):
+        self.index(["Where are you?", "I'm at the store", "Don't forget the milk"])
+        self.index(["Milk is at the store"], contact="dad")
+
+        self.assertEqual(["Milk is at the store", "I'm at the store"], self.search("STORE")[0])
+        self.assertEqual(["Milk is at the store"], self.search("store dad")[0])
+        self.assertEqual(["I'm at the store"], self.search('"at the store" mom')[0])
+        self.assertEqual(["Don't forget the milk"], self.search("don't")[0])
+        self.assertEqual(["Milk is at the store"], self.search('"milk is"')[0])
+        self.assertEqual([], self.search('"the milk is"')[0])
+        self.assertEqual([], self.search("bread")[0])
+        self.assertEqual([], self.search("")[0])
+
+    def test_pagination(self):
+        self.index(["Message %d" % i for i in range(0, 5)])
+
+        results, cursor = self.search("message", limit=3)
+        self.assertEqual(["Message 4", "Message 3", "Message 2"], results)
+        results, cursor = self.search("message", before=cursor, limit=3)
+        self.assertEqual(["Message 1", "Message 0"], results)
+        self.assertEqual(None, cursor)
+
+    def test_chunks(self):
+        messagesearch.CHUNK_SIZE = 4
+        # One batch per message, so chunks fill up as they would with a steady trickle.
+        for i in range(0, 30):
+            self.index(["common %d" % i])
+        self.index(["rare common"])
+
+        searchTerm = SearchTerm.get_by_id("common")
+        self.assertEqual(31, searchTerm.docCount)
+        self.assertEqual(7, len(searchTerm.chunkFirstDocs))
+
+        self.assertEqual(["common 12"], self.search("12 common")[0])
+        self.assertEqual(["rare common"], self.search("common rare")[0])
+        self.assertEqual(31, len(self.search("common", limit=100)[0]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.api import memcache
+
+import config
+import models
+from models import Contact
+from util import phonenumberutils
+
+class DbContact(db.Model):
+    """ A Contact as stored by the old db API. """
+    name = db.StringProperty(required=True)
+    phoneNumber = db.StringProperty(required=True)
+    normalizedPhoneNumber = db.StringProperty(required=True)
+    subscribed = db.BooleanProperty(default=False, required=True)
+
+    @classmethod
+    def kind(cls):
+        return "Contact"
+
+class ContactTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        models._contactIndexes.clear()
+        models._numberFilters.clear()
+        models._migratedNamespaces.clear()
+        models._unmigratedNamespaces.clear()
+
+    def tearDown(self):
+        config.CONTACT_NUMBER_FILTER = False
+        self.testbed.deactivate()
+
+    def createContact(self, name, number):
+        contact = Contact(
+            name = name,
+            phoneNumber = phonenumberutils.toPrettyNumber(number),
+            normalizedPhoneNumber = phonenumberutils.toNormalizedNumber(number))
+        Contact.update(contact)
+        return contact
+
+    def searchNames(self, query):
+        return [contact['name'] for contact in Contact.search(query)]
+
+    def test_searchByName(self):
+        Contact.getDefaultSender()
+        self.createContact("mom", "+16135551234")
+        self.createContact("mike", "+16135555678")
+        self.createContact("dad", "+16135559999")
+
+        self.assertEqual(["mike", "mom"], self.searchNames("m"))
+        self.assertEqual(["mom"], self.searchNames("MO"))
+        self.assertEqual([], self.searchNames("x"))
+
+    def test_searchByNumberSuffix(self):
+        self.createContact("mom", "+16135551234")
+        self.createContact("mike", "+16135559934")
+
+        self.assertEqual(["mom"], self.searchNames("1234"))
+        self.assertEqual(["mom"], self.searchNames("555-1234"))
+        self.assertEqual(["mike", "mom"], sorted(self.searchNames("34")))
+        self.assertEqual([], self.searchNames("6135"))
+
+    def test_indexKeptUpToDate(self):
+        mom = self.createContact("mom", "+16135551234")
+        self.assertEqual(["mom"], self.searchNames("m"))
+
+        # Built index should be updated in place.
+        self.createContact("mike", "+16135555678")
+        self.assertEqual(["mike", "mom"], self.searchNames("m"))
+
+        mom.name = "mother"
+        Contact.update(mom)
+        self.assertEqual(["mike", "mother"], self.searchNames("m"))
+
+        mom.delete()
+        self.assertEqual(["mike"], self.searchNames("m"))
+        self.assertEqual(None, Contact.getByName("mother"))
+
+    def test_indexRebuiltAfterChangeElsewhere(self):
+        self.createContact("mom", "+16135551234")
+        self.assertEqual(["mom"], self.searchNames("m"))
+
+        # Simulate another instance changing the contacts.
+        memcache.incr(models._CONTACT_GENERATION_MEMCACHE_KEY)
+        Contact(name="mike", phoneNumber="(613)555-5678", normalizedPhoneNumber="+16135555678").put()
+        models._contactIndexes._entries[''][1] = 0
+
+        self.assertEqual(["mike", "mom"], self.searchNames("m"))
+
+    def test_updateWithoutRenameSkipsGet(self):
+        self.createContact("mom", "+16135551234")
+        ndb.get_context().clear_cache()
+        mom = Contact.getByName("mom")
+
+        gets = []
+        def countGets(service, call, request, response):
+            if call == "Get":
+                gets.append(service)
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("countGets", countGets)
+        try:
+            mom.subscribed = True
+            Contact.update(mom)
+        finally:
+            apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+
+        self.assertEqual([], gets)
+        ndb.get_context().clear_cache()
+        self.assertTrue(Contact.getByName("mom").subscribed)
+        self.assertTrue(Contact.getByPhoneNumber("+16135551234").subscribed)
+
+    def test_renamedContactNotFoundByOldName(self):
+        mom = self.createContact("mom", "+16135551234")
+
+        mom.name = "mother"
+        mom.phoneNumber = "(613)555-9999"
+        Contact.update(mom)
+        ndb.get_context().clear_cache()
+
+        self.assertEqual(None, Contact.getByName("mom"))
+        self.assertEqual(None, Contact.getByPhoneNumber("+16135551234"))
+        self.assertEqual("mother", Contact.getByName("mother").name)
+        self.assertEqual("mother", Contact.getByPhoneNumber("+16135559999").name)
+
+    def test_dbContactsStillFound(self):
+        dbContact = DbContact(name="mom", phoneNumber="(613)555-1234", normalizedPhoneNumber="+16135551234")
+        dbContact.put()
+
+        mom = Contact.getByPhoneNumber("(613)555-1234")
+        self.assertEqual("mom", mom.name)
+        self.assertEqual(dbContact.key().id(), mom.key.id())
+
+        # Finding the contact should have indexed it.
+        self.assertEqual(mom.key, models.ContactNumberIndex.get_by_id("+16135551234").contact)
+        self.assertEqual(mom.key, models.ContactNameIndex.get_by_id("mom").contact)
+
+    def test_duplicatesRejected(self):
+        self.createContact("mom", "+16135551234")
+        mike = self.createContact("mike", "+16135555678")
+
+        with self.assertRaises(models.ContactExistsException) as context:
+            self.createContact("mom", "+16135559999")
+        self.assertEqual("name", context.exception.propertyName)
+        with self.assertRaises(models.ContactExistsException) as context:
+            self.createContact("mother", "(613)555-1234")
+        self.assertEqual("phoneNumber", context.exception.propertyName)
+        self.assertEqual("mom", context.exception.contact.name)
+
+        mike.name = "mom"
+        with self.assertRaises(models.ContactExistsException):
+            Contact.update(mike)
+
+        ndb.get_context().clear_cache()
+        self.assertEqual(2, Contact.query().count())
+        self.assertEqual("+16135555678", Contact.getByName("mike").normalizedPhoneNumber)
+        self.assertEqual(None, Contact.getByPhoneNumber("+16135559999"))
+
+    def test_duplicateOfUnindexedContactRejected(self):
+        DbContact(name="mom", phoneNumber="(613)555-1234", normalizedPhoneNumber="+16135551234").put()
+
+        with self.assertRaises(models.ContactExistsException):
+            self.createContact("mother", "+16135551234")
+
+    def test_newNamespaceNeedsNoMigration(self):
+        defaultSender = Contact.getDefaultSender()
+        self.assertTrue(models.ContactIndexState.isMigrated())
+        self.assertEqual(defaultSender.key, Contact.getByName("xmppVoiceMail").key)
+
+        queries = []
+        def countQueries(service, call, request, response):
+            if call == "RunQuery":
+                queries.append(service)
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("countQueries", countQueries)
+        try:
+            self.assertEqual(None, Contact.getByPhoneNumber("+16135551234"))
+            self.assertEqual(None, Contact.getByName("mom"))
+        finally:
+            apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+        self.assertEqual([], queries)
+
+    def test_unknownNumberCached(self):
+        self.assertEqual(None, Contact.getByPhoneNumber("(613)555-1234"))
+        self.assertEqual(True, memcache.get(
+            models._CONTACT_NOT_FOUND_MEMCACHE_KEY + "ContactNumberIndex:+16135551234"))
+        self.assertEqual(None, Contact.getByPhoneNumber("+16135551234"))
+
+        # Creating the contact should replace the cached miss.
+        self.createContact("mom", "+16135551234")
+        ndb.get_context().clear_cache()
+        self.assertEqual("mom", Contact.getByPhoneNumber("+16135551234").name)
+
+    def test_updateAfterChangingCachedContact(self):
+        contact = self.createContact("mom", "+16135551234")
+        ndb.get_context().clear_cache()
+
+        contact = Contact.getByName("mom")
+        contact.name = "mother"
+        # The context cache hands back the changed contact; it must still
+        # know it's stored as "mom".
+        sameContact = contact.key.get()
+        Contact.update(sameContact)
+
+        ndb.get_context().clear_cache()
+        self.assertEqual(None, Contact.getByName("mom"))
+        self.assertEqual("mother", Contact.getByName("mother").name)
+
+    def test_numberFilter(self):
+        config.CONTACT_NUMBER_FILTER = True
+        self.createContact("mom", "+16135551234")
+        memcache.flush_all()
+        ndb.get_context().clear_cache()
+
+        self.assertEqual(None, Contact.getByPhoneNumber("+16135559999"))
+        self.assertEqual("mom", Contact.getByPhoneNumber("+16135551234").name)
+
+        # Contacts added after the filter is built should still be found.
+        self.createContact("mike", "+16135555678")
+        ndb.get_context().clear_cache()
+        self.assertEqual("mike", Contact.getByPhoneNumber("+16135555678").name)
+
+    def test_numberFilterBuiltBeforeQuerySeesContact(self):
+        config.CONTACT_NUMBER_FILTER = True
+        datastoreStub = self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME)
+        datastoreStub.SetConsistencyPolicy(datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0))
+        self.createContact("mom", "+16135551234")
+        memcache.flush_all()
+        models._numberFilters.clear()
+        ndb.get_context().clear_cache()
+
+        # The filter's query didn't see mom, but the filter isn't trusted yet.
+        self.assertEqual(None, Contact.getByPhoneNumber("+16135559999"))
+        self.assertEqual("mom", Contact.getByPhoneNumber("+16135551234").name)
+
+        # Once it has settled, it's rebuilt, and then rules out strangers.
+        datastoreStub.SetConsistencyPolicy(datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        numberFilter = models._numberFilters.get()
+        numberFilter.settleTime = 1
+        ndb.get_context().clear_cache()
+        self.assertEqual("mom", Contact.getByPhoneNumber("+16135551234").name)
+        self.assertEqual(None, numberFilter.settleTime)
+        self.assertTrue(numberFilter.excludes("+16135559999"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import threading
+import time
+import unittest
+
+from util.notifier import Notifier
+
+class NotifierTestCases(unittest.TestCase):
+    def test_waitWakesOnNotify(self):
+        notifier = Notifier()
+        results = []
+
+        waiter = threading.Thread(target=lambda: results.append(notifier.wait("log", 0, 10)))
+        waiter.start()
+        time.sleep(0.05)
+        start = time.time()
+        notifier.notify("other")
+        notifier.notify("log", 7)
+        waiter.join()
+
+        self.assertEqual([7], results)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_waitTimesOut(self):
+        notifier = Notifier()
+        notifier.notify("log")
+        self.assertEqual(1, notifier.wait("log", 1, 0.05))
+
+        # Already newer, so no need to wait.
+        self.assertEqual(1, notifier.wait("log", 0, 10))
+
+    def test_versionNeverGoesBack(self):
+        notifier = Notifier()
+        notifier.notify("log", 5)
+        notifier.notify("log", 3)
+        self.assertEqual(5, notifier.getVersion("log"))
+        notifier.notify("log")
+        self.assertEqual(6, notifier.getVersion("log"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import time
+import unittest
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import testbed
+
+from xmppvoicemail import Owner
+from models import Contact, OwnerAccount
+from owners import OwnerRegistry
+
+class OwnerRegistryTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_app_identity_stub()
+
+        self.defaultOwner = Owner("+16135554444", "user@gmail.com", "user@test.com")
+        self.secondNumber = "+16135556666"
+        OwnerAccount.create(self.secondNumber, "second@gmail.com", "Second@Test.com", 10)
+
+    def tearDown(self):
+        namespace_manager.set_namespace("")
+        self.testbed.deactivate()
+
+    def test_singleOwner(self):
+        owners = OwnerRegistry(self.defaultOwner)
+        self.assertTrue(owners.getByPhoneNumber(self.secondNumber) is owners.getDefault())
+        self.assertTrue(owners.getByJid("second@gmail.com") is owners.getDefault())
+
+    def test_multiOwner(self):
+        owners = OwnerRegistry(self.defaultOwner, multiOwner=True)
+        self.assertTrue(owners.getByPhoneNumber("(613)555-4444") is owners.getDefault())
+
+        voiceMail = owners.getByPhoneNumber("(613)555-6666")
+        self.assertEqual("second@gmail.com", voiceMail.getOwner().jid)
+        self.assertEqual("owner16135556666", voiceMail.getOwner().namespace)
+
+        # Should be cached, and findable by JID or email.
+        self.assertTrue(owners.getByPhoneNumber(self.secondNumber) is voiceMail)
+        self.assertEqual(self.secondNumber, owners.getByJid("second@gmail.com").getOwner().phoneNumber)
+        self.assertEqual(self.secondNumber,
+                         owners.getByEmail('"Second" <second@test.com>').getOwner().phoneNumber)
+
+        self.assertEqual(None, owners.getByPhoneNumber("+16135557777"))
+        self.assertEqual(None, owners.getByJid("stranger@gmail.com"))
+
+    def test_newOwnerFoundSoon(self):
+        owners = OwnerRegistry(self.defaultOwner, multiOwner=True)
+        self.assertEqual(None, owners.getByPhoneNumber("+16135557777"))
+
+        # Created on another instance, which can't clear our cache.
+        OwnerAccount.create("+16135557777", "third@gmail.com", "third@test.com", 10)
+        expiry, voiceMail = owners._cache[("number", "+16135557777")]
+        self.assertTrue(expiry <= time.time() + 5)
+        owners._cache[("number", "+16135557777")] = (time.time() - 1, voiceMail)
+        self.assertEqual("third@gmail.com", owners.getByPhoneNumber("+16135557777").getOwner().jid)
+
+    def test_contactsArePartitioned(self):
+        owners = OwnerRegistry(self.defaultOwner, multiOwner=True)
+        voiceMail = owners.getByPhoneNumber(self.secondNumber)
+
+        namespace_manager.set_namespace(voiceMail.getOwner().namespace)
+        Contact.update(Contact(name="mrtest", phoneNumber="+16135551234", normalizedPhoneNumber="+16135551234"))
+        self.assertTrue(Contact.getByName("mrtest"))
+
+        namespace_manager.set_namespace("")
+        self.assertEqual(None, Contact.getByName("mrtest"))
+        self.assertEqual(None, Contact.getByPhoneNumber("+16135551234"))
+
+if __name__ == '__main__':
+    unittest.main()
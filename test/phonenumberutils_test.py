@@ -0,0 +1,55 @@
+import unittest
+
+from util import phonenumberutils
+from util.phonenumberutils import toPrettyNumber, toNormalizedNumber, validateNumber
+
+class PhoneNumberUtilsTestCases(unittest.TestCase):
+    def test_northAmericanNumbers(self):
+        for number in ["6135551234", "(613)555-1234", "613.555.1234", "1-613-555-1234",
+                       "+1 613 555 1234", u"+16135551234"]:
+            self.assertTrue(validateNumber(number), number)
+            self.assertEqual("(613)555-1234", toPrettyNumber(number))
+            self.assertEqual("+16135551234", toNormalizedNumber(number))
+
+    def test_internationalNumbers(self):
+        for number, pretty, normalized in [
+                ("+44 20 7946 0958", "+44 20 7946 0958", "+442079460958"),
+                ("+447911123456", "+44 7911 123456", "+447911123456"),
+                ("011 44 20 7946 0958", "+44 20 7946 0958", "+442079460958"),
+                ("0033612345678", "+33 6 12 34 56 78", "+33612345678"),
+                ("+86 138 1234 5678", "+86 138 1234 5678", "+8613812345678"),
+                ("+61412345678", "+61 412 345 678", "+61412345678"),
+                # No format for this length; falls back to groups of three.
+                ("+3531234567", "+353 123 45 67", "+3531234567")]:
+            self.assertTrue(validateNumber(number), number)
+            self.assertEqual(pretty, toPrettyNumber(number))
+            self.assertEqual(normalized, toNormalizedNumber(number))
+            self.assertEqual((normalized, pretty), phonenumberutils.parseNumber(number))
+            # Formatting is stable.
+            self.assertEqual(pretty, toPrettyNumber(toNormalizedNumber(pretty)))
+
+    def test_invalidNumbers(self):
+        for number in ["mom", "(613)555-123a", "555-1234", "+28 1234567", "+44 12", "*", u"+1613555123\u00e9"]:
+            self.assertFalse(validateNumber(number), number)
+            self.assertEqual(number, toPrettyNumber(number))
+            self.assertEqual(None, phonenumberutils.parseNumber(number))
+
+    def test_parsedNumbersCached(self):
+        phonenumberutils._parsedNumbers.clear()
+        self.assertEqual(("+16135551234", "(613)555-1234"), phonenumberutils.parseNumber("613-555-1234"))
+        self.assertIn("613-555-1234", phonenumberutils._parsedNumbers)
+        self.assertEqual("(613)555-1234", toPrettyNumber("613-555-1234"))
+        self.assertEqual(None, phonenumberutils.parseNumber("mom"))
+        self.assertIn("mom", phonenumberutils._parsedNumbers)
+
+        for i in range(0, phonenumberutils._MAX_PARSED_NUMBERS + 1):
+            phonenumberutils.parseNumber("+1613555%04d" % i)
+        self.assertTrue(len(phonenumberutils._parsedNumbers) <= phonenumberutils._MAX_PARSED_NUMBERS)
+
+    def test_countryCodesArePrefixFree(self):
+        codes = phonenumberutils._getCountryFormats().keys()
+        for code in codes:
+            self.assertFalse([other for other in codes if other != code and other.startswith(code)], code)
+
+if __name__ == '__main__':
+    unittest.main()
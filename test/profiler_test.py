@@ -0,0 +1,87 @@
+import unittest
+
+from google.appengine.ext import testbed
+
+from util import requestcontext
+from util.profiler import Profiler, ProfilerMiddleware
+
+def _slowFunction():
+    total = 0
+    for i in xrange(0, 20000):
+        total += i
+    return total
+
+def _app(environ, start_response):
+    _slowFunction()
+    start_response("200 OK", [])
+    return ["OK"]
+
+def _callApp(app, headers=None):
+    environ = {"PATH_INFO": "/sms"}
+    environ.update(headers or {})
+    return app(environ, lambda status, headers, exc_info=None: None)
+
+class ProfilerTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        requestcontext.start()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_onlyProfilesWhenEnabled(self):
+        profiler = Profiler("secret", flushInterval=0)
+        app = ProfilerMiddleware(_app, profiler)
+        tokenHeader = {"HTTP_X_PROFILE_TOKEN": profiler.getToken()}
+
+        self.assertEqual(["OK"], _callApp(app, tokenHeader))
+        self.assertEqual(0, profiler.getStats()["requests"])
+
+        # With a sample rate of 0, only requests with the right token are profiled.
+        profiler.setSettings(True, 0, 60)
+        _callApp(app)
+        _callApp(app, {"HTTP_X_PROFILE_TOKEN": "wrong"})
+        self.assertEqual(0, profiler.getStats()["requests"])
+        _callApp(app, tokenHeader)
+        self.assertEqual(1, profiler.getStats()["requests"])
+
+        profiler.setSettings(True, 1, 60)
+        _callApp(app)
+        stats = profiler.getStats()
+        self.assertEqual(2, stats["requests"])
+        slowFunction = [function for function in stats["functions"] if "(_slowFunction)" in function["function"]]
+        self.assertEqual(1, len(slowFunction))
+        self.assertEqual(2, slowFunction[0]["calls"])
+        self.assertTrue(slowFunction[0]["function"].startswith("test/profiler_test.py:"), slowFunction[0])
+
+        profiler.clearStats()
+        self.assertEqual({"requests": 0, "functions": []}, profiler.getStats())
+
+    def test_settingsSharedAcrossInstances(self):
+        profiler = Profiler("secret", refreshInterval=0)
+        otherProfiler = Profiler("secret", refreshInterval=0)
+        profiler.setSettings(True, 0.5, 60)
+        self.assertEqual({"enabled": True, "sampleRate": 0.5}, otherProfiler.getSettings())
+
+    def test_statsMergedAcrossInstances(self):
+        profilers = [Profiler("secret", maxFunctions=5) for i in range(0, 3)]
+        profilers[1]._slot = profilers[0]._slot
+        for profiler in profilers:
+            profiler.setSettings(True, 1, 60)
+            app = ProfilerMiddleware(_app, profiler)
+            _callApp(app)
+            _callApp(app)
+            profiler.flush()
+
+        stats = profilers[0].getStats(limit=100)
+        self.assertEqual(6, stats["requests"])
+        # Each slot only keeps the slowest functions.
+        self.assertTrue(len(stats["functions"]) <= 10, stats["functions"])
+        self.assertEqual(6, [function["calls"] for function in stats["functions"]
+                             if "(_slowFunction)" in function["function"]][0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import shutil
+import tempfile
+import unittest
+
+import recordings
+from recordings import FileRecordingStore, RecordingCache, RecordingNotFoundException
+
+TWILIO_URL = "https://api.twilio.com/2010-04-01/Accounts/AC123/Recordings/RE0123456789abcdef"
+
+class RecordingsTestCases(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fetched = []
+        self.recordingCache = RecordingCache(FileRecordingStore(self.directory), self.fetch)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, recordingSid):
+        self.fetched.append(recordingSid)
+        if recordingSid == "REmissing":
+            raise RecordingNotFoundException("Twilio returned 404")
+        return "0123456789"
+
+    def test_fetchedOnce(self):
+        self.assertEqual(10, self.recordingCache.getSize("RE1"))
+        self.assertEqual(10, self.recordingCache.getSize("RE1"))
+        self.assertEqual("2345", self.recordingCache.read("RE1", 2, 4))
+        self.assertEqual(["RE1"], self.fetched)
+
+        # Another instance finds the same copy.
+        otherCache = RecordingCache(FileRecordingStore(self.directory), self.fetch)
+        self.assertEqual(10, otherCache.getSize("RE1"))
+        self.assertEqual(["RE1"], self.fetched)
+
+    def test_missingRecordingNotStored(self):
+        self.assertRaises(RecordingNotFoundException, self.recordingCache.getSize, "REmissing")
+        self.assertRaises(RecordingNotFoundException, self.recordingCache.getSize, "REmissing")
+        self.assertEqual(["REmissing", "REmissing"], self.fetched)
+
+    def test_parseRange(self):
+        self.assertEqual(None, recordings.parseRange(None, 10))
+        self.assertEqual(None, recordings.parseRange("bytes=0-1,4-5", 10))
+        self.assertEqual((0, 9), recordings.parseRange("bytes=0-", 10))
+        self.assertEqual((2, 5), recordings.parseRange("bytes=2-5", 10))
+        self.assertEqual((2, 9), recordings.parseRange("bytes=2-100", 10))
+        self.assertEqual((7, 9), recordings.parseRange("bytes=-3", 10))
+        self.assertEqual((0, 9), recordings.parseRange("bytes=-30", 10))
+        self.assertRaises(ValueError, recordings.parseRange, "bytes=10-", 10)
+        self.assertRaises(ValueError, recordings.parseRange, "bytes=5-2", 10)
+
+    def test_proxyUrl(self):
+        url = recordings.getProxyUrl("https://example.appspot.com", TWILIO_URL)
+        self.assertTrue(url.startswith("https://example.appspot.com/recordings/RE0123456789abcdef.mp3?sig="), url)
+
+        signature = url.split("sig=")[1]
+        self.assertTrue(recordings.checkSignature("RE0123456789abcdef", signature))
+        self.assertFalse(recordings.checkSignature("RE0123456789abcdee", signature))
+        self.assertFalse(recordings.checkSignature("RE0123456789abcdef", None))
+
+        # Not a Twilio recording, so nothing to proxy.
+        self.assertEqual("http://example.com/foo", recordings.getProxyUrl("https://example.appspot.com", "http://example.com/foo"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from smsgateway import SmsRouter, FakeGateway, GatewayError
+from xmppvoicemail import Communications, SmsException
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class SmsGatewayTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_urlfetch_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def send(self, router, count=1):
+        return [router.sendAsync("+16135554444", "+16135551234", "Hello").get_result()
+                for i in range(0, count)]
+
+    def test_prefersFasterGateway(self):
+        slow = FakeGateway("slow", latency=0.03)
+        fast = FakeGateway("fast", latency=0.001)
+        router = SmsRouter([slow, fast])
+
+        # Both get tried, then the fast one gets everything.
+        self.send(router, 2)
+        self.assertEqual(["fast"] * 10, self.send(router, 10))
+        self.assertEqual(["fast", "slow"], [status["name"] for status in router.getStatus()])
+
+        # Once it slows down, the other one takes over.
+        fast.latency = 0.1
+        sent = self.send(router, 10)
+        self.assertEqual(["slow"] * 5, sent[-5:])
+
+    def test_failoverAndCircuitBreaker(self):
+        clock = FakeClock()
+        primary = FakeGateway("primary", errorRate=1)
+        backup = FakeGateway("backup")
+        router = SmsRouter([primary, backup], clock=clock, failureThreshold=3, openTime=30)
+
+        # Every message still gets through.
+        self.assertEqual(["backup"] * 10, self.send(router, 10))
+        self.assertEqual(10, len(backup.sent))
+
+        # After three failures in a row, the primary gets no more messages.
+        self.assertTrue(primary.attempts <= 3)
+        self.assertEqual("open", [status["state"] for status in router.getStatus()
+                                  if status["name"] == "primary"][0])
+        attempts = primary.attempts
+        self.send(router, 5)
+        self.assertEqual(attempts, primary.attempts)
+
+        # Once it's been open long enough, one message tries it again.
+        clock.now += 31
+        self.send(router)
+        self.assertEqual(attempts + 1, primary.attempts)
+        self.send(router, 5)
+        self.assertEqual(attempts + 1, primary.attempts)
+
+        # A successful trial closes the breaker.
+        primary.errorRate = 0
+        clock.now += 31
+        self.assertEqual(["primary"], self.send(router))
+        self.assertEqual("closed", router.getStatus()[0]["state"])
+
+    def test_unfinishedTrial(self):
+        clock = FakeClock()
+        primary = FakeGateway("primary", errorRate=1)
+        router = SmsRouter([primary, FakeGateway("backup")], clock=clock, failureThreshold=1, openTime=30)
+        self.send(router)
+        health = router._gateways[0][1]
+
+        # A trial whose request dies without an answer doesn't leave the gateway unused forever.
+        clock.now += 31
+        self.assertTrue(health.allowRequest(clock.now))
+        self.assertFalse(health.allowRequest(clock.now + 1))
+        clock.now += 31
+        primary.errorRate = 0
+        self.assertEqual(["primary"], self.send(router))
+
+    def test_timeoutNotFailedOver(self):
+        primary = FakeGateway("primary")
+        backup = FakeGateway("backup")
+        router = SmsRouter([primary, backup])
+
+        def timeOut(fromNumber, toNumber, body):
+            raise GatewayError(None, "Deadline exceeded", maybeSent=True)
+        primary.sendAsync = ndb.tasklet(timeOut)
+
+        # The primary might have sent it, so the backup mustn't.
+        with self.assertRaises(GatewayError) as context:
+            self.send(router)
+        self.assertTrue(context.exception.isRetryable())
+        self.assertEqual([], backup.sent)
+
+    def test_badMessageNotFailedOver(self):
+        primary = FakeGateway("primary", errorRate=1, statusCode=400)
+        backup = FakeGateway("backup", errorRate=1, statusCode=400)
+        router = SmsRouter([primary, backup])
+
+        for i in range(0, 5):
+            with self.assertRaises(GatewayError) as context:
+                self.send(router)
+            self.assertFalse(context.exception.isRetryable())
+
+        # Each message went to one gateway, and neither was blamed for it.
+        self.assertEqual(5, primary.attempts + backup.attempts)
+        self.assertEqual(["closed", "closed"], [status["state"] for status in router.getStatus()])
+
+    def test_allGatewaysDown(self):
+        router = SmsRouter([FakeGateway("one", errorRate=1), FakeGateway("two", errorRate=1)])
+        communications = Communications(router)
+        with self.assertRaises(SmsException) as context:
+            communications.sendSMS("+16135554444", "+16135551234", "Hello")
+        self.assertTrue(context.exception.isRetryable())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import logging
+import unittest
+
+import config
+from util import structlog
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class _CountingValue:
+    """ Counts how many times it's formatted. """
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "value"
+
+class StructLogTestCases(unittest.TestCase):
+    def setUp(self):
+        self.handler = _ListHandler()
+        self.logger = logging.getLogger("structlog_test")
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.log = structlog.getLogger("structlog_test")
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        config.LOG_SAMPLE_RATES = {}
+
+    def test_keyValueRecords(self):
+        self.log.info("sms.send", to="+16135551234", length=5)
+        self.log.warn("sms.retry", error="503: Unavailable", name=u"Andr\u00e9")
+        self.assertEqual(["sms.send length=5 to=+16135551234",
+                          'sms.retry error="503: Unavailable" name="Andr\\u00e9"'], self.handler.messages)
+
+    def test_onlyFormattedWhenLogged(self):
+        value = _CountingValue()
+        self.log.debug("xmpp.send", value=value)
+        self.assertEqual([], self.handler.messages)
+        self.assertEqual(0, value.formatted)
+
+        self.log.info("xmpp.send", value=value)
+        self.assertEqual(["xmpp.send value=value"], self.handler.messages)
+        self.assertEqual(1, value.formatted)
+
+    def test_sampling(self):
+        config.LOG_SAMPLE_RATES = {"sms.send": 0, "xmpp.send": 0.999999}
+        for i in range(0, 100):
+            self.log.info("sms.send", to="+16135551234")
+        self.log.info("xmpp.send")
+        self.log.info("email.send")
+        self.assertEqual(["xmpp.send sampleRate=0.999999", "email.send"], self.handler.messages)
+
+if __name__ == '__main__':
+    unittest.main()
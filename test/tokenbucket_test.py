@@ -0,0 +1,58 @@
+import unittest
+
+from google.appengine.ext import testbed
+
+from util.tokenbucket import MemCacheTokenBucket, reserveAll
+
+class TokenBucketTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_burstThenDelay(self):
+        bucket = MemCacheTokenBucket("test", rate=1, capacity=3)
+        for i in range(0, 3):
+            self.assertEqual(0, bucket.reserve())
+
+        # Out of tokens; each caller queues up behind the last one.
+        self.assertAlmostEqual(1, bucket.reserve(), places=1)
+        self.assertAlmostEqual(2, bucket.reserve(), places=1)
+
+        status = bucket.getStatus()
+        self.assertEqual(0, status["tokens"])
+        self.assertAlmostEqual(2, status["queuedDelay"], places=1)
+
+    def test_bucketsAreShared(self):
+        bucket1 = MemCacheTokenBucket("shared", rate=1, capacity=1)
+        bucket2 = MemCacheTokenBucket("shared", rate=1, capacity=1)
+        self.assertEqual(0, bucket1.reserve())
+        self.assertTrue(bucket2.reserve() > 0)
+
+    def test_reserveAllWaitsForSlowestBucket(self):
+        fast = MemCacheTokenBucket("fast", rate=10, capacity=1)
+        slow = MemCacheTokenBucket("slow", rate=1, capacity=1)
+        self.assertEqual(0, reserveAll([fast, slow]))
+        self.assertAlmostEqual(1, reserveAll([fast, slow]), places=1)
+
+        # Both buckets should have had a token taken each time.
+        self.assertAlmostEqual(0.2, fast.reserve(), places=1)
+        self.assertAlmostEqual(2, slow.reserve(), places=1)
+
+    def test_zeroRateIsUnlimited(self):
+        unlimited = MemCacheTokenBucket("unlimited", rate=0, capacity=1)
+        limited = MemCacheTokenBucket("limited", rate=1, capacity=1)
+        for i in range(0, 3):
+            self.assertEqual(0, unlimited.reserve())
+        self.assertEqual(0, unlimited.getStatus()["queuedDelay"])
+
+        # Only the limited bucket holds up reserveAll.
+        self.assertEqual(0, reserveAll([unlimited, limited]))
+        self.assertAlmostEqual(1, reserveAll([unlimited, limited]), places=1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from trafficrollup import TrafficRollups
+from models import TrafficRollup
+
+HOUR = 60 * 60
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000 * HOUR + 10.0
+
+    def __call__(self):
+        return self.now
+
+class TrafficRollupTestCases(unittest.TestCase):
+    def setUp(self):
+        # Set up Google App Engine testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        namespace_manager.set_namespace("")
+        self.testbed.deactivate()
+
+    def test_seriesFromSeveralInstances(self):
+        rollups = TrafficRollups(clock=self.clock, shardCount=2)
+        otherInstance = TrafficRollups(clock=self.clock, shardCount=2)
+        rollups._shard, otherInstance._shard = 0, 1
+
+        rollups.record("to", "sms", "mom")
+        otherInstance.record("to", "sms", "mom")
+        self.clock.now += HOUR
+        rollups.record("to", "sms", "mom")
+        rollups.record("from", "xmpp", "mom")
+        otherInstance.record("to", "sms", "(613)555-1234")
+        rollups.flush()
+        otherInstance.flush()
+        # One entity per hour for each shard.
+        self.assertEqual(4, TrafficRollup.query().count())
+
+        series = rollups.getSeries(hours=3)
+        self.assertEqual((self.clock.now // HOUR - 2) * HOUR * 1000, series["start"])
+        self.assertEqual(HOUR * 1000, series["interval"])
+        self.assertEqual([
+            {"direction": "from", "channel": "xmpp", "contact": "mom", "counts": [0, 0, 1]},
+            {"direction": "to", "channel": "sms", "contact": "(613)555-1234", "counts": [0, 0, 1]},
+            {"direction": "to", "channel": "sms", "contact": "mom", "counts": [0, 2, 1]}
+        ], series["series"])
+
+        series = rollups.getSeries(hours=2, groupBy=("contact",), channel="sms")
+        self.assertEqual([
+            {"contact": "(613)555-1234", "counts": [0, 1]},
+            {"contact": "mom", "counts": [2, 1]}
+        ], series["series"])
+
+        series = rollups.getSeries(hours=1, groupBy=())
+        self.assertEqual([{"counts": [3]}], series["series"])
+
+    def test_countsWrittenInBatches(self):
+        rollups = TrafficRollups(clock=self.clock, flushInterval=30)
+
+        for i in range(0, 5):
+            rollups.record("to", "sms", "mom")
+        self.assertEqual(0, TrafficRollup.query().count())
+        # Counts not written yet still show up on this instance.
+        self.assertEqual([5], rollups.getSeries(hours=1)["series"][0]["counts"])
+
+        self.clock.now += 31
+        rollups.record("to", "sms", "mom")
+        self.assertEqual(1, TrafficRollup.query().count())
+        self.assertEqual({"to|sms|mom": 6}, TrafficRollup.query().get().counts)
+
+        rollups.record("to", "sms", "mom")
+        self.assertEqual([7], rollups.getSeries(hours=1)["series"][0]["counts"])
+
+    def test_namespaces(self):
+        rollups = TrafficRollups(clock=self.clock)
+        rollups.record("to", "sms", "mom")
+        namespace_manager.set_namespace("16135556666")
+        rollups.record("to", "email", "dad")
+        rollups.flush()
+
+        self.assertEqual([{"contact": "dad", "counts": [1]}],
+                         rollups.getSeries(hours=1, groupBy=("contact",))["series"])
+        namespace_manager.set_namespace("")
+        self.assertEqual([{"contact": "mom", "counts": [1]}],
+                         rollups.getSeries(hours=1, groupBy=("contact",))["series"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,24 @@
+import os
 import unittest
 
 from google.appengine.api import app_identity
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.api import xmpp
 
 
-from xmppvoicemail import Owner, XmppVoiceMail, InvalidParametersException, PermissionException
-from models import Contact
+from xmppvoicemail import Owner, XmppVoiceMail, InvalidParametersException, PermissionException, SmsException
+from models import Contact, BroadcastList, DigestItem
 from util import phonenumberutils
+from util import requestcontext
+import smsqueue
+import digest
+import conversations
+from trafficrollup import TrafficRollups
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
 
 class CommunicationsFixture:
     def __init__(self):
@@ -15,6 +26,9 @@ class CommunicationsFixture:
         self.xmppMessages = []
         self.xmppInvites = []
         self.sms = []
+        self.smsErrors = []
+        self.smsInFlight = 0
+        self.maxSmsInFlight = 0
         self.ownerOnline = True
     
     def sendMail(self, sender, to, subject, body):
@@ -43,11 +57,24 @@ class CommunicationsFixture:
         return self.ownerOnline
 
     def sendSMS(self, fromNumber, toNumber, body):
+        if self.smsErrors:
+            raise self.smsErrors.pop(0)
         self.sms.append({
             "toNumber": toNumber,
             "body": body
         })
 
+    @ndb.tasklet
+    def sendSMSAsync(self, fromNumber, toNumber, body):
+        self.smsInFlight += 1
+        self.maxSmsInFlight = max(self.maxSmsInFlight, self.smsInFlight)
+        try:
+            # Let other sends start, like a real RPC would.
+            yield ndb.sleep(0)
+            self.sendSMS(fromNumber, toNumber, body)
+        finally:
+            self.smsInFlight -= 1
+
 class XmppVoiceMailTestCases(unittest.TestCase):
     def setUp(self):
         # Set up Google App Engine testbed
@@ -56,6 +83,10 @@ class XmppVoiceMailTestCases(unittest.TestCase):
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
         self.testbed.init_app_identity_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().clear_cache()
+        digest._queuedTasks.clear()
+        requestcontext.start()
         
         self.contactNumber = "+16135551234"
         
@@ -87,7 +118,8 @@ class XmppVoiceMailTestCases(unittest.TestCase):
             phoneNumber = self.contactNumber,
             normalizedPhoneNumber=phonenumberutils.toNormalizedNumber(self.contactNumber),
             subscribed=subscribed)
-        Contact.update(c)        
+        Contact.update(c)
+        return c
         
     def test_incomingSmsMessageFromUnknownUser(self):
         """
@@ -211,8 +243,10 @@ class XmppVoiceMailTestCases(unittest.TestCase):
         """
         Test an incoming XMPP to a contact.
         """
-        self.createContact(subscribed=False)
-        self.createContact(subscribed=True)
+        # Contacts can't share a name, so the second save updates the first.
+        contact = self.createContact(subscribed=False)
+        contact.subscribed = True
+        Contact.update(contact)
 
         self.xmppvoicemail.handleIncomingXmpp(
             sender=self.ownerJid,
@@ -225,6 +259,34 @@ class XmppVoiceMailTestCases(unittest.TestCase):
         self.assertEqual("+16135551234", sms["toNumber"])
         self.assertEqual("Hello", sms["body"])
 
+    def test_trafficCounted(self):
+        """
+        Test messages are counted by direction, channel and contact.
+        """
+        rollups = self.xmppvoicemail._traffic = TrafficRollups()
+        self.createContact(subscribed=True)
+
+        self.xmppvoicemail.handleIncomingSms(self.contactNumber, self.ownerPhoneNumber, "Hello")
+        self.xmppvoicemail.handleIncomingSms("+16135559999", self.ownerPhoneNumber, "Hello")
+        self.xmppvoicemail.handleIncomingXmpp(
+            sender=self.ownerJid,
+            to='mrtest' + self.XMPP_SUFFIX,
+            messageBody="Hi")
+
+        self.xmppvoicemail.sendSMS(None, self.contactNumber, "Bye")
+
+        # Each message is counted once, under the channel it came in over.
+        series = rollups.getSeries(hours=1)["series"]
+        self.assertEqual([
+            ("from", "web", "mrtest"),
+            ("from", "xmpp", "mrtest"),
+            ("to", "sms", "(613)555-9999"),
+            ("to", "sms", "mrtest")
+        ], [(item["direction"], item["channel"], item["contact"]) for item in series])
+        self.assertEqual([[1]] * 4, [item["counts"] for item in series])
+        self.assertEqual([{"contact": "(613)555-9999", "counts": [1]}, {"contact": "mrtest", "counts": [3]}],
+                         rollups.getSeries(hours=1, groupBy=("contact",))["series"])
+
     def test_incomingXmppForInvalidNumber(self):
         """
         Test an incoming XMPP to the default sender, with an invalid number
@@ -238,6 +300,115 @@ class XmppVoiceMailTestCases(unittest.TestCase):
                 to=defaultSender.name + self.XMPP_SUFFIX,
                 messageBody="(613)555-123a: Hello")
 
+    def test_incomingXmppForSeveralRecipients(self):
+        """
+        Test an incoming XMPP to the default sender for numbers, contacts and
+        lists, which is sent to each number once, with one report back.
+        """
+        self.createContact(subscribed=True)
+        BroadcastList(id="family", members=["mrtest", "+16135552222"]).put()
+        self.xmppvoicemail._fanOutConcurrency = 2
+        self.disableRateLimit()
+
+        defaultSender = Contact.getDefaultSender()
+        self.xmppvoicemail.handleIncomingXmpp(
+            sender=self.ownerJid,
+            to=defaultSender.name + self.XMPP_SUFFIX,
+            messageBody="(613)555-1111, MrTest,family: Hello")
+
+        self.assertEqual(["+16135551111", "+16135551234", "+16135552222"],
+                         sorted(sms["toNumber"] for sms in self.communications.sms))
+        self.assertEqual(["Hello"] * 3, [sms["body"] for sms in self.communications.sms])
+        self.assertEqual(2, self.communications.maxSmsInFlight)
+
+        self.assertEqual(1, len(self.communications.xmppMessages), "Should have sent one report")
+        self.assertEqual("Sent to 3 of 3 recipients.", self.communications.xmppMessages[0]["message"])
+        self.assertEqual(1, conversations.getConversation(self.contactNumber).messageCount)
+
+    def test_incomingXmppForSeveralRecipientsWithFailure(self):
+        """
+        Test that failures sending to some recipients are reported together.
+        """
+        self.communications.smsErrors = [SmsException(400, "Invalid number")]
+        self.disableRateLimit()
+
+        defaultSender = Contact.getDefaultSender()
+        self.xmppvoicemail.handleIncomingXmpp(
+            sender=self.ownerJid,
+            to=defaultSender.name + self.XMPP_SUFFIX,
+            messageBody="6135551111,6135552222: Hello")
+
+        self.assertEqual(["+16135552222"], [sms["toNumber"] for sms in self.communications.sms])
+        self.assertEqual(1, len(self.communications.xmppMessages), "Should have sent one report")
+        self.assertEqual("Sent to 1 of 2 recipients. Failed: (613)555-1111 (400: Invalid number)",
+                         self.communications.xmppMessages[0]["message"])
+
+        with self.assertRaises(InvalidParametersException):
+            self.xmppvoicemail.handleIncomingXmpp(
+                sender=self.ownerJid,
+                to=defaultSender.name + self.XMPP_SUFFIX,
+                messageBody="6135551111,nobody: Hello")
+
+    def test_conversationRecorded(self):
+        """
+        Test that messages to and from a number are added to its conversation.
+        """
+        self.createContact(subscribed=True)
+
+        self.xmppvoicemail.handleIncomingSms(self.contactNumber, self.ownerPhoneNumber, "Hello")
+        self.xmppvoicemail.handleIncomingSms("+16135559999", self.ownerPhoneNumber, "Who is this?")
+        self.xmppvoicemail.handleIncomingXmpp(self.ownerJid, "mrtest" + self.XMPP_SUFFIX, "Hi")
+
+        messages, cursor = conversations.getMessages(self.contactNumber)
+        self.assertEqual([("from", "Hi"), ("to", "Hello")],
+                         [(message.direction, message.message) for message in messages])
+        self.assertEqual("mrtest", conversations.getConversation(self.contactNumber).name)
+
+        stranger = conversations.getConversation("+16135559999")
+        self.assertEqual("(613)555-9999", stranger.name)
+        self.assertEqual(1, stranger.unreadCount)
+
+    def test_logSince(self):
+        """
+        Test fetching and waiting for log items newer than ones we've seen.
+        """
+        voiceMail = XmppVoiceMail(Owner(self.ownerPhoneNumber, self.ownerJid, self.ownerEmailAddress, logSize=10))
+        voiceMail._communications = self.communications
+
+        voiceMail.handleIncomingSms(self.contactNumber, self.ownerPhoneNumber, "First")
+        items, lastId = voiceMail.getNewLog()
+        self.assertEqual(["First"], [item.message for item in items])
+        voiceMail.handleIncomingSms(self.contactNumber, self.ownerPhoneNumber, "Second")
+        voiceMail.handleIncomingSms(self.contactNumber, self.ownerPhoneNumber, "Third")
+
+        self.assertEqual(["First", "Second", "Third"], [item.message for item in voiceMail.getLog()])
+        self.assertEqual(["Second", "Third"], [item.message for item in voiceMail.getNewLog(lastId)[0]])
+
+        items, newLastId = voiceMail.waitForLog(lastId, 10)
+        self.assertEqual(["Second", "Third"], [item.message for item in items])
+        self.assertEqual(([], newLastId), voiceMail.getNewLog(newLastId))
+
+        # Nothing new.
+        self.assertEqual(([], newLastId), voiceMail.waitForLog(newLastId, 0.05))
+
+    def test_logCounterAheadOfItems(self):
+        """
+        Test that a poller doesn't skip an item whose sequence number was taken before it was logged.
+        """
+        voiceMail = XmppVoiceMail(Owner(self.ownerPhoneNumber, self.ownerJid, self.ownerEmailAddress, logSize=10))
+        voiceMail._communications = self.communications
+
+        for message in ["First", "Second", "Third", "Fourth"]:
+            voiceMail.handleIncomingSms(self.contactNumber, self.ownerPhoneNumber, message)
+        items, lastId = voiceMail.getNewLog()
+        # Another instance takes the next sequence number in a shard, but
+        # hasn't added its item yet.
+        messageLog = voiceMail._messageLog
+        memcache.incr(messageLog._counterKey(0), namespace=voiceMail._logNamespace)
+
+        self.assertEqual(([], lastId), voiceMail.getNewLog(lastId))
+        self.assertEqual(([], lastId), voiceMail.waitForLog(lastId, 0.05))
+
     def test_incomingXmppFromBadUser(self):
         """
         Test an incoming email to the default sender with a number in the message body.
@@ -286,6 +457,20 @@ class XmppVoiceMailTestCases(unittest.TestCase):
         self.assertEqual("+16135551234", sms["toNumber"])
         self.assertEqual("Hello", sms["body"])
 
+    def test_incomingEmailForUnknownNumber(self):
+        """
+        Test a reply to an email from a number with no contact.
+        """
+        self.xmppvoicemail.handleIncomingEmail(
+            sender=self.ownerEmailAddress,
+            to="16135559999" + self.MAIL_SUFFIX,
+            subject="Re: Hello",
+            messageBody="Hi there")
+
+        self.assertEqual(1, len(self.communications.sms), "Should have sent an SMS")
+        self.assertEqual("+16135559999", self.communications.sms[0]["toNumber"])
+        self.assertEqual("Hi there", self.communications.sms[0]["body"])
+
     def test_incomingEmailFromBadUser(self):
         """
         Test an incoming email to the default sender with a number in the message body.
@@ -304,6 +489,160 @@ class XmppVoiceMailTestCases(unittest.TestCase):
         
 
 
+    def test_outgoingSmsQueuedWhenRateLimited(self):
+        """
+        Test that SMS messages over the rate limit are queued instead of sent.
+        """
+        self.xmppvoicemail._rateLimiter = smsqueue.SmsRateLimiter(self.ownerPhoneNumber,
+            rate=1, burst=1, perNumberRate=1, perNumberBurst=1)
+
+        self.xmppvoicemail.sendSMS(None, self.contactNumber, "First")
+        self.xmppvoicemail.sendSMS(None, self.contactNumber, "Second")
+
+        self.assertEqual(1, len(self.communications.sms), "Should have sent one SMS")
+        self.assertEqual("First", self.communications.sms[0]["body"])
+
+        tasks = self.getSendSmsTasks()
+        self.assertEqual(1, len(tasks), "Should have queued one SMS")
+
+        # Run the task
+        self.xmppvoicemail.sendPendingSMS(tasks[0].extract_params()["id"])
+        self.assertEqual(2, len(self.communications.sms))
+        self.assertEqual("Second", self.communications.sms[1]["body"])
+        self.assertEqual(0, len(self.communications.xmppMessages), "Should not report a rate limited message")
+
+    def test_outgoingSmsRetriedAfterTemporaryError(self):
+        """
+        Test that an SMS which fails with a temporary error is retried, and the owner
+        gets a single report once it's sent.
+        """
+        self.communications.smsErrors = [SmsException(503, "Unavailable"), SmsException(None, "Timeout")]
+        self.disableRateLimit()
+
+        self.xmppvoicemail.sendSMS(None, self.contactNumber, "Hello")
+        self.assertEqual(0, len(self.communications.sms))
+
+        self.runSendSmsTasks()
+        self.assertEqual(1, len(self.communications.sms), "Should have sent SMS")
+        self.assertEqual("Hello", self.communications.sms[0]["body"])
+
+        self.assertEqual(1, len(self.communications.xmppMessages), "Should have sent one report")
+        self.assertIn("3 attempts", self.communications.xmppMessages[0]["message"])
+
+    def test_outgoingSmsGivesUpAfterMaxAttempts(self):
+        """
+        Test that we stop retrying an SMS eventually, and report the failure to the owner once.
+        """
+        self.communications.smsErrors = [SmsException(500, "Error")] * smsqueue.MAX_SEND_ATTEMPTS
+        self.disableRateLimit()
+
+        self.xmppvoicemail.sendSMS(None, self.contactNumber, "Hello")
+        self.runSendSmsTasks()
+
+        self.assertEqual(0, len(self.communications.sms))
+        self.assertEqual(1, len(self.communications.xmppMessages), "Should have sent one report")
+        self.assertIn("Could not send message", self.communications.xmppMessages[0]["message"])
+
+    def test_outgoingSmsPermanentErrorNotRetried(self):
+        """
+        Test that an SMS which fails with a permanent error is not retried.
+        """
+        self.communications.smsErrors = [SmsException(400, "Invalid number")]
+
+        self.xmppvoicemail.sendSMS(None, self.contactNumber, "Hello")
+
+        self.assertEqual(0, len(self.getSendSmsTasks()), "Should not have queued a retry")
+        self.assertEqual(0, len(self.communications.sms))
+
+    def test_emailDigest(self):
+        """
+        Test that messages for an offline owner are collected into one email, grouped by sender.
+        """
+        self.xmppvoicemail._digestWindow = 300
+        self.communications.ownerOnline = False
+        self.createContact(subscribed=True)
+        # The digest has to find every message, even if queries lag behind writes.
+        self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME).SetConsistencyPolicy(
+            datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0))
+
+        self.xmppvoicemail.handleIncomingSms(self.contactNumber, self.ownerPhoneNumber, "Hello")
+        self.xmppvoicemail.handleIncomingSms("+16135559999", self.ownerPhoneNumber, "Who is this?")
+        self.xmppvoicemail.handleIncomingSms(self.contactNumber, self.ownerPhoneNumber, "Call me")
+        self.assertEqual(0, len(self.communications.mails), "Should not have sent any email yet")
+
+        tasks = self.getDigestTasks()
+        self.assertEqual(1, len(tasks), "Should have queued one digest")
+        self.xmppvoicemail.sendDigest(int(tasks[0].extract_params()["window"]))
+
+        self.assertEqual(1, len(self.communications.mails), "Should have sent one email")
+        mail = self.communications.mails[0]
+        self.assertEqual('"' + Contact.getDefaultSender().name + '" <' + Contact.getDefaultSender().name + self.MAIL_SUFFIX + '>',
+                         mail["sender"])
+        self.assertEqual("3 messages from mrtest, (613)555-9999", mail["subject"])
+        self.assertIn("mrtest - reply to 16135551234" + self.MAIL_SUFFIX, mail["body"])
+        self.assertIn("(613)555-9999 - reply to 16135559999" + self.MAIL_SUFFIX, mail["body"])
+        self.assertTrue(mail["body"].index("Hello") < mail["body"].index("Call me") < mail["body"].index("(613)555-9999"))
+
+        # Messages are only sent once.
+        self.xmppvoicemail.sendDigest(int(tasks[0].extract_params()["window"]))
+        self.assertEqual(1, len(self.communications.mails))
+
+    def test_lateDigestItemSentNextTime(self):
+        """
+        Test that a message stored after its window's digest went out is in the next digest.
+        """
+        self.xmppvoicemail._digestWindow = 300
+        self.communications.ownerOnline = False
+
+        self.xmppvoicemail.handleIncomingSms("+16135559999", self.ownerPhoneNumber, "Hello")
+        window = int(self.getDigestTasks()[0].extract_params()["window"])
+        self.xmppvoicemail.sendDigest(window)
+        DigestItem(parent=ndb.Key("DigestWindow", str(window) + ":0"), window=window,
+                   fromName="(613)555-9999", fromAddress="16135559999" + self.MAIL_SUFFIX, message="Late").put()
+
+        self.xmppvoicemail.sendDigest(window + 1)
+        self.assertEqual(2, len(self.communications.mails))
+        self.assertIn("Late", self.communications.mails[1]["body"])
+
+    def test_emailDigestFromOneSender(self):
+        """
+        Test that a digest of messages from one sender can be replied to directly.
+        """
+        self.xmppvoicemail._digestWindow = 300
+        self.communications.ownerOnline = False
+
+        self.xmppvoicemail.handleIncomingSms("+16135559999", self.ownerPhoneNumber, "Hello")
+        self.xmppvoicemail.handleIncomingSms("+16135559999", self.ownerPhoneNumber, "Hello?")
+        self.xmppvoicemail.sendDigest(int(self.getDigestTasks()[0].extract_params()["window"]))
+
+        self.assertEqual(1, len(self.communications.mails), "Should have sent one email")
+        self.assertIn("<16135559999" + self.MAIL_SUFFIX + ">", self.communications.mails[0]["sender"])
+        self.assertEqual("2 messages from (613)555-9999", self.communications.mails[0]["subject"])
+
+    def disableRateLimit(self):
+        self.xmppvoicemail._rateLimiter = smsqueue.SmsRateLimiter(self.ownerPhoneNumber,
+            rate=1000, burst=1000, perNumberRate=1000, perNumberBurst=1000)
+
+    def getSendSmsTasks(self):
+        taskqueueStub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        return taskqueueStub.get_filtered_tasks(url=smsqueue.SEND_SMS_TASK_URL)
+
+    def getDigestTasks(self):
+        taskqueueStub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        return taskqueueStub.get_filtered_tasks(url=digest.SEND_DIGEST_TASK_URL)
+
+    def runSendSmsTasks(self):
+        """ Run queued send SMS tasks until there are none left. """
+        taskqueueStub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        while True:
+            tasks = self.getSendSmsTasks()
+            if not tasks:
+                break
+            taskqueueStub.FlushQueue("default")
+            for task in tasks:
+                self.xmppvoicemail.sendPendingSMS(task.extract_params()["id"])
+
+
 # TODO: Incoming email tests
 
         
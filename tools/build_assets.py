@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Builds the admin UI into assets/dist, ready to deploy.
+#
+# Run from anywhere:
+#
+#     python tools/build_assets.py
+#
+# This compiles xmppVoiceMail.coffee (if the "coffee" compiler is on your
+# PATH), minifies it (if "uglifyjs" is), and bundles it with jQuery,
+# Underscore, Backbone and the templates from index.html into one file,
+# assets/dist/js/app.<hash>.js.  <hash> comes from the file's contents, so the
+# file can be cached forever; any change gets a new name.
+# assets/dist/index.html is index.html, loading that one file instead.
+#
+# Without coffee, the checked in xmppVoiceMail.js is used.  Without uglifyjs,
+# the app's script is bundled as is; the libraries are already minified.
+#
+import hashlib
+import json
+import optparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ASSETS = os.path.join(ROOT, "assets")
+DIST = os.path.join(ASSETS, "dist")
+
+# Scripts loaded by index.html, and the already minified versions to bundle instead.
+LIBRARIES = [
+    ("js/jquery-1.8.2.min.js", "js/jquery-1.8.2.min.js"),
+    ("js/underscore-1.4.2.min.js", "js/underscore-1.4.2.min.js"),
+    ("js/backbone-0.9.2.js", "js/backbone-min-0.9.2.js"),
+]
+APP_COFFEE = "js/xmppVoiceMail.coffee"
+APP_SCRIPT = "js/xmppVoiceMail.js"
+
+_scriptRegex = re.compile(r'[ \t]*<script src="([^"]+)"></script>\n')
+_templateRegex = re.compile(r'[ \t]*<script type="text/template" id="([^"]+)">(.*?)</script>\n(?:[ \t]*\n)?', re.DOTALL)
+
+# Puts the templates back into the page as <script type="text/template">
+# elements, where the app expects to find them.
+_TEMPLATE_LOADER = """(function(templates) {
+    var head = document.getElementsByTagName('head')[0];
+    for (var id in templates) {
+        var script = document.createElement('script');
+        script.type = 'text/template';
+        script.id = id;
+        script.text = templates[id];
+        head.appendChild(script);
+    }
+})(%s);
+"""
+
+def readAsset(path):
+    with open(os.path.join(ASSETS, path)) as assetFile:
+        return assetFile.read()
+
+def compileApp(options):
+    """ Returns the app's script, compiled from CoffeeScript if we can. """
+    try:
+        process = subprocess.Popen([options.coffee, "--compile", "--print", os.path.join(ASSETS, APP_COFFEE)],
+                                   stdout=subprocess.PIPE)
+    except OSError:
+        print "%s not found; using the checked in %s." % (options.coffee, APP_SCRIPT)
+        return readAsset(APP_SCRIPT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        sys.exit("%s failed" % options.coffee)
+    return output
+
+def minify(script, options):
+    try:
+        process = subprocess.Popen([options.uglify, "--compress", "--mangle"],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError:
+        print "%s not found; not minifying %s." % (options.uglify, APP_SCRIPT)
+        return script
+    output = process.communicate(script)[0]
+    if process.returncode != 0:
+        sys.exit("%s failed" % options.uglify)
+    return output
+
+def build(options):
+    indexHtml = readAsset("index.html")
+
+    # Check index.html loads the scripts we're going to bundle, in order.
+    scripts = _scriptRegex.findall(indexHtml)
+    expectedScripts = [source for source, minified in LIBRARIES] + [APP_SCRIPT]
+    if scripts != expectedScripts:
+        sys.exit("index.html loads %s; expected %s" % (scripts, expectedScripts))
+
+    templates = dict((templateId, template) for templateId, template in _templateRegex.findall(indexHtml))
+
+    parts = [readAsset(minified) for source, minified in LIBRARIES]
+    parts.append(_TEMPLATE_LOADER % json.dumps(templates, sort_keys=True))
+    parts.append(minify(compileApp(options), options))
+    # Separate with ";" in case a file doesn't end with one.
+    bundle = "\n;\n".join(parts)
+
+    bundleName = "app." + hashlib.sha1(bundle).hexdigest()[:12] + ".js"
+    jsDir = os.path.join(DIST, "js")
+    if not os.path.isdir(jsDir):
+        os.makedirs(jsDir)
+    # Only deploy the current bundle.
+    for oldName in os.listdir(jsDir):
+        if oldName.startswith("app.") and oldName != bundleName:
+            os.remove(os.path.join(jsDir, oldName))
+    with open(os.path.join(jsDir, bundleName), "w") as bundleFile:
+        bundleFile.write(bundle)
+
+    # Load the bundle in place of the first script, and drop the others and the templates.
+    bundleTag = '        <script src="/dist/js/%s"></script>\n' % bundleName
+    builtHtml = _templateRegex.sub("", indexHtml)
+    builtHtml = _scriptRegex.sub(lambda match: bundleTag if match.group(1) == scripts[0] else "", builtHtml)
+    with open(os.path.join(DIST, "index.html"), "w") as indexFile:
+        indexFile.write(builtHtml)
+
+    print "Wrote assets/dist/js/%s (%d bytes) and assets/dist/index.html" % (bundleName, len(bundle))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--coffee", default="coffee", help="CoffeeScript compiler to use")
+    parser.add_option("--uglify", default="uglifyjs", help="JavaScript minifier to use")
+    options, args = parser.parse_args()
+    build(options)
+
+if __name__ == '__main__':
+    main()
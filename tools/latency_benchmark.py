@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# Measures how much time LatencyMiddleware adds to each request.
+#
+# Run from the root of the project, with the App Engine SDK on your PYTHONPATH:
+#
+#     python tools/latency_benchmark.py
+#
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from google.appengine.ext import testbed
+
+from util.latency import LatencyMiddleware
+
+ITERATIONS = 100000
+
+ROUTES = [
+    r'/recording',
+    r'/call',
+    r'/sms',
+    r'/api/admin/contacts',
+    r'/api/admin/contacts/(.*)',
+    r'/_ah/xmpp/message/chat/',
+]
+
+def app(environ, start_response):
+    start_response("200 OK", [])
+    return []
+
+def startResponse(status, headers, exc_info=None):
+    pass
+
+def main():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+
+    timedApp = LatencyMiddleware(app, ROUTES)
+    environ = {"PATH_INFO": "/_ah/xmpp/message/chat/"}
+
+    bare = min(timeit.repeat(lambda: app(environ, startResponse), number=ITERATIONS, repeat=3))
+    timed = min(timeit.repeat(lambda: timedApp(environ, startResponse), number=ITERATIONS, repeat=3))
+
+    print "Without middleware: %.2f us/request" % (bare * 1e6 / ITERATIONS)
+    print "With middleware:    %.2f us/request" % (timed * 1e6 / ITERATIONS)
+    print "Overhead:           %.2f us/request" % ((timed - bare) * 1e6 / ITERATIONS)
+
+    bed.deactivate()
+
+if __name__ == '__main__':
+    main()
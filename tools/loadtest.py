@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#
+# Load test xmppvoicemail by replaying webhook traffic straight into main.app.
+#
+# Requests go through the real WSGI application, backed by the App Engine
+# testbed stubs, with a stand-in for Communications so nothing is sent to
+# Twilio, XMPP or email.  This shows contention on the module-level
+# xmppVoiceMail and on hot memcache keys, without deploying anything.
+#
+# Run from the root of the project, with the App Engine SDK on your PYTHONPATH:
+#
+#     python tools/loadtest.py --threads 8 --requests 2000
+#     python tools/loadtest.py --threads 8 --trace trace.json
+#
+# A trace is a file with one JSON object per line:
+#
+#     {"path": "/sms", "params": {"From": "+16135551234", "To": "555555555", "Body": "Hi"}}
+#
+# Use --write-trace to save a synthetic trace to edit or replay later.
+#
+# If there's no config.py, config.py.dist is used.  The testbed keeps the
+# namespace in os.environ, which is shared by all threads, so this only
+# makes sense in single owner mode.
+#
+import imp
+import json
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+import Queue
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+try:
+    import config
+except ImportError:
+    config = imp.load_source("config", os.path.join(ROOT, "config.py.dist"))
+
+import webob
+
+import xmppvoicemail
+
+# Paths which should each send exactly one message to the owner.
+INBOUND_PATHS = ("/sms", "/call", "/recording")
+XMPP_CHAT_PATH = "/_ah/xmpp/message/chat/"
+
+class LoadTestCommunications:
+    """ Stands in for xmppvoicemail.Communications, counting what would have been sent. """
+
+    def __init__(self, latency=0):
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def _count(self, kind):
+        if self._latency:
+            time.sleep(self._latency)
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def sendMail(self, sender, to, subject, body):
+        self._count("mail")
+
+    def sendXmppMessage(self, fromJid, toJid, message):
+        self._count("xmpp")
+
+    def sendXmppInvite(self, fromJid, toJid):
+        self._count("xmppInvite")
+
+    def getXmppPresence(self, jid, fromJid):
+        self._count("xmppPresence")
+        return True
+
+    def sendSMS(self, fromNumber, toNumber, body):
+        self._count("sms")
+
+    @ndb.tasklet
+    def sendSMSAsync(self, fromNumber, toNumber, body):
+        self._count("sms")
+
+def makeSyntheticTrace(requestCount, senderCount):
+    """ Returns a trace mixing calls, SMS, voicemail, replies and presence changes.
+
+    Traffic comes from 'senderCount' numbers, so fewer senders means hotter keys.
+    """
+    appId = os.environ.get("APPLICATION_ID", "testbed-test").split("~")[-1]
+    owner = config.USERJID + "/loadtest"
+    senders = ["+1613555%04d" % i for i in range(0, senderCount)]
+
+    trace = []
+    for i in range(0, requestCount):
+        sender = random.choice(senders)
+        kind = random.random()
+        if kind < 0.5:
+            trace.append({"path": "/sms",
+                          "params": {"From": sender, "To": config.TWILIO_NUMBER, "Body": "Message %d" % i}})
+        elif kind < 0.65:
+            trace.append({"path": "/call",
+                          "params": {"From": sender, "To": config.TWILIO_NUMBER, "CallStatus": "ringing"}})
+        elif kind < 0.75:
+            trace.append({"path": "/recording",
+                          "params": {"Caller": sender, "To": config.TWILIO_NUMBER,
+                                     "TranscriptionText": "Voicemail %d" % i,
+                                     "RecordingUrl": "http://example.com/RE%d" % i}})
+        elif kind < 0.9:
+            trace.append({"path": XMPP_CHAT_PATH,
+                          "params": {"from": owner, "to": "xmppvoicemail@" + appId + ".appspotchat.com",
+                                     "body": sender + ": Reply %d" % i}})
+        else:
+            trace.append({"path": "/_ah/xmpp/presence/" + random.choice(["available", "unavailable"]) + "/",
+                          "params": {"from": owner}})
+    return trace
+
+def readTrace(filename):
+    with open(filename) as traceFile:
+        return [json.loads(line) for line in traceFile if line.strip()]
+
+def writeTrace(filename, trace):
+    with open(filename, "w") as traceFile:
+        for entry in trace:
+            traceFile.write(json.dumps(entry) + "\n")
+
+def percentile(sortedValues, percent):
+    if not sortedValues:
+        return 0
+    index = min(len(sortedValues) - 1, int(len(sortedValues) * percent / 100.0))
+    return sortedValues[index]
+
+class LoadTest:
+    def __init__(self, app, trace, threadCount):
+        self._app = app
+        self._threadCount = threadCount
+        self._queue = Queue.Queue()
+        for entry in trace:
+            self._queue.put(entry)
+        self._lock = threading.Lock()
+        # Maps path to a list of latencies in ms.
+        self.latencies = {}
+        # Maps (path, status) to a count.
+        self.statuses = {}
+        self.errors = []
+
+    def _worker(self):
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            path = entry["path"]
+            request = webob.Request.blank(path, POST=entry.get("params", {}))
+            start = time.time()
+            try:
+                status = request.get_response(self._app).status_int
+            except Exception as e:
+                status = "exception"
+                with self._lock:
+                    self.errors.append(path + ": " + repr(e))
+            latency = (time.time() - start) * 1000
+
+            with self._lock:
+                self.latencies.setdefault(path, []).append(latency)
+                self.statuses[(path, status)] = self.statuses.get((path, status), 0) + 1
+
+    def run(self):
+        """ Runs the trace, and returns how long it took in seconds. """
+        start = time.time()
+        threads = [threading.Thread(target=self._worker) for i in range(0, self._threadCount)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--threads", type="int", default=4, help="Number of concurrent requests")
+    parser.add_option("--trace", help="Trace file to replay")
+    parser.add_option("--requests", type="int", default=1000, help="Size of synthetic trace")
+    parser.add_option("--senders", type="int", default=20, help="Distinct numbers in synthetic trace")
+    parser.add_option("--write-trace", dest="writeTrace", help="Save the trace to this file")
+    parser.add_option("--latency", type="float", default=0,
+                      help="Simulated latency of each outgoing message, in ms")
+    options, args = parser.parse_args()
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(SERVER_SOFTWARE="Development/1.0", overwrite=True)
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_app_identity_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_xmpp_stub()
+    bed.init_mail_stub()
+    bed.init_urlfetch_stub()
+
+    communications = LoadTestCommunications(options.latency / 1000.0)
+    xmppvoicemail.Communications = lambda: communications
+
+    import main as xmppvoicemailMain
+    import smsqueue
+
+    if options.trace:
+        trace = readTrace(options.trace)
+    else:
+        trace = makeSyntheticTrace(options.requests, options.senders)
+    if options.writeTrace:
+        writeTrace(options.writeTrace, trace)
+
+    # Don't count the invites sent at startup.
+    communications.counts.clear()
+
+    loadTest = LoadTest(xmppvoicemailMain.app, trace, options.threads)
+    elapsed = loadTest.run()
+
+    print "%d requests in %.2fs with %d threads: %.1f requests/s" % (
+        len(trace), elapsed, options.threads, len(trace) / elapsed)
+    print
+    print "%-45s %7s %8s %8s %8s %8s" % ("path", "count", "p50 ms", "p95 ms", "p99 ms", "max ms")
+    for path, latencies in sorted(loadTest.latencies.items()):
+        latencies.sort()
+        print "%-45s %7d %8.1f %8.1f %8.1f %8.1f" % (path, len(latencies), percentile(latencies, 50),
+            percentile(latencies, 95), percentile(latencies, 99), latencies[-1])
+    print
+    for (path, status), count in sorted(loadTest.statuses.items()):
+        print "%-45s %7s %7d" % (path, status, count)
+    print
+    print "Sent: " + ", ".join("%s=%d" % item for item in sorted(communications.counts.items()))
+
+    # Check nothing was lost along the way.
+    failures = list(loadTest.errors)
+    for (path, status), count in loadTest.statuses.items():
+        if status == "exception" or status >= 500:
+            failures.append("%d requests to %s returned %s" % (count, path, status))
+
+    inbound = sum(count for (path, status), count in loadTest.statuses.items()
+                  if path in INBOUND_PATHS and status == 200)
+    toOwner = communications.counts.get("xmpp", 0) + communications.counts.get("mail", 0)
+    if toOwner != inbound:
+        failures.append("%d calls, SMS and voicemails, but %d messages to the owner" % (inbound, toOwner))
+
+    replies = sum(count for (path, status), count in loadTest.statuses.items()
+                  if path == XMPP_CHAT_PATH and status == 200)
+    taskqueueStub = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    queued = len(taskqueueStub.get_filtered_tasks(url=smsqueue.SEND_SMS_TASK_URL))
+    if communications.counts.get("sms", 0) + queued != replies:
+        failures.append("%d replies, but %d SMS sent and %d queued" % (
+            replies, communications.counts.get("sms", 0), queued))
+
+    bed.deactivate()
+
+    if failures:
+        print
+        print "FAILED:"
+        for failure in failures:
+            print "  " + failure
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# Compares how fast util/phonenumberutils parses and formats numbers with the
+# North American-only regular expressions it used before.
+#
+# Run from the root of the project:
+#
+#     python tools/phonenumber_benchmark.py --numbers 1000000
+#
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from util import phonenumberutils
+
+# The old implementation, for comparison.
+_phoneNumberRegex = re.compile(r"^\+?1?[ -]?\(?([0-9]{3})\)?[-. ]?([0-9]{3})[-. ]?([0-9]{4})$")
+_e164Regex = re.compile(r"^\+(?:[0-9] ?){6,14}[0-9]$")
+
+def regexToPrettyNumber(phoneNumber):
+    match = _phoneNumberRegex.match(phoneNumber)
+    if match:
+        return "(" + match.group(1) + ")" + match.group(2) + "-" + match.group(3)
+    else:
+        return phoneNumber
+
+def regexToNormalizedNumber(phoneNumber):
+    normalizedNumber = re.sub(r'[^0-9]', "", phoneNumber)
+    if len(normalizedNumber) == 10:
+        normalizedNumber = "1" + normalizedNumber
+    return "+" + normalizedNumber
+
+def regexValidateNumber(phoneNumber):
+    return bool(_phoneNumberRegex.match(phoneNumber) or _e164Regex.match(phoneNumber))
+
+def makeNumbers(count, internationalFraction):
+    """ Returns 'count' numbers in a mix of formats, like the ones Twilio and people send us. """
+    rand = random.Random(1)
+    numbers = []
+    for i in xrange(0, count):
+        if rand.random() < internationalFraction:
+            countryCode = rand.choice(["44", "33", "49", "61", "86", "91", "353", "972"])
+            national = str(rand.randint(10 ** 8, 10 ** 9 - 1))
+            numbers.append(rand.choice(["+" + countryCode + national,
+                                        "+" + countryCode + " " + national[:3] + " " + national[3:],
+                                        "011" + countryCode + national]))
+        else:
+            digits = str(rand.randint(2 * 10 ** 9, 10 ** 10 - 1))
+            numbers.append(rand.choice(["+1" + digits,
+                                        digits,
+                                        "(" + digits[:3] + ")" + digits[3:6] + "-" + digits[6:],
+                                        digits[:3] + "-" + digits[3:6] + "-" + digits[6:]]))
+    return numbers
+
+def timeFunctions(numbers, validate, pretty, normalize):
+    start = time.time()
+    for number in numbers:
+        if validate(number):
+            pretty(number)
+            normalize(number)
+    return time.time() - start
+
+def timeParseNumber(numbers):
+    start = time.time()
+    for number in numbers:
+        phonenumberutils.parseNumber(number)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark phone number parsing and formatting.")
+    parser.add_argument("--numbers", type=int, default=1000000, help="How many numbers to parse")
+    parser.add_argument("--international", type=float, default=0.2,
+                        help="Fraction of the numbers which aren't North American")
+    args = parser.parse_args()
+
+    numbers = makeNumbers(args.numbers, args.international)
+
+    regexTime = timeFunctions(numbers, regexValidateNumber, regexToPrettyNumber, regexToNormalizedNumber)
+    tableTime = timeFunctions(numbers, phonenumberutils.validateNumber, phonenumberutils.toPrettyNumber,
+                              phonenumberutils.toNormalizedNumber)
+    parseTime = timeParseNumber(numbers)
+
+    print "%d numbers, %d%% international" % (len(numbers), args.international * 100)
+    print "Regex (North America only): %.2fs, %.2f us/number" % (regexTime, regexTime * 1e6 / len(numbers))
+    print "Country table:              %.2fs, %.2f us/number" % (tableTime, tableTime * 1e6 / len(numbers))
+    print "Country table, one pass:    %.2fs, %.2f us/number" % (parseTime, parseTime * 1e6 / len(numbers))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Counts the RPCs xmppvoicemail makes to handle each kind of message.
+#
+# Run from the root of the project, with the App Engine SDK on your PYTHONPATH:
+#
+#     python tools/rpc_benchmark.py
+#
+# Each message is handled as if it were a new request, after the caches
+# have been warmed up by an earlier message.
+#
+import imp
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+try:
+    import config
+except ImportError:
+    config = imp.load_source("config", os.path.join(ROOT, "config.py.dist"))
+
+from util import requestcontext
+
+MESSAGES = 20
+
+class RpcCounter:
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, service, call, request, response):
+        name = service + "." + call
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self):
+        self.counts = {}
+
+    def total(self):
+        return sum(self.counts.values())
+
+class BenchmarkCommunications:
+    def sendMail(self, sender, to, subject, body):
+        pass
+
+    def sendXmppMessage(self, fromJid, toJid, message):
+        pass
+
+    def sendXmppInvite(self, fromJid, toJid):
+        pass
+
+    def getXmppPresence(self, jid, fromJid):
+        return True
+
+    def sendSMS(self, fromNumber, toNumber, body):
+        pass
+
+    @ndb.tasklet
+    def sendSMSAsync(self, fromNumber, toNumber, body):
+        pass
+
+def newRequest():
+    """ Forget anything cached for the previous request. """
+    ndb.get_context().clear_cache()
+    requestcontext.start()
+
+def measure(counter, name, handleMessage):
+    # Warm up caches.
+    newRequest()
+    handleMessage(0)
+
+    counter.reset()
+    for i in range(1, MESSAGES + 1):
+        newRequest()
+        handleMessage(i)
+
+    details = ", ".join("%s=%.1f" % (call, float(count) / MESSAGES)
+                        for call, count in sorted(counter.counts.items()))
+    print "%-30s %5.1f RPCs/message  (%s)" % (name, float(counter.total()) / MESSAGES, details)
+
+def main():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(SERVER_SOFTWARE="Development/1.0", overwrite=True)
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_app_identity_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+
+    from models import Contact, XmppUser
+    from xmppvoicemail import Owner, XmppVoiceMail
+
+    owner = Owner(config.TWILIO_NUMBER, "owner@example.com", config.USER_EMAIL, logSize=0)
+    voiceMail = XmppVoiceMail(owner)
+    voiceMail._communications = BenchmarkCommunications()
+
+    Contact.update(Contact(name="mom", phoneNumber="(613)555-1234", normalizedPhoneNumber="+16135551234"))
+    XmppUser(id=owner.jid, jid=owner.jid, presence=True).put()
+
+    counter = RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("rpc_benchmark", counter.count)
+
+    appId = os.environ.get("APPLICATION_ID", "testbed-test").split("~")[-1]
+    measure(counter, "SMS from a contact",
+            lambda i: voiceMail.handleIncomingSms("+16135551234", config.TWILIO_NUMBER, "Hello"))
+    measure(counter, "SMS from a stranger",
+            lambda i: voiceMail.handleIncomingSms("+16135559999", config.TWILIO_NUMBER, "Hello"))
+    measure(counter, "Call from a contact",
+            lambda i: voiceMail.handleIncomingCall("+16135551234", "ringing"))
+    measure(counter, "Reply to a contact",
+            lambda i: voiceMail.handleIncomingXmpp(owner.jid, "mom@" + appId + ".appspotchat.com", "Hi"))
+
+    bed.deactivate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Measures how long message searches take as the index grows.
+#
+# Run from the root of the project, with the App Engine SDK on your PYTHONPATH:
+#
+#     python tools/search_benchmark.py --messages 100000
+#
+# Messages are made up from a small vocabulary with a few rare words, and
+# indexed in batches as the indexer task would.  Searches then run with a
+# cold cache, and report the RPCs and time they took.
+#
+import imp
+import optparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+try:
+    import config
+except ImportError:
+    config = imp.load_source("config", os.path.join(ROOT, "config.py.dist"))
+
+COMMON_WORDS = ["the", "at", "call", "me", "store", "home", "later", "ok", "see", "you", "milk", "soon"]
+RARE_WORDS = ["birthday", "dentist", "passport"]
+QUERIES = ["store", "call me", '"call me later"', "milk dentist", "passport", "zebra"]
+
+class RpcCounter:
+    def __init__(self):
+        self.count = 0
+
+    def countRpc(self, service, call, request, response):
+        self.count += 1
+
+def makeMessage():
+    words = [random.choice(COMMON_WORDS) for i in range(0, random.randint(3, 12))]
+    if random.random() < 0.01:
+        words.insert(random.randint(0, len(words)), random.choice(RARE_WORDS))
+    return " ".join(words)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--messages", type="int", default=20000, help="Number of messages to index")
+    options, args = parser.parse_args()
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+
+    import messagesearch
+
+    start = time.time()
+    for batchStart in range(0, options.messages, messagesearch._BATCH_SIZE):
+        items = [{"contact": "mom", "direction": "to", "message": makeMessage(), "time": time.time()}
+                 for i in range(batchStart, min(options.messages, batchStart + messagesearch._BATCH_SIZE))]
+        messagesearch._indexItems(items)
+        ndb.get_context().clear_cache()
+    print "Indexed %d messages in %.1fs" % (options.messages, time.time() - start)
+    print
+
+    counter = RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("search_benchmark", counter.countRpc)
+
+    print "%-20s %8s %6s %8s" % ("query", "results", "RPCs", "ms")
+    for query in QUERIES:
+        ndb.get_context().clear_cache()
+        counter.count = 0
+        start = time.time()
+        results, cursor = messagesearch.search(query)
+        print "%-20s %8d %6d %8.1f" % (query, len(results), counter.count, (time.time() - start) * 1000)
+
+    bed.deactivate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+""" Counts of messages per hour, by direction, channel and contact.
+
+Each message to or from a contact is counted once, under the channel it
+came in over: SMS and voicemail for messages to the owner, and XMPP, email
+or the web UI for messages from the owner.
+
+Messages are counted in-process, per namespace, and counts are added to
+TrafficRollup entities, one transaction per hour, when a message arrives
+at least _FLUSH_INTERVAL seconds after the last write.  Each instance adds to
+one of _SHARD_COUNT entities per hour, picked when it starts, so instances
+rarely contend for the same entity.
+"""
+import random
+import threading
+import time
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import ndb
+
+from models import TrafficRollup
+from util import structlog
+
+log = structlog.getLogger(__name__)
+
+# Channels a message can come in over.
+SMS = "sms"
+VOICEMAIL = "voicemail"
+XMPP = "xmpp"
+EMAIL = "email"
+WEB = "web"
+
+DIMENSIONS = ("direction", "channel", "contact")
+
+# How often each instance writes its counts, in seconds.
+_FLUSH_INTERVAL = 30
+
+_SHARD_COUNT = 8
+
+_HOUR = 60 * 60
+
+# Longest time series getSeries() will return, in hours.
+#
+# Counts are only written when a message arrives, and neither a cron job nor a
+# task can reach a particular instance's memory, so an instance which goes
+# idle keeps its last _FLUSH_INTERVAL seconds of counts until its next message,
+# and loses them if it shuts down first.  Series can be that far behind.
+MAX_HOURS = 31 * 24
+
+def _countKey(direction, channel, contact):
+    # The contact goes last, since it's the only part which might contain "|".
+    return direction + "|" + channel + "|" + contact
+
+def _addCounts(totals, key, count):
+    totals[key] = totals.get(key, 0) + count
+
+class TrafficRollups:
+    """ Message counts, kept in-process and written to the datastore in batches. """
+
+    def __init__(self, flushInterval=_FLUSH_INTERVAL, shardCount=_SHARD_COUNT, clock=time.time):
+        self._flushInterval = flushInterval
+        self._shard = random.randrange(0, shardCount)
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Maps namespaces to {(hour, count key): count} for messages not yet written.
+        self._pending = {}
+        self._lastFlush = clock()
+
+    def record(self, direction, channel, contact):
+        """ Count a message to or from 'contact' in the current namespace. """
+        now = self._clock()
+        key = (int(now // _HOUR), _countKey(direction, channel, contact))
+        namespace = namespace_manager.get_namespace()
+        with self._lock:
+            _addCounts(self._pending.setdefault(namespace, {}), key, 1)
+            if now - self._lastFlush < self._flushInterval:
+                return
+            pending = self._takePending(now)
+
+        self._write(pending)
+
+    def flush(self):
+        """ Write counts to the datastore now. """
+        with self._lock:
+            pending = self._takePending(self._clock())
+        self._write(pending)
+
+    def _takePending(self, now):
+        pending = self._pending
+        self._pending = {}
+        self._lastFlush = now
+        return pending
+
+    @ndb.tasklet
+    def _addToRollupAsync(self, namespace, hour, counts):
+        key = ndb.Key(TrafficRollup, str(hour) + ":" + str(self._shard), namespace=namespace)
+
+        @ndb.tasklet
+        def txn():
+            rollup = yield key.get_async()
+            if not rollup:
+                rollup = TrafficRollup(key=key, hour=hour, counts={})
+            for countKey, count in counts.items():
+                _addCounts(rollup.counts, countKey, count)
+            yield rollup.put_async()
+
+        yield ndb.transaction_async(txn)
+
+    def _write(self, pending):
+        """ Add 'pending' to the TrafficRollup entities.
+
+        Counts which can't be written are put back, to be tried again with the
+        next batch.
+        """
+        writes = []
+        for namespace, counts in pending.items():
+            byHour = {}
+            for (hour, countKey), count in counts.items():
+                byHour.setdefault(hour, {})[countKey] = count
+            for hour, hourCounts in byHour.items():
+                writes.append((namespace, hour, hourCounts,
+                               self._addToRollupAsync(namespace, hour, hourCounts)))
+
+        for namespace, hour, counts, future in writes:
+            try:
+                future.get_result()
+            except Exception:
+                log.exception("traffic.flush.failed", namespace=namespace, hour=hour)
+                with self._lock:
+                    namespacePending = self._pending.setdefault(namespace, {})
+                    for countKey, count in counts.items():
+                        _addCounts(namespacePending, (hour, countKey), count)
+
+    def getSeries(self, hours=24, groupBy=DIMENSIONS, direction=None, channel=None, contact=None):
+        """ Returns hourly message counts for the current namespace, over the last 'hours' hours.
+
+        Counts are added up over the dimensions not in 'groupBy', after
+        keeping only messages which match 'direction', 'channel' and
+        'contact', if given.  Returns {"start", "interval", "series"}, where
+        start and interval are in ms, and series is a list of
+        {<groupBy dimension>: value, "counts": [count for each hour]}.
+        Includes counts this instance hasn't written yet, but not ones other
+        instances haven't.
+        """
+        endHour = int(self._clock() // _HOUR) + 1
+        startHour = endHour - hours
+
+        totals = {}
+        for rollup in TrafficRollup.query(TrafficRollup.hour >= startHour).fetch():
+            for countKey, count in (rollup.counts or {}).items():
+                _addCounts(totals, (rollup.hour, countKey), count)
+        with self._lock:
+            for key, count in self._pending.get(namespace_manager.get_namespace(), {}).items():
+                _addCounts(totals, key, count)
+
+        filters = dict(item for item in zip(DIMENSIONS, (direction, channel, contact)) if item[1])
+        series = {}
+        for (hour, countKey), count in totals.items():
+            if not startHour <= hour < endHour:
+                continue
+            values = dict(zip(DIMENSIONS, countKey.split("|", 2)))
+            if any(values[dimension] != value for dimension, value in filters.items()):
+                continue
+            group = tuple(values[dimension] for dimension in groupBy)
+            if not group in series:
+                series[group] = [0] * hours
+            series[group][hour - startHour] += count
+
+        answer = []
+        for group in sorted(series):
+            item = dict(zip(groupBy, group))
+            item["counts"] = series[group]
+            answer.append(item)
+        return {"start": startHour * _HOUR * 1000, "interval": _HOUR * 1000, "series": answer}
+
+# Shared by every owner on this instance.
+rollups = TrafficRollups()
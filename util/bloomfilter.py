@@ -0,0 +1,39 @@
+import hashlib
+import math
+import struct
+
+class BloomFilter:
+    """ A compact, probabilistic set of strings.
+
+    A BloomFilter can tell you for certain that a string has never been added
+    to it, but may occasionally claim a string was added when it wasn't.  The
+    chance of that is controlled by errorRate, as long as no more than
+    'capacity' strings are added.  Strings can't be removed.
+
+    The filter is just a bytearray, so it's cheap to pickle into MemCache.
+    """
+
+    def __init__(self, capacity, errorRate=0.01):
+        capacity = max(capacity, 1)
+        self._bitCount = int(math.ceil(-capacity * math.log(errorRate) / (math.log(2) ** 2)))
+        self._hashCount = max(int(round(self._bitCount / float(capacity) * math.log(2))), 1)
+        self._bits = bytearray((self._bitCount + 7) // 8)
+
+    def _positions(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        # Derive all our hash functions from two halves of an MD5 digest.
+        hash1, hash2 = struct.unpack('<QQ', hashlib.md5(value).digest())
+        for i in range(0, self._hashCount):
+            yield (hash1 + i * hash2) % self._bitCount
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= (1 << (position & 7))
+
+    def __contains__(self, value):
+        for position in self._positions(value):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
@@ -1,9 +1,10 @@
+import itertools
+import random
+import time
 import uuid
 import threading
 
-from google.appengine.api import memcache
-
-#TODO: Add some way to check if anything's been added since the last call to getItems?
+from util import requestcontext
 
 class ThreadSafeCircularBuffer:
     """ Stores data in a circular buffer. 
@@ -46,37 +47,99 @@ class ThreadSafeCircularBuffer:
 class MemCacheCircularBuffer:
     """ Stores data in a circular buffer. 
     
-    Data is stored in MemCache.
+    Data is stored in MemCache.  The buffer is split into one or more shards,
+    each with its own counter and an equal share of the bufferSize slots.
+    Each instance of this class writes to the shards in turn, so writers on
+    different App Engine instances rarely contend for the same counter key,
+    and a read fetches about bufferSize slots however many shards there are.
+    getItems() merges the shards back together in the order items were added.
+    getNewItems() returns just the items added after a cursor, which holds the
+    newest sequence number seen in each shard.  If some writers add far more items than others, the buffer can hold
+    fewer than bufferSize of the newest items.
     """
     
-    def __init__(self, bufferSize, keyPrefix=None):
+    def __init__(self, bufferSize, keyPrefix=None, shardCount=1, namespace="CircularBuffer"):
         """ Create a new CircularBuffer.
         
         keyPrefix is the prefix to use when storing data in MemCache.
         bufferSize is the maximum number of elements to allow in the buffer.
+        shardCount is the number of shards to spread writes across.
+        namespace is the MemCache namespace to store data in.
         """
         if not keyPrefix:
             keyPrefix = str(uuid.uuid4())
             
         self._keyPrefix = keyPrefix
         self._bufferSize = bufferSize
-        self._memcache = memcache.Client()
-        
+        self._shardCount = max(shardCount, 1)
+        self._shardSize = max(-(-bufferSize // self._shardCount), 0)
+        # Start each writer at a different shard.
+        self._nextShard = itertools.count(random.randrange(self._shardCount))
+        self._namespace = namespace
+
+    def _counterKey(self, shard):
+        return self._keyPrefix + ":" + str(shard) + ":counter"
+
+    def _slotKey(self, shard, slot):
+        return self._keyPrefix + ":" + str(shard) + ":" + str(slot)
+
+    def _getShardEntries(self, shards):
+        """ Returns a list of entries for each shard, in the order they were added.
+
+        Each entry is a (time, seq, item) tuple.
+        """
+        keysToGet = [self._slotKey(shard, slot)
+                     for shard in shards
+                     for slot in range(0, self._shardSize)]
+        results = requestcontext.get().memcache.get_multi(keysToGet, namespace=self._namespace)
+
+        answer = []
+        for shard in shards:
+            entries = []
+            for slot in range(0, self._shardSize):
+                entry = results.get(self._slotKey(shard, slot))
+                if entry:
+                    entries.append(entry)
+            entries.sort(key=lambda entry: entry[1])
+            answer.append(entries)
+        return answer
+
+    def _recoverCounter(self, shard):
+        """ Recreates the counter for a shard after it has been evicted.
+
+        Probes the shard's slots to find the newest sequence number still in
+        MemCache, and restarts the counter from there so we don't overwrite
+        live slots.  If the slots are gone too, restarts from the time in ms,
+        so sequence numbers still go up past any cursor handed out, as long
+        as a shard gets fewer than 1000 items a second.  Returns the next
+        sequence number to write to.
+        """
+        latestSeq = int(time.time() * 1000)
+        entries = self._getShardEntries([shard])[0]
+        if entries:
+            latestSeq = max(latestSeq, entries[-1][1])
+
+        # If another writer recovers the counter at the same time, only one
+        # of us will create it; the other will just increment it.
+        return requestcontext.get().memcache.incr(key=self._counterKey(shard),
+                                   initial_value=latestSeq,
+                                   namespace=self._namespace)
+
     def addItem(self, item):
         """ Add an item to the circular buffer. """
-        newKey = self._memcache.incr(key=self._keyPrefix + ":counter",
-                                     initial_value=1,
-                                     namespace="CircularBuffer")
-        
-        # Add the new item
-        self._memcache.set(key=self._keyPrefix + ":" + str(newKey),
-                           value=item,
-                           namespace="CircularBuffer")
+        if self._bufferSize <= 0:
+            return
+
+        shard = next(self._nextShard) % self._shardCount
+        client = requestcontext.get().memcache
+        newSeq = client.incr(key=self._counterKey(shard), namespace=self._namespace)
+        if newSeq is None:
+            newSeq = self._recoverCounter(shard)
         
-        # Delete the old item
-        keyToDelete = newKey - self._bufferSize
-        self._memcache.delete(key=self._keyPrefix + ":" + str(keyToDelete),
-                              namespace="CircularBuffer")
+        # Each shard is a ring of slots, so the new item overwrites the oldest one.
+        client.set(key=self._slotKey(shard, newSeq % self._shardSize),
+                   value=(time.time(), newSeq, item),
+                   namespace=self._namespace)
         
     def getItems(self, maxItemsToGet=None):
         """ Returns all the items in the buffer.
@@ -84,28 +147,64 @@ class MemCacheCircularBuffer:
         If maxItemsToGet is specified, then at most maxItemsToGet will be
         retrieved from the buffer.
         
-        Note that if an item is in the process of being added, this may return
-        bufferSize - 1 items and fail to return the new item.
+        Items from all shards are returned in the order they were added.
+        Items added at the same instant on different instances are ordered by
+        shard.
         """
         
         answer = []
 
-        latestKey = self._memcache.get(key=self._keyPrefix + ":counter", namespace="CircularBuffer")
-        if latestKey:
-            itemCount = self._bufferSize
-            if maxItemsToGet:
-                itemCount = min(maxItemsToGet, self._bufferSize)
-                
-            if itemCount:
-                end = latestKey + 1
-                start = end - itemCount
-                
-                keysToGet = [(self._keyPrefix + ":" + str(x)) for x in range(start, end)] 
-            
-                results = self._memcache.get_multi(keysToGet, namespace="CircularBuffer")
-                if results:
-                    for key in keysToGet:
-                        if key in results:
-                            answer.append(results[key])
+        itemCount = self._bufferSize
+        if maxItemsToGet:
+            itemCount = min(maxItemsToGet, self._bufferSize)
+
+        if itemCount > 0:
+            answer = [entry[3] for entry in self._getMergedEntries()[-itemCount:]]
         
-        return answer
\ No newline at end of file
+        return answer
+
+    def _getMergedEntries(self):
+        """ Returns (time, shard, seq, item) for the newest bufferSize items, in the order they were added. """
+        shards = range(0, self._shardCount)
+        # Each shard is written by instances whose clocks can disagree, so
+        # a shard in sequence order isn't always in time order; sort the
+        # lot rather than merging the shards.
+        merged = sorted((entryTime, shard, seq, item)
+                        for shard, entries in zip(shards, self._getShardEntries(shards))
+                        for entryTime, seq, item in entries)
+        return merged[-self._bufferSize:] if self._bufferSize > 0 else []
+
+    def _padCursor(self, cursor):
+        # Cursors from before a change to the shard count still work.
+        cursor = list(cursor or ())[:self._shardCount]
+        return cursor + [0] * (self._shardCount - len(cursor))
+
+    def hasNewItems(self, cursor=None):
+        """ Returns True if items may have been added after 'cursor'.
+
+        Only reads the shards' counters, so it's cheaper than getNewItems().
+        A counter goes up before its item is stored, so getNewItems() can
+        still find nothing new for a moment after this returns True.
+        """
+        cursor = self._padCursor(cursor)
+        keys = [self._counterKey(shard) for shard in range(0, self._shardCount)]
+        counters = requestcontext.get().memcache.get_multi(keys, namespace=self._namespace)
+        return any((counters.get(key) or 0) > cursor[shard] for shard, key in enumerate(keys))
+
+    def getNewItems(self, cursor=None):
+        """ Returns (items, cursor) for the items added after 'cursor', in the order they were added.
+
+        'cursor' is None for every item in the buffer, or a cursor returned
+        by an earlier call.  The cursor returned is a tuple of the newest
+        sequence number returned from each shard.  It only covers items
+        actually read, not ones whose sequence number has been taken but
+        which haven't been stored yet.
+        """
+        cursor = self._padCursor(cursor)
+        newCursor = list(cursor)
+        items = []
+        for entryTime, shard, seq, item in self._getMergedEntries():
+            if seq > cursor[shard]:
+                items.append(item)
+                newCursor[shard] = max(newCursor[shard], seq)
+        return (items, tuple(newCursor))
@@ -0,0 +1,98 @@
+import threading
+import time
+
+from google.appengine.api import namespace_manager
+
+from util import requestcontext
+
+class GenerationCache:
+    """ Keeps an in-process object built from datastore data, one per namespace.
+
+    Every change to the underlying data should increment a generation number
+    stored in MemCache, by calling incrementGeneration() and changed().  Each cached object remembers
+    the generation it was built from.  At most once every checkInterval
+    seconds we check the generation, and rebuild the object if another
+    instance has changed the data.  Changes made on this instance are applied
+    to the cached object in place.
+
+    Requests on several threads can use the same GenerationCache, so the
+    cached objects must be safe to read while changed() updates them.
+    """
+
+    def __init__(self, generationKey, build, checkInterval=1):
+        """ Create a new GenerationCache.
+
+        generationKey is the MemCache key to store the generation number in.
+        build is called with the current generation to build a new object.
+        checkInterval is how often to check the generation, in seconds.
+        """
+        self._generationKey = generationKey
+        self._build = build
+        self._checkInterval = checkInterval
+        self._lock = threading.Lock()
+        # Maps namespaces to [generation, checkedAt, object].
+        self._entries = {}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def getGeneration(self):
+        client = requestcontext.get().memcache
+        generation = client.get(self._generationKey)
+        if generation is None:
+            # Start from the current time, so we can't pick up a generation
+            # number some instance already has cached data for.
+            client.add(self._generationKey, int(time.time() * 1000))
+            generation = client.get(self._generationKey)
+        return generation
+
+    def get(self):
+        """ Returns the object for the current namespace, building it if required. """
+        namespace = namespace_manager.get_namespace()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(namespace)
+            if entry and (now - entry[1]) < self._checkInterval:
+                return entry[2]
+
+        generation = self.getGeneration()
+        with self._lock:
+            entry = self._entries.get(namespace)
+            if entry and entry[0] == generation:
+                entry[1] = now
+                return entry[2]
+
+        # Build outside the lock, since it can take a while.  If another
+        # thread builds one at the same time, the last one built wins.
+        entry = [generation, now, self._build(generation)]
+        with self._lock:
+            self._entries[namespace] = entry
+        return entry[2]
+
+    def incrementGeneration(self):
+        """ Call after changing the underlying data.  Returns the new generation.
+
+        Pass the result to changed() for each GenerationCache using this
+        generation key.
+        """
+        return requestcontext.get().memcache.incr(self._generationKey)
+
+    def changed(self, generation, update=None):
+        """ Update the cached object after the generation was incremented to 'generation'.
+
+        'update' is called with the cached object and the new generation to
+        update the object in place, if it's safe to do so.  Otherwise the
+        object is rebuilt the next time someone asks for it.
+        """
+        namespace = namespace_manager.get_namespace()
+        with self._lock:
+            entry = self._entries.get(namespace)
+            if entry:
+                if update and generation is not None and entry[0] == generation - 1:
+                    # Nobody else has changed anything since we built this, so we
+                    # can update it in place.
+                    update(entry[2], generation)
+                    entry[0] = generation
+                else:
+                    self._entries.pop(namespace, None)
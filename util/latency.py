@@ -0,0 +1,226 @@
+import array
+import bisect
+import logging
+import re
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from util import requestcontext
+
+_MEMCACHE_NAMESPACE = "Latency"
+_SERIES_MEMCACHE_KEY = "SERIES"
+
+# How often each instance writes its histograms to memcache, in seconds.
+_FLUSH_INTERVAL = 10
+
+# Histograms are kept per window, so percentiles reflect recent traffic.
+_WINDOW = 60 * 60
+
+# How many paths to remember the route for.
+_MAX_MEMOIZED_PATHS = 1000
+
+# Routes we don't know about are counted together.
+OTHER_ROUTE = "other"
+
+# Upper bound of each bucket, in milliseconds.  Each bucket is 25% wider than
+# the one before, so percentiles are accurate to within 25%.  The last bucket
+# catches everything slower than a minute.
+def _makeBucketBounds():
+    bounds = []
+    bound = 1.0
+    while bound < 60 * 1000:
+        if int(bound) not in bounds:
+            bounds.append(int(bound))
+        bound *= 1.25
+    return bounds
+
+BUCKET_BOUNDS_MS = _makeBucketBounds()
+_BUCKET_COUNT = len(BUCKET_BOUNDS_MS) + 1
+
+PERCENTILES = (50, 95, 99)
+
+def _seriesName(route, status):
+    return route + " " + status
+
+def _bucketKey(window, series, bucket):
+    return str(window) + ":" + series + ":" + str(bucket)
+
+def _percentiles(counts):
+    """ Returns {"pNN": latencyInMs} for counts, a list of counts per bucket.
+
+    Latencies are the upper bound of the bucket the percentile falls in.
+    """
+    total = sum(counts)
+    answer = {}
+    for percentile in PERCENTILES:
+        rank = total * percentile / 100.0
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        if bucket < len(BUCKET_BOUNDS_MS):
+            answer["p" + str(percentile)] = BUCKET_BOUNDS_MS[bucket]
+        else:
+            answer["p" + str(percentile)] = None
+    return answer
+
+class LatencyHistograms:
+    """ Latency histograms for each route and response status.
+
+    Requests are counted in an array of fixed buckets per series in-process,
+    and every few seconds the counts are added to memcache, where they are
+    summed across instances.
+    """
+
+    def __init__(self, flushInterval=_FLUSH_INTERVAL):
+        self._flushInterval = flushInterval
+        self._lock = threading.Lock()
+        # Maps series names to an array of counts, one per bucket.
+        self._histograms = {}
+        # Series we've already added to the list in memcache.
+        self._knownSeries = set()
+        self._lastFlush = time.time()
+
+    def record(self, route, status, latencyMs, now=None):
+        """ Count a request to 'route' which took latencyMs, and returned 'status'. """
+        if now is None:
+            now = time.time()
+        bucket = bisect.bisect_left(BUCKET_BOUNDS_MS, latencyMs)
+        series = _seriesName(route, status)
+
+        with self._lock:
+            histogram = self._histograms.get(series)
+            if histogram is None:
+                histogram = self._histograms[series] = array.array('L', [0] * _BUCKET_COUNT)
+            histogram[bucket] += 1
+
+            if now - self._lastFlush < self._flushInterval:
+                return
+            histograms = self._histograms
+            self._histograms = {}
+            self._lastFlush = now
+
+        self._flush(histograms, now)
+
+    def flush(self):
+        """ Write counts to memcache now. """
+        now = time.time()
+        with self._lock:
+            histograms = self._histograms
+            self._histograms = {}
+            self._lastFlush = now
+        self._flush(histograms, now)
+
+    def _flush(self, histograms, now):
+        if not histograms:
+            return
+
+        window = int(now // _WINDOW)
+        offsets = {}
+        for series, histogram in histograms.items():
+            for bucket, count in enumerate(histogram):
+                if count:
+                    offsets[_bucketKey(window, series, bucket)] = count
+        requestcontext.get().memcache.offset_multi(offsets, namespace=_MEMCACHE_NAMESPACE, initial_value=0)
+
+        newSeries = set(histograms.keys()) - self._knownSeries
+        if newSeries:
+            self._addSeries(newSeries)
+
+    def _addSeries(self, newSeries):
+        """ Add series names to the list in memcache, so readers can find them. """
+        # memcache.Client keeps track of CAS IDs, so we need our own.
+        client = memcache.Client()
+        for attempt in range(0, 10):
+            series = client.gets(_SERIES_MEMCACHE_KEY, namespace=_MEMCACHE_NAMESPACE)
+            if series is None:
+                stored = client.add(_SERIES_MEMCACHE_KEY, newSeries, namespace=_MEMCACHE_NAMESPACE)
+            elif newSeries <= series:
+                stored = True
+            else:
+                stored = client.cas(_SERIES_MEMCACHE_KEY, series | newSeries, namespace=_MEMCACHE_NAMESPACE)
+
+            if stored:
+                self._knownSeries |= newSeries
+                return
+
+        logging.warn("Could not update latency series list")
+
+    def getPercentiles(self):
+        """ Returns p50, p95 and p99 latency for each series, across all instances.
+
+        Covers requests in the current and previous window.  Returns a list of
+        {"route", "status", "count", "p50", "p95", "p99"}, slowest p99 first.
+        """
+        self.flush()
+
+        series = requestcontext.get().memcache.get(_SERIES_MEMCACHE_KEY, namespace=_MEMCACHE_NAMESPACE) or set()
+        window = int(time.time() // _WINDOW)
+        keys = [_bucketKey(w, s, bucket)
+                for s in series
+                for w in (window - 1, window)
+                for bucket in range(0, _BUCKET_COUNT)]
+        values = requestcontext.get().memcache.get_multi(keys, namespace=_MEMCACHE_NAMESPACE)
+
+        answer = []
+        for s in series:
+            counts = [sum(int(values.get(_bucketKey(w, s, bucket), 0)) for w in (window - 1, window))
+                      for bucket in range(0, _BUCKET_COUNT)]
+            total = sum(counts)
+            if not total:
+                continue
+            route, status = s.rsplit(" ", 1)
+            item = {"route": route, "status": status, "count": total}
+            item.update(_percentiles(counts))
+            answer.append(item)
+
+        answer.sort(key=lambda item: item["p99"], reverse=True)
+        return answer
+
+class LatencyMiddleware:
+    """ WSGI middleware which records how long each request takes.
+
+    'routes' is a list of route regular expressions, in the order the
+    application matches them.  Requests are counted under the first route
+    which matches their path.
+    """
+
+    def __init__(self, app, routes, histograms=None):
+        self._app = app
+        self._routes = [(re.compile(route + "$"), route) for route in routes]
+        self._histograms = histograms or LatencyHistograms()
+        self._routeForPath = {}
+
+    def getHistograms(self):
+        return self._histograms
+
+    def _getRoute(self, path):
+        route = self._routeForPath.get(path)
+        if route is None:
+            route = OTHER_ROUTE
+            for regex, template in self._routes:
+                if regex.match(path):
+                    route = template
+                    break
+            if len(self._routeForPath) < _MAX_MEMOIZED_PATHS:
+                self._routeForPath[path] = route
+        return route
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        statuses = []
+
+        def timedStartResponse(status, headers, exc_info=None):
+            statuses.append(status[:3])
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self._app(environ, timedStartResponse)
+        finally:
+            now = time.time()
+            status = statuses[-1] if statuses else "500"
+            self._histograms.record(self._getRoute(environ.get("PATH_INFO", "")), status,
+                                    (now - start) * 1000, now)
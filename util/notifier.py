@@ -0,0 +1,51 @@
+import threading
+import time
+
+class Notifier:
+    """ Lets threads wait for something to change.
+
+    Each key has a version number, which only goes up.  notify() sets a new
+    version, and wakes any threads waiting on the key for a newer version
+    than they've already seen.
+
+    This only works within one process.  Anything which needs to notice
+    changes made on other App Engine instances has to check for those
+    itself, e.g. by waiting with a short timeout and polling MemCache.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+
+    def getVersion(self, key):
+        with self._condition:
+            return self._versions.get(key, 0)
+
+    def notify(self, key, version=None):
+        """ Set the version for 'key', and wake up threads waiting for it.
+
+        If version is None, the version goes up by one.  Versions older than
+        the current version are ignored.
+        """
+        with self._condition:
+            current = self._versions.get(key, 0)
+            if version is None:
+                version = current + 1
+            if version > current:
+                self._versions[key] = version
+                self._condition.notify_all()
+
+    def wait(self, key, version, timeout):
+        """ Wait up to 'timeout' seconds for the version of 'key' to be newer than 'version'.
+
+        Returns the current version, which is no newer than 'version' if we
+        timed out.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._versions.get(key, 0) <= version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._versions.get(key, 0)
@@ -0,0 +1,82 @@
+""" Country calling codes, and how to format numbers in each.
+
+This is kept as one packed string rather than as a dict of lists, so
+importing it is cheap; phonenumberutils unpacks it the first time it's
+needed.  Entries are separated by ";".  Each entry is a country calling code,
+optionally followed by ":" and a "|" separated list of formats, tried in
+order.  A format is a template, optionally preceded by the leading digits of
+the national number it applies to and "@".  In a template, "$" stands for
+"+" and the country code, and each "x" for one digit of the national number,
+so a template only matches national numbers with as many digits as it has
+"x"s.  Codes with no format that fits are formatted in groups of three.
+"""
+
+COUNTRY_FORMATS = (
+    "1:(xxx)xxx-xxxx;"
+    "7:$ xxx xxx-xx-xx;"
+    "20:$ xx xxxx xxxx|$ x xxxx xxxx;"
+    "27:$ xx xxx xxxx;"
+    "30:$ xxx xxx xxxx;"
+    "31:6@$ x xxxxxxxx|$ xx xxx xxxx;"
+    "32:4@$ xxx xx xx xx|$ xx xx xx xx|$ x xxx xx xx;"
+    "33:$ x xx xx xx xx;"
+    "34:$ xxx xx xx xx;"
+    "36:1@$ x xxx xxxx|$ xx xxx xxxx|$ xx xxx xxx;"
+    "39:3@$ xxx xxx xxxx|0@$ xx xxxx xxxx|3@$ xxx xxx xxx;"
+    "40:$ xxx xxx xxx;"
+    "41:$ xx xxx xx xx;"
+    "43:6@$ xxx xxxxxxx|1@$ x xxxxxxx;"
+    "44:2@$ xx xxxx xxxx|7@$ xxxx xxxxxx|$ xxxx xxxxxx;"
+    "45:$ xx xx xx xx;"
+    "46:7@$ xx xxx xx xx|8@$ x xxx xxx xx|$ xx xxx xx xx;"
+    "47:$ xxx xx xxx;"
+    "48:$ xxx xxx xxx;"
+    "49:1@$ xxx xxxxxxxx|1@$ xxx xxxxxxx|30@$ xx xxxxxxxx|30@$ xx xxxxxxx|$ xxx xxxxxxx;"
+    "51:9@$ xxx xxx xxx|$ x xxx xxxx;"
+    "52:$ xx xxxx xxxx;"
+    "53:$ x xxx xxxx;"
+    "54:9@$ x xx xxxx-xxxx|$ xx xxxx-xxxx;"
+    "55:$ xx xxxxx-xxxx|$ xx xxxx-xxxx;"
+    "56:$ x xxxx xxxx;"
+    "57:$ xxx xxxxxxx;"
+    "58:$ xxx-xxxxxxx;"
+    "60:1@$ xx-xxx xxxx|1@$ xx-xxxx xxxx|$ x-xxx xxxx;"
+    "61:4@$ xxx xxx xxx|$ x xxxx xxxx;"
+    "62:8@$ xxx-xxxx-xxxx|8@$ xxx-xxx-xxxx|$ xx xxxx xxxx;"
+    "63:$ xxx xxx xxxx;"
+    "64:2@$ xx xxx xxxx|2@$ xx xxx xxxxx|$ x xxx xxxx;"
+    "65:$ xxxx xxxx;"
+    "66:$ xx xxx xxxx|$ x xxx xxxx;"
+    "81:$ xx-xxxx-xxxx|$ x-xxxx-xxxx;"
+    "82:$ xx-xxxx-xxxx|$ x-xxxx-xxxx;"
+    "84:$ xx xxx xx xx;"
+    "86:1@$ xxx xxxx xxxx|$ xx xxxx xxxx;"
+    "90:$ xxx xxx xx xx;"
+    "91:$ xxxxx xxxxx;"
+    "92:$ xxx xxxxxxx;"
+    "93:$ xx xxx xxxx;"
+    "94:$ xx x xxxxxx;"
+    "95:$ x xxx xxxx;"
+    "98:$ xxx xxx xxxx;"
+    "211;212:$ xxx-xxxxxx;213;216:$ xx xxx xxx;218;"
+    "220;221:$ xx xxx xx xx;222;223;224;225:$ xx xx xx xx xx;226;227;228;229;"
+    "230;231;232;233:$ xx xxx xxxx;234:$ xxx xxx xxxx;235;236;237;238;239;"
+    "240;241;242;243;244:$ xxx xxx xxx;245;246;247;248;249;"
+    "250;251:$ xx xxx xxxx;252;253;254:$ xxx xxxxxx;255:$ xxx xxx xxx;256:$ xxx xxxxxx;257;258;"
+    "260:$ xx xxxxxxx;261;262;263:$ xx xxx xxxx;264;265;266;267;268;269;"
+    "290;291;297;298;299;"
+    "350;351:$ xxx xxx xxx;352;353:8@$ xx xxx xxxx|$ x xxx xxxx;354:$ xxx xxxx;355;356:$ xxxx xxxx;"
+    "357:$ xx xxxxxx;358:$ xx xxx xxxx;359;"
+    "370;371;372;373;374;375;376;377;378;379;"
+    "380:$ xx xxx xxxx;381;382;383;385;386;387;389;"
+    "420:$ xxx xxx xxx;421:$ xxx xxx xxx;423;"
+    "500;501;502;503;504;505;506:$ xxxx xxxx;507;508;509;"
+    "590;591;592;593;594;595;596;597;598;599;"
+    "670;672;673;674;675;676;677;678;679;680;681;682;683;685;686;687;688;689;690;691;692;"
+    "800;808;850;852:$ xxxx xxxx;853:$ xxxx xxxx;855;856;870;878;880:$ xxxx-xxxxxx;"
+    "881;882;883;886:9@$ xxx xxx xxx|$ x xxxx xxxx;888;"
+    "960;961;962;963;964;965:$ xxxx xxxx;966:5@$ xx xxx xxxx|$ xx xxx xxxx;967;968;"
+    "970;971:5@$ xx xxx xxxx|$ x xxx xxxx;972:5@$ xx-xxx-xxxx|$ x-xxx-xxxx;973;974:$ xxxx xxxx;"
+    "975;976;977;979;"
+    "992;993;994;995;996;998"
+)
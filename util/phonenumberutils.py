@@ -1,41 +1,183 @@
+import operator
 import re
 
-# Adapted from http://blog.stevenlevithan.com/archives/validate-phone-number
-_phoneNumberRegex = re.compile(r"^\+?1?[ -]?\(?([0-9]{3})\)?[-. ]?([0-9]{3})[-. ]?([0-9]{4})$")
-_e164Regex = re.compile(r"^\+(?:[0-9] ?){6,14}[0-9]$")
+from util import phonenumberdata
+
+_nonDigitRegex = re.compile(r"[^0-9]")
+_NON_DIGITS = "".join(chr(c) for c in range(256) if not chr(c).isdigit())
+
+# Characters which may appear in a phone number.
+_NUMBER_CHARACTERS = "0123456789 -.()+/"
+
+# Prefixes for dialing out of North America, and most other places.
+_INTERNATIONAL_PREFIXES = ("011", "00")
+
+# E.164 numbers have at most 15 digits, including the country code.
+_MIN_DIGITS = 7
+_MAX_DIGITS = 15
+
+# Maps country code to [(leading digits, national number length, format string, getter)],
+# unpacked from phonenumberdata the first time it's needed.  getter() picks
+# out the groups of digits which go in the format string.
+_countryFormats = None
+
+# Maps numbers to what parseNumber() returned for them.  Callers tend to
+# validate, format and normalize the same number one after the other, so
+# this saves parsing it each time.  Cleared when it gets too big.
+_parsedNumbers = {}
+_MAX_PARSED_NUMBERS = 1000
+_NOT_PARSED = object()
+
+def _compileTemplate(countryCode, template):
+    """ Returns (format string, getter) for a phonenumberdata template. """
+    formatString = ""
+    groups = []
+    digit = 0
+    for part in re.findall(r"x+|[^x]+", template):
+        if part[0] == "x":
+            formatString += "%s"
+            groups.append(slice(digit, digit + len(part)))
+            digit += len(part)
+        else:
+            formatString += part.replace("%", "%%").replace("$", "+" + countryCode)
+    if len(groups) == 1:
+        # itemgetter with one item doesn't return a tuple.
+        groups.append(slice(0, 0))
+        formatString += "%s"
+    return formatString, operator.itemgetter(*groups)
+
+def _getCountryFormats():
+    global _countryFormats
+    if _countryFormats is None:
+        countryFormats = {}
+        for entry in phonenumberdata.COUNTRY_FORMATS.split(";"):
+            countryCode, _, templates = entry.partition(":")
+            formats = countryFormats[countryCode] = []
+            for template in templates.split("|") if templates else []:
+                leading, _, template = template.rpartition("@")
+                formatString, getter = _compileTemplate(countryCode, template)
+                formats.append((leading, template.count("x"), formatString, getter))
+        _countryFormats = countryFormats
+    return _countryFormats
+
+def _groupDigits(digits):
+    """ Split digits into groups of three, with no group of one at the end. """
+    groups = [digits[i:i + 3] for i in range(0, len(digits), 3)]
+    if len(groups) > 1 and len(groups[-1]) == 1:
+        groups[-2:] = [groups[-2][:2], groups[-2][2] + groups[-1]]
+    return " ".join(groups)
+
+def _parse(phoneNumber):
+    """ Splits a phone number into (country code, national number).
+
+    Numbers starting with "+", or an international dialing prefix, have
+    their country code looked up.  Others are taken to be North American.
+    Returns None if phoneNumber isn't a phone number.
+    """
+    if isinstance(phoneNumber, unicode):
+        try:
+            phoneNumber = phoneNumber.encode("ascii")
+        except UnicodeError:
+            return None
+
+    if phoneNumber[:1] == "+" and phoneNumber[1:].isdigit():
+        # Already normalized, as numbers from Twilio are.
+        digits = phoneNumber[1:]
+        international = True
+    else:
+        phoneNumber = phoneNumber.strip()
+        # Anything but digits and punctuation means this isn't a number.
+        if phoneNumber.translate(None, _NUMBER_CHARACTERS):
+            return None
+        digits = phoneNumber.translate(None, _NON_DIGITS)
+        international = phoneNumber[:1] == "+"
+
+    if not international and digits[:1] == "0":
+        for prefix in _INTERNATIONAL_PREFIXES:
+            if digits.startswith(prefix) and len(digits) - len(prefix) >= _MIN_DIGITS:
+                digits = digits[len(prefix):]
+                international = True
+                break
+
+    if not international:
+        if len(digits) == 10:
+            return "1", digits
+        if len(digits) == 11 and digits.startswith("1"):
+            return "1", digits[1:]
+        return None
+
+    if not _MIN_DIGITS <= len(digits) <= _MAX_DIGITS:
+        return None
+    countryFormats = _countryFormats or _getCountryFormats()
+    # Country codes are one to three digits, and no code is a prefix of another.
+    for length in (1, 2, 3):
+        if digits[:length] in countryFormats:
+            return digits[:length], digits[length:]
+    return None
 
 def stripNumber(number):
     """ Strips all non-digits from a phone number. """
-    return re.sub(r'[^0-9]', "", number)
+    if isinstance(number, str):
+        return number.translate(None, _NON_DIGITS)
+    return _nonDigitRegex.sub("", number)
+
+def _format(countryCode, nationalNumber):
+    length = len(nationalNumber)
+    for leading, formatLength, formatString, getter in (_countryFormats or _getCountryFormats())[countryCode]:
+        if formatLength == length and nationalNumber.startswith(leading):
+            return formatString % getter(nationalNumber)
+    return "+" + countryCode + " " + _groupDigits(nationalNumber)
+
+def parseNumber(phoneNumber):
+    """ Returns (normalized number, pretty number) for a phone number, or None if it isn't valid.
+
+    validateNumber(), toNormalizedNumber() and toPrettyNumber() all use this,
+    so calling them one after another only parses the number once.
+    """
+    parsed = _parsedNumbers.get(phoneNumber, _NOT_PARSED)
+    if parsed is not _NOT_PARSED:
+        return parsed
+
+    parsed = _parse(phoneNumber)
+    if parsed:
+        parsed = ("+" + parsed[0] + parsed[1], _format(*parsed))
+    if len(_parsedNumbers) >= _MAX_PARSED_NUMBERS:
+        _parsedNumbers.clear()
+    _parsedNumbers[phoneNumber] = parsed
+    return parsed
 
 def toPrettyNumber(phoneNumber):
-    """ Converts a number to nicely formatted number. """
-    match = _phoneNumberRegex.match(phoneNumber)
-    if match:
-        return "(" + match.group(1) + ")" + match.group(2) + "-" + match.group(3)
-    else:
+    """ Converts a number to nicely formatted number.
+
+    North American numbers are formatted like "(613)555-1234", and others
+    like "+44 20 7946 0958".  Anything which isn't a phone number is returned
+    as is.
+    """
+    parsed = parseNumber(phoneNumber)
+    if not parsed:
         return phoneNumber
+    return parsed[1]
 
 def toNormalizedNumber(phoneNumber):
     """ Returns a normalized E.164 phone number.
-    
-    The number returned will always have a leading "+", followed by a "1" for
-    North American style numbers, followed by digits with no spaces.
+
+    The number returned will always have a leading "+", followed by the
+    country code ("1" for North American style numbers), followed by digits
+    with no spaces.
     """
+    if phoneNumber[:1] == "+" and phoneNumber[1:].isdigit():
+        # Already normalized, as numbers from Twilio are.
+        return phoneNumber
+
+    parsed = parseNumber(phoneNumber)
+    if parsed:
+        return parsed[0]
+
     normalizedNumber = stripNumber(phoneNumber)
-    if len(normalizedNumber) == 10:
+    if len(normalizedNumber) == 10 and not phoneNumber.lstrip().startswith("+"):
         normalizedNumber = "1" + normalizedNumber
     return "+" + normalizedNumber
 
 def validateNumber(phoneNumber):
     """ Returns True if 'phoneNumber' is a valid phone number, False otherwise. """
-    answer = False
-    match = _phoneNumberRegex.match(phoneNumber)
-    if match:
-        answer = True
-    else:
-        match = _e164Regex.match(phoneNumber)
-        if match:
-            answer = True
-            
-    return answer
+    return parseNumber(phoneNumber) is not None
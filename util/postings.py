@@ -0,0 +1,63 @@
+""" Compact posting lists for an inverted index.
+
+A posting list is a sorted list of document ids.  It's stored as the gaps
+between ids, each written as a varint: 7 bits per byte, with the high bit
+set on every byte but the last.  Ids handed out in order have small gaps, so
+most postings take one or two bytes.
+"""
+import bisect
+
+def encode(docIds, previous=0):
+    """ Encode a sorted list of document ids.
+
+    'previous' is the id before docIds[0], if this continues an existing list.
+    """
+    answer = bytearray()
+    for docId in docIds:
+        gap = docId - previous
+        if gap <= 0:
+            raise ValueError("Document ids must be increasing: %d after %d" % (docId, previous))
+        while gap >= 0x80:
+            answer.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        answer.append(gap)
+        previous = docId
+    return str(answer)
+
+def decode(data, previous=0):
+    """ Decode a list encoded by encode(). """
+    answer = []
+    gap = 0
+    shift = 0
+    for byte in bytearray(data):
+        gap |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += gap
+            answer.append(previous)
+            gap = 0
+            shift = 0
+    return answer
+
+def intersect(list1, list2):
+    """ Returns the ids in both sorted lists. """
+    if len(list1) > len(list2):
+        list1, list2 = list2, list1
+
+    answer = []
+    j = 0
+    length2 = len(list2)
+    # Binary search through the longer list if it's much longer; otherwise merge.
+    skip = length2 > 8 * len(list1)
+    for docId in list1:
+        if skip:
+            j = bisect.bisect_left(list2, docId, j)
+        else:
+            while j < length2 and list2[j] < docId:
+                j += 1
+        if j == length2:
+            break
+        if list2[j] == docId:
+            answer.append(docId)
+    return answer
@@ -0,0 +1,53 @@
+import bisect
+import threading
+
+class PrefixIndex:
+    """ An in-memory index for finding values by the prefix of their key.
+
+    Entries are kept in a sorted list of (key, value) pairs, so finding every
+    key that starts with a given prefix is a binary search followed by a scan
+    over just the matching entries.  Access is protected by a threading.Lock.
+    """
+
+    def __init__(self, entries=None):
+        """ Create a new PrefixIndex.
+
+        'entries' is an optional list of (key, value) pairs to start with.
+        """
+        self._lock = threading.Lock()
+        self._entries = sorted(entries or [])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, value):
+        """ Add a value to the index under the given key. """
+        with self._lock:
+            index = bisect.bisect_left(self._entries, (key, value))
+            if index >= len(self._entries) or self._entries[index] != (key, value):
+                self._entries.insert(index, (key, value))
+
+    def remove(self, key, value):
+        """ Remove the value stored under the given key, if it is in the index. """
+        with self._lock:
+            index = bisect.bisect_left(self._entries, (key, value))
+            if index < len(self._entries) and self._entries[index] == (key, value):
+                del self._entries[index]
+
+    def search(self, prefix, limit=None):
+        """ Returns the values for all keys starting with 'prefix', ordered by key.
+
+        If limit is specified, at most limit values are returned.
+        """
+        answer = []
+        with self._lock:
+            index = bisect.bisect_left(self._entries, (prefix,))
+            while index < len(self._entries):
+                key, value = self._entries[index]
+                if not key.startswith(prefix):
+                    break
+                answer.append(value)
+                if limit and len(answer) >= limit:
+                    break
+                index += 1
+        return answer
@@ -0,0 +1,223 @@
+import cProfile
+import hashlib
+import hmac
+import os
+import pstats
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from util import requestcontext
+
+_MEMCACHE_NAMESPACE = "Profiler"
+_SETTINGS_MEMCACHE_KEY = "SETTINGS"
+
+# Requests with this header set to getToken() are profiled whenever profiling is on.
+PROFILE_HEADER = "X-Profile-Token"
+
+# Longest time profiling can be turned on for, in seconds.  MemCache takes
+# expiry times over 30 days to be absolute timestamps.
+MAX_DURATION = 30 * 24 * 60 * 60
+
+# How often each instance re-reads the settings, and writes its stats to memcache, in seconds.
+_REFRESH_INTERVAL = 10
+_FLUSH_INTERVAL = 10
+
+# Each instance adds its stats to one of this many slots, so instances
+# don't all contend for the same key, and readers know which keys to read.
+_SLOT_COUNT = 16
+
+# Most functions kept per slot, so a slot stays well under memcache's size limit.
+_MAX_FUNCTIONS = 200
+
+_MAX_CAS_RETRIES = 10
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+
+def _slotKey(slot):
+    return "SLOT:" + str(slot)
+
+def _functionName(function):
+    """ Returns a short name for a pstats (file, line, function) key. """
+    filename, line, name = function
+    if filename.startswith(_ROOT):
+        filename = filename[len(_ROOT):]
+    return "%s:%d(%s)" % (filename, line, name)
+
+def _mergeStats(stats, newStats):
+    """ Add newStats to stats, both {"requests": n, "functions": {name: [calls, totalTime, cumulativeTime]}}. """
+    stats["requests"] += newStats["requests"]
+    functions = stats["functions"]
+    for name, (calls, totalTime, cumulativeTime) in newStats["functions"].items():
+        counts = functions.setdefault(name, [0, 0.0, 0.0])
+        counts[0] += calls
+        counts[1] += totalTime
+        counts[2] += cumulativeTime
+
+def _newStats():
+    return {"requests": 0, "functions": {}}
+
+def _truncate(stats, maxFunctions):
+    """ Drop all but the maxFunctions functions with the most time in them. """
+    functions = stats["functions"]
+    if len(functions) > maxFunctions:
+        keep = sorted(functions.items(), key=lambda item: item[1][1], reverse=True)[:maxFunctions]
+        stats["functions"] = dict(keep)
+
+class Profiler:
+    """ Profiles a sample of requests, and collects the results across instances.
+
+    Profiling is turned on and off with setSettings(), which stores the
+    settings in memcache for every instance to see.  Each instance checks the
+    settings every few seconds.  While profiling is on, a random 'sampleRate'
+    of requests are profiled, along with any request which sends the
+    PROFILE_HEADER.  Profiling turns itself off after the duration given to
+    setSettings(), or if memcache evicts the settings.
+
+    Each instance adds up the time spent in each function, and every few
+    seconds adds that to a slot in memcache.  getStats() merges the slots.
+    """
+
+    def __init__(self, secret, refreshInterval=_REFRESH_INTERVAL, flushInterval=_FLUSH_INTERVAL,
+                 maxFunctions=_MAX_FUNCTIONS):
+        self._token = hmac.new(secret, "profile", hashlib.sha256).hexdigest()
+        self._refreshInterval = refreshInterval
+        self._flushInterval = flushInterval
+        self._maxFunctions = maxFunctions
+        self._slot = random.randrange(_SLOT_COUNT)
+        self._lock = threading.Lock()
+        # Settings as last read, and when we read them.
+        self._settings = None
+        self._refreshedAt = 0
+        # Stats not yet written to memcache.
+        self._stats = _newStats()
+        self._lastFlush = time.time()
+
+    def getToken(self):
+        """ Returns the value to send in PROFILE_HEADER to have a request profiled. """
+        return self._token
+
+    def getSettings(self):
+        """ Returns {"enabled": bool, "sampleRate": float}, checking memcache if it's time to. """
+        now = time.time()
+        if now - self._refreshedAt >= self._refreshInterval:
+            settings = requestcontext.get().memcache.get(_SETTINGS_MEMCACHE_KEY, namespace=_MEMCACHE_NAMESPACE)
+            self._settings = settings or {"enabled": False, "sampleRate": 0.0}
+            self._refreshedAt = now
+        return self._settings
+
+    def setSettings(self, enabled, sampleRate, duration):
+        """ Turn profiling on or off for all instances, for 'duration' seconds. """
+        settings = {"enabled": enabled, "sampleRate": sampleRate}
+        requestcontext.get().memcache.set(_SETTINGS_MEMCACHE_KEY, settings, time=duration,
+                                          namespace=_MEMCACHE_NAMESPACE)
+        self._settings = settings
+        self._refreshedAt = time.time()
+
+    def shouldProfile(self, environ):
+        settings = self.getSettings()
+        if not settings["enabled"]:
+            return False
+        token = environ.get("HTTP_" + PROFILE_HEADER.upper().replace("-", "_"))
+        if token:
+            return hmac.compare_digest(self._token, token)
+        return random.random() < settings["sampleRate"]
+
+    def record(self, profile):
+        """ Add the stats from a finished cProfile.Profile. """
+        newStats = _newStats()
+        newStats["requests"] = 1
+        for function, (primitiveCalls, calls, totalTime, cumulativeTime, callers) in \
+                pstats.Stats(profile).stats.items():
+            newStats["functions"][_functionName(function)] = [calls, totalTime, cumulativeTime]
+
+        now = time.time()
+        with self._lock:
+            _mergeStats(self._stats, newStats)
+            if now - self._lastFlush < self._flushInterval:
+                return
+            stats = self._stats
+            self._stats = _newStats()
+            self._lastFlush = now
+
+        self._flush(stats)
+
+    def flush(self):
+        """ Write stats to memcache now. """
+        with self._lock:
+            stats = self._stats
+            self._stats = _newStats()
+            self._lastFlush = time.time()
+        self._flush(stats)
+
+    def _flush(self, stats):
+        if not stats["requests"]:
+            return
+
+        # memcache.Client keeps track of CAS IDs, so we need our own.
+        client = memcache.Client()
+        key = _slotKey(self._slot)
+        for attempt in range(0, _MAX_CAS_RETRIES):
+            stored = client.gets(key, namespace=_MEMCACHE_NAMESPACE)
+            if stored is None:
+                merged = _newStats()
+            else:
+                merged = {"requests": stored["requests"], "functions": dict(stored["functions"])}
+            _mergeStats(merged, stats)
+            _truncate(merged, self._maxFunctions)
+
+            if stored is None:
+                if client.add(key, merged, namespace=_MEMCACHE_NAMESPACE):
+                    return
+            elif client.cas(key, merged, namespace=_MEMCACHE_NAMESPACE):
+                return
+
+    def getStats(self, limit=50, sortBy="totalTime"):
+        """ Returns the stats from every instance, merged.
+
+        The result is {"requests": n, "functions": [...]}, where "functions"
+        has the 'limit' functions with the most 'sortBy' (totalTime or
+        cumulativeTime), each as {"function", "calls", "totalTime", "cumulativeTime"}.
+        Times are in seconds, summed over all profiled requests.  Other
+        instances' stats may be up to a flush interval old.
+        """
+        self.flush()
+        slots = requestcontext.get().memcache.get_multi([_slotKey(slot) for slot in range(0, _SLOT_COUNT)],
+                                                        namespace=_MEMCACHE_NAMESPACE)
+        merged = _newStats()
+        for stats in slots.values():
+            _mergeStats(merged, stats)
+
+        functions = [{"function": name, "calls": calls, "totalTime": totalTime, "cumulativeTime": cumulativeTime}
+                     for name, (calls, totalTime, cumulativeTime) in merged["functions"].items()]
+        functions.sort(key=lambda function: function[sortBy], reverse=True)
+        return {"requests": merged["requests"], "functions": functions[:limit]}
+
+    def clearStats(self):
+        with self._lock:
+            self._stats = _newStats()
+        requestcontext.get().memcache.delete_multi([_slotKey(slot) for slot in range(0, _SLOT_COUNT)],
+                                                   namespace=_MEMCACHE_NAMESPACE)
+
+class ProfilerMiddleware:
+    """ WSGI middleware which profiles the requests 'profiler' picks.
+
+    Only install this if profiling is allowed; without it, requests pay
+    nothing for profiling.
+    """
+
+    def __init__(self, app, profiler):
+        self._app = app
+        self._profiler = profiler
+
+    def __call__(self, environ, start_response):
+        if not self._profiler.shouldProfile(environ):
+            return self._app(environ, start_response)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(self._app, environ, start_response)
+        finally:
+            self._profiler.record(profile)
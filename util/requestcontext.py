@@ -0,0 +1,75 @@
+""" State which belongs to a single request.
+
+app.yaml sets threadsafe, so one instance handles several requests at once on
+different threads, and objects shared between requests (the XmppVoiceMail for
+each owner, the in-process caches in models.py) can be used by several threads
+at the same time.  Those objects only hold configuration which doesn't change.
+Anything a request needs its own copy of - RPC clients, values it has already
+looked up, counts of what it has done - lives in the RequestContext for the
+current thread.
+"""
+import collections
+import logging
+import threading
+
+from google.appengine.api import memcache
+
+_local = threading.local()
+
+class RequestContext:
+    """ Per-request RPC clients, caches and counters.
+    """
+
+    def __init__(self):
+        # memcache.Client keeps track of CAS IDs, so it can't be shared between threads.
+        self.memcache = memcache.Client()
+        # Maps keys to values already looked up during this request.
+        self.cache = {}
+        # Maps names to how many times something happened during this request.
+        self.counters = collections.defaultdict(int)
+
+    def getCached(self, key, load):
+        """ Returns the value cached under 'key', calling load() to get it the first time. """
+        if not key in self.cache:
+            self.cache[key] = load()
+        return self.cache[key]
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+def start():
+    """ Start a new context for the current thread, and return it. """
+    _local.context = RequestContext()
+    return _local.context
+
+def get():
+    """ Returns the context for the current thread, starting one if required. """
+    context = getattr(_local, "context", None)
+    if context is None:
+        context = start()
+    return context
+
+def end():
+    """ Drop the context for the current thread, and return it. """
+    context = getattr(_local, "context", None)
+    _local.context = None
+    return context
+
+class RequestContextMiddleware:
+    """ WSGI middleware which gives every request a new RequestContext.
+
+    Threads are reused for later requests, so without this, a request could
+    see values cached by an earlier one.
+    """
+
+    def __init__(self, app):
+        self._app = app
+
+    def __call__(self, environ, start_response):
+        start()
+        try:
+            return self._app(environ, start_response)
+        finally:
+            context = end()
+            if context.counters:
+                logging.debug("Request counters: %r", dict(context.counters))
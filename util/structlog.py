@@ -0,0 +1,82 @@
+""" Key/value logging which costs next to nothing when it's turned off.
+
+    log = structlog.getLogger(__name__)
+    log.info("sms.send", to=toNumber, length=len(body))
+
+logs "sms.send length=5 to=+16135551234".  The record is only formatted if
+a handler actually writes it, so a call below the logging level costs one
+level check.  Events named in config.LOG_SAMPLE_RATES are only logged for
+that fraction of calls, and each record that is logged says what fraction
+it stands for, so busy events can be left on without logging every one.
+"""
+import json
+import logging
+import random
+import re
+
+import config
+
+# Values made of these characters are written without quotes.
+_plainValueRegex = re.compile(r"^[\w.+@:/()*-]+$")
+
+def _formatValue(value):
+    if isinstance(value, basestring):
+        if _plainValueRegex.match(value):
+            return str(value)
+        try:
+            return json.dumps(value)
+        except UnicodeDecodeError:
+            return repr(value)
+    return str(value)
+
+class _Record:
+    """ A log message which isn't formatted until it's written. """
+
+    def __init__(self, event, fields, sampleRate):
+        self._event = event
+        self._fields = fields
+        self._sampleRate = sampleRate
+
+    def __str__(self):
+        parts = [self._event]
+        for key in sorted(self._fields):
+            parts.append(key + "=" + _formatValue(self._fields[key]))
+        if self._sampleRate < 1:
+            parts.append("sampleRate=" + str(self._sampleRate))
+        return " ".join(parts)
+
+class StructLogger:
+    """ Logs events, with key/value fields, to a standard logging.Logger. """
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(name)
+
+    def isEnabledFor(self, level):
+        return self._logger.isEnabledFor(level)
+
+    def _log(self, level, event, fields, exc_info=None):
+        if not self._logger.isEnabledFor(level):
+            return
+        sampleRate = getattr(config, "LOG_SAMPLE_RATES", {}).get(event, 1)
+        if sampleRate < 1 and random.random() >= sampleRate:
+            return
+        self._logger.log(level, _Record(event, fields, sampleRate), exc_info=exc_info)
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warn(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """ Log an error, with the exception being handled. """
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+def getLogger(name):
+    return StructLogger(name)
@@ -0,0 +1,108 @@
+import logging
+import time
+
+from google.appengine.api import memcache
+
+# How many times to retry a compare-and-set before giving up.
+_MAX_CAS_RETRIES = 10
+
+class MemCacheTokenBucket:
+    """ A token bucket rate limiter, stored in MemCache.
+
+    The bucket holds up to 'capacity' tokens, and refills at 'rate' tokens
+    per second.  Callers reserve tokens with reserve(); if the bucket doesn't
+    have enough, the tokens are still reserved, and reserve() returns how
+    long the caller has to wait before using them.  This lets callers queue
+    work for later instead of failing, while later callers queue up behind
+    them.
+
+    The bucket's state is updated with compare-and-set, so it is shared
+    correctly between instances.  A rate of 0 or less means no limit; the
+    bucket is never stored, and reserve() always returns 0.
+    """
+
+    def __init__(self, key, rate, capacity, namespace="TokenBucket"):
+        self._key = key
+        self._rate = float(rate)
+        self._capacity = capacity
+        self._namespace = namespace
+
+    def _refill(self, state, now):
+        """ Returns the number of tokens in the bucket at time 'now'. """
+        if state is None:
+            return self._capacity
+        tokens, updated = state
+        return min(self._capacity, tokens + (now - updated) * self._rate)
+
+    def reserve(self, tokens=1):
+        """ Reserve tokens from the bucket.
+
+        Returns 0 if the tokens are available now, or else the number of
+        seconds until they will be.
+        """
+        return reserveAll([self], tokens)
+
+    def getStatus(self):
+        """ Returns a dict describing the bucket.
+
+        'tokens' is the number of tokens available now, and 'queuedDelay' is
+        how long someone reserving a token now would have to wait.
+        """
+        if self._rate <= 0:
+            return {"tokens": self._capacity, "capacity": self._capacity, "rate": self._rate, "queuedDelay": 0}
+
+        available = self._refill(memcache.get(self._key, namespace=self._namespace), time.time())
+        return {
+            "tokens": max(0, available),
+            "capacity": self._capacity,
+            "rate": self._rate,
+            "queuedDelay": max(0, -available / self._rate)
+        }
+
+def reserveAll(buckets, tokens=1):
+    """ Reserve tokens from several buckets at once, with one memcache round trip per attempt.
+
+    The buckets must all be in the same namespace.  Returns 0 if the tokens
+    are available now from every bucket, or else the number of seconds until
+    they will be.
+    """
+    buckets = [bucket for bucket in buckets if bucket._rate > 0]
+    if not buckets:
+        return 0
+
+    # memcache.Client keeps track of CAS IDs, so we need our own.
+    client = memcache.Client()
+    namespace = buckets[0]._namespace
+    delay = 0
+    for attempt in range(0, _MAX_CAS_RETRIES):
+        now = time.time()
+        states = client.get_multi([bucket._key for bucket in buckets], namespace=namespace, for_cas=True)
+
+        newBuckets = {}
+        changedBuckets = {}
+        available = {}
+        for bucket in buckets:
+            state = states.get(bucket._key)
+            available[bucket._key] = bucket._refill(state, now) - tokens
+            if state is None:
+                newBuckets[bucket._key] = (available[bucket._key], now)
+            else:
+                changedBuckets[bucket._key] = (available[bucket._key], now)
+
+        notStored = []
+        if newBuckets:
+            notStored += client.add_multi(newBuckets, namespace=namespace)
+        if changedBuckets:
+            notStored += client.cas_multi(changedBuckets, namespace=namespace)
+
+        for bucket in buckets:
+            if bucket._key not in notStored:
+                delay = max(delay, -available[bucket._key] / bucket._rate)
+
+        buckets = [bucket for bucket in buckets if bucket._key in notStored]
+        if not buckets:
+            return max(0, delay)
+
+    # Too much contention; let the caller through rather than dropping work.
+    logging.warn("Could not update token buckets " + ", ".join(bucket._key for bucket in buckets))
+    return max(0, delay)
@@ -1,20 +1,40 @@
 import os
 import re
-import base64
-import logging
-import urllib
 import time
 
 from google.appengine.api import mail
-from google.appengine.api import urlfetch
 from google.appengine.api import app_identity
 from google.appengine.api import xmpp
+from google.appengine.ext import ndb
 
 import config
 
 from util.phonenumberutils import  toPrettyNumber, stripNumber, toNormalizedNumber, validateNumber
 from util.circularbuffer import MemCacheCircularBuffer
-from models import XmppUser, Contact
+from util.notifier import Notifier
+from util import requestcontext
+from util import structlog
+from models import XmppUser, Contact, PendingSms, DigestItem, BroadcastList
+import smsqueue
+import smsgateway
+import trafficrollup
+import digest
+import conversations
+import messagesearch
+
+log = structlog.getLogger(__name__)
+
+# Wakes up requests waiting for new log items on this instance.
+logNotifier = Notifier()
+
+# While waiting for log items, check for items logged on other instances this often, in seconds.
+_LOG_POLL_INTERVAL = 5
+
+def _parseLogCursor(lastId):
+    """ Returns the log cursor 'lastId' stands for, or None for the whole log. """
+    if not lastId:
+        return None
+    return [int(seq) for seq in lastId.split(".")]
 
 class XmppVoiceMailException(Exception):
     """ Abstract base class for all XmppVoiceMail errors.
@@ -43,20 +63,36 @@ class SmsException(XmppVoiceMailException):
     """ Thrown when an SMS message fails.
     """
     def __init__(self, status_code, value):
-        super(SmsException, self).__init__(str(status_code) + ": " + value)
+        if status_code is None:
+            super(SmsException, self).__init__(value)
+        else:
+            super(SmsException, self).__init__(str(status_code) + ": " + value)
         self.status_code = status_code
         self.errorMessage = value
 
+    def isRetryable(self):
+        """ Returns True if sending the message again later might work.
+
+        status_code is None if we couldn't reach the SMS gateway at all.
+        """
+        return (self.status_code is None) or (self.status_code == 429) or (self.status_code >= 500)
+
 
 class Owner:
     """ Represents the owner of an XmppVoiceMail
     """
     
-    def __init__(self, phoneNumber, jid, emailAddress, logSize=0):
+    def __init__(self, phoneNumber, jid, emailAddress, logSize=0, namespace=None):
+        """ Create a new Owner.
+
+        'namespace' is the datastore and memcache namespace this owner's data
+        is stored in, or None to use the default namespace.
+        """
         self.phoneNumber = phoneNumber
         self.jid = jid
         self.emailAddress = emailAddress
         self.logSize = logSize
+        self.namespace = namespace
         
     def xmppEnabled(self):
         return self.jid and self.jid != "None"
@@ -65,8 +101,9 @@ class Owner:
         return self.emailAddress and self.emailAddress != "None"
 
 class Communications:
-    def __init__(self):
+    def __init__(self, smsRouter=None):
         self._DEV_ENVIRONMENT = os.environ['SERVER_SOFTWARE'].startswith('Development')
+        self._smsRouter = smsRouter or smsgateway.getDefaultRouter(self._DEV_ENVIRONMENT)
     
     def sendMail(self, sender, to, subject, body):
         mail.send_mail(
@@ -85,28 +122,18 @@ class Communications:
         return xmpp.get_presence(jid, fromJid)
 
     def sendSMS(self, fromNumber, toNumber, body):
-        logging.info("SMS to " + toNumber + ": " + body)
-
-        if not self._DEV_ENVIRONMENT:
-            form_fields = {
-                "From": fromNumber,
-                "To": toNumber,
-                "Body": body
-            }
-            form_data = urllib.urlencode(form_fields)
-
-            twurl = "https://api.twilio.com/2010-04-01/Accounts/" + config.TWILIO_ACID + "/SMS/Messages"
-            logging.debug('The twilio url: ' + twurl)
-
-            result = urlfetch.fetch(url=twurl,
-                                    payload=form_data,
-                                    method=urlfetch.POST,
-                                    headers={'Content-Type': 'application/x-www-form-urlencoded',
-                                             "Authorization": "Basic %s" % (base64.encodestring(config.TWILIO_ACID + ":" + config.TWILIO_AUTH)[:-1]).replace('\n', '') })
-            logging.debug('reply content: ' + result.content)
-            
-            if (result.status_code < 200) or (result.status_code >= 300):
-                raise SmsException(result.status_code, result.content)
+        self.sendSMSAsync(fromNumber, toNumber, body).get_result()
+
+    def getSMSGatewayStatus(self):
+        return self._smsRouter.getStatus()
+
+    @ndb.tasklet
+    def sendSMSAsync(self, fromNumber, toNumber, body):
+        try:
+            gateway = yield self._smsRouter.sendAsync(fromNumber, toNumber, body)
+        except smsgateway.GatewayError as e:
+            raise SmsException(e.statusCode, e.errorMessage)
+        log.info("sms.send", to=toNumber, length=len(body), gateway=gateway)
 
 class LogItem:
     """
@@ -146,53 +173,140 @@ class LogItem:
 class XmppVoiceMail:
     """
     Represents a virtual cell phone, which can receive SMS messages and voicemail.
+
+    One XmppVoiceMail is shared by every request for its owner, on any
+    thread, so it only holds the owner's configuration.  Per-request state
+    goes in the current RequestContext.
     """
-    def __init__(self, owner):
+    def __init__(self, owner, trafficRollups=None):
         self._APP_ID = app_identity.get_application_id()
         self._owner = owner
         self._communications = Communications()
-        self._messageLog = MemCacheCircularBuffer(owner.logSize, "xmppVoiceMailLog")
-
-    def _log(self, direction, contact, message):
+        self._traffic = trafficRollups or trafficrollup.rollups
+
+        logNamespace = "CircularBuffer"
+        if owner.namespace:
+            logNamespace += "-" + owner.namespace
+        self._logNamespace = logNamespace
+        self._messageLog = MemCacheCircularBuffer(owner.logSize, "xmppVoiceMailLog",
+                                                  shardCount=getattr(config, "LOG_SHARDS", 4),
+                                                  namespace=logNamespace)
+        self._rateLimiter = smsqueue.SmsRateLimiter(owner.phoneNumber,
+            rate=getattr(config, "SMS_RATE", 1),
+            burst=getattr(config, "SMS_BURST", 5),
+            perNumberRate=getattr(config, "SMS_PER_NUMBER_RATE", 0.2),
+            perNumberBurst=getattr(config, "SMS_PER_NUMBER_BURST", 3))
+        self._digestWindow = getattr(config, "EMAIL_DIGEST_WINDOW", 0)
+        self._fanOutConcurrency = getattr(config, "FAN_OUT_CONCURRENCY", 5)
+
+    def getOwner(self):
+        return self._owner
+
+    def _getContactName(self, contact, number=None):
+        """ Returns the name to file a message to or from 'contact' under.
+
+        That's the contact's name, or for the default sender, 'number'.
+        """
+        if isinstance(contact, Contact):
+            if number and contact.isDefaultSender():
+                return toPrettyNumber(number)
+            return contact.name
+        return contact
+
+    def _log(self, direction, contact, message, number=None, channel=None):
+        """ Add a message to the log.
+
+        The message is queued to be added to the search index.  If 'number'
+        is given, the message is also added to the conversation with that
+        number, and this returns a Future to wait on for that.  If 'channel'
+        is given, the message is counted in the traffic rollups as having
+        come in over that channel; our own reports to the owner aren't.
+        """
+        conversationName = self._getContactName(contact, number)
         if isinstance(contact, Contact):
             contact = contact.name
-            
-        logItem = LogItem(direction, contact, message)
-        self._messageLog.addItem(logItem)
+
+        self._messageLog.addItem(LogItem(direction, contact, message))
+        requestcontext.get().count("logItems")
+        logNotifier.notify(self._logNamespace)
+        messagesearch.queueDocument(direction, contact, message)
+
+        if channel:
+            self._traffic.record(direction, channel, conversationName)
+        if number:
+            return conversations.recordMessageAsync(number, conversationName, direction, message,
+                                                    unread=(direction == LogItem.TO_OWNER))
+        return None
 
     def getLog(self):
+        """ Returns the items in the log. """
         return self._messageLog.getItems()
 
+    def getNewLog(self, since=None):
+        """ Returns (items, lastId) for the items in the log after 'since'.
+
+        'since' is a lastId from an earlier call, or None for the whole log.
+        lastId is a string of the log's per-shard cursor, and only covers
+        items actually returned.
+        """
+        items, cursor = self._messageLog.getNewItems(_parseLogCursor(since))
+        return (items, ".".join(str(seq) for seq in cursor))
+
+    def waitForLog(self, since, timeout):
+        """ Wait up to 'timeout' seconds for items to be added to the log after 'since'.
+
+        Returns (items, lastId), as getNewLog() does.  Items logged on this
+        instance wake us up straight away; items logged on other instances
+        are noticed within _LOG_POLL_INTERVAL seconds, by checking the log's
+        counters.
+        """
+        cursor = _parseLogCursor(since)
+        deadline = time.time() + timeout
+        while True:
+            version = logNotifier.getVersion(self._logNamespace)
+            if self._messageLog.hasNewItems(cursor):
+                items, lastId = self.getNewLog(since)
+                if items:
+                    return (items, lastId)
+                # A counter has gone up, but its item isn't in the log yet.
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return ([], since)
+            logNotifier.wait(self._logNamespace, version, min(remaining, _LOG_POLL_INTERVAL))
+
     def handleIncomingCall(self, fromNumber, callStatus):
         """Handle an incoming call.
         """
-        displayFrom = toPrettyNumber(fromNumber)
-        
-        # Find the XMPP user to send this from
-        contact = Contact.getByPhoneNumber(fromNumber)
-        if contact:
-            displayFrom = contact.name
-        else:
-            contact = Contact.getDefaultSender()
-            
-        self.sendMessageToOwner("Call from: " + displayFrom + " status:" + callStatus, contact, fromNumber)
+        # Check if the owner is online while we find the XMPP user to send this from
+        storedPresence = self._getStoredPresenceAsync()
+        displayFrom, contact = self.getDisplayNameAndContact(fromNumber)
 
-    def getDisplayNameAndContact(self, number):
+        self.sendMessageToOwner("Call from: " + displayFrom + " status:" + callStatus, contact, fromNumber,
+                                storedPresence)
+
+    @ndb.tasklet
+    def getDisplayNameAndContactAsync(self, number):
         displayName = toPrettyNumber(number)
         
-        # Find the XMPP user to send this from
-        contact = Contact.getByPhoneNumber(number)
+        # Find the XMPP user to send this from.  Get the default sender at
+        # the same time, since sendMessageToOwner will want it too.
+        contact, defaultSender = yield Contact.getByPhoneNumberAsync(number), Contact.getDefaultSenderAsync()
         if contact:
             displayName = contact.name
         else:
-            contact = Contact.getDefaultSender()
+            contact = defaultSender
             
-        return (displayName, contact)
+        raise ndb.Return((displayName, contact))
+
+    def getDisplayNameAndContact(self, number):
+        return self.getDisplayNameAndContactAsync(number).get_result()
         
 
     def handleVoiceMail(self, fromNumber, transcriptionText=None, recordingUrl=None):
         """Handle an incoming voice mail.
         """
+        storedPresence = self._getStoredPresenceAsync()
         displayName, contact = self.getDisplayNameAndContact(fromNumber)
 
         body = "New message from " + displayName
@@ -202,20 +316,24 @@ class XmppVoiceMail:
         if recordingUrl:
             body += " - Recording: " + recordingUrl
             
-        self._log(LogItem.TO_OWNER, displayName, body)
-        return self.sendMessageToOwner(body, contact, fromNumber)
+        logged = self._log(LogItem.TO_OWNER, displayName, body, fromNumber, trafficrollup.VOICEMAIL)
+        answer = self.sendMessageToOwner(body, contact, fromNumber, storedPresence)
+        logged.get_result()
+        return answer
 
     def handleIncomingSms(self, fromNumber, toNumber, body):
         """Handle an incoming SMS message from the network.
         """
 
-        # Find the XMPP user to send this from
+        # Check if the owner is online while we find the XMPP user to send this from
+        storedPresence = self._getStoredPresenceAsync()
         displayName, contact = self.getDisplayNameAndContact(fromNumber)
         
-        self._log(LogItem.TO_OWNER, displayName, body)
+        logged = self._log(LogItem.TO_OWNER, displayName, body, fromNumber, trafficrollup.SMS)
             
         # Forward the message to the owner
-        self.sendMessageToOwner(body, contact, fromNumber)
+        self.sendMessageToOwner(body, contact, fromNumber, storedPresence)
+        logged.get_result()
 
     def handleIncomingXmpp(self, sender, to, messageBody):
         """Handle an incoming XMPP message from the owner.
@@ -229,7 +347,7 @@ class XmppVoiceMail:
         if not sender == self._owner.jid:
             raise PermissionException("Incorrect XMPP user")
 
-        self._forwardToSms(to, messageBody)
+        self._forwardToSms(to, messageBody, trafficrollup.XMPP)
 
     def handleIncomingEmail(self, sender, to, subject, messageBody):
         """Handle an incoming Email message from the owner.
@@ -244,22 +362,87 @@ class XmppVoiceMail:
         if not self._owner.emailAddress in sender:
             raise PermissionException("Incorrect user")
         
-        self._forwardToSms(to, messageBody)
+        self._forwardToSms(to, messageBody, trafficrollup.EMAIL)
 
-    def _forwardToSms(self, to, messageBody):
+    def _forwardToSms(self, to, messageBody, channel):
+        """ Send a message from the owner, which arrived over 'channel', on by SMS. """
         toName = to.split("@")[0]
 
         contact = Contact.getByName(toName)
-        if not contact:
+        if contact and contact.isDefaultSender():
+            recipients, body = self._getRecipientsAndBody(contact, messageBody)
+            if len(recipients) > 1:
+                self._sendSMSToAll(recipients, body, channel)
+                return
+            contact, toNumber = recipients[0]
+        elif contact:
+            toNumber, body = contact.normalizedPhoneNumber, messageBody
+        elif toName.isdigit() and validateNumber("+" + toName):
+            # A reply to an email from a number with no contact.
+            toNumber, body = "+" + toName, messageBody.strip()
+            contact = toPrettyNumber(toNumber)
+        else:
             raise InvalidParametersException("Unknown contact " + toName)
-    
-        toNumber, body = self._getNumberAndBody(contact, messageBody)
 
-        self._communications.sendSMS(self._owner.phoneNumber, toNumber, body)
+        self._sendSMSRateLimited(toNumber, body)
         
-        self._log(LogItem.FROM_OWNER, contact, body)
+        self._log(LogItem.FROM_OWNER, contact, body, toNumber, channel).get_result()
 
-            
+    def _sendSMSToAll(self, recipients, body, channel):
+        """ Send the same SMS to each of 'recipients', a list of (contact, toNumber).
+
+        The owner's message came in over 'channel'.
+
+        Messages are sent concurrently, up to _fanOutConcurrency at a time.
+        Rather than an error or nothing for each message, the owner gets one
+        report of how they all went.
+        """
+        results = self._mapAsync(lambda toNumber: self._sendSMSRateLimitedAsync(toNumber, body),
+                                 [toNumber for contact, toNumber in recipients],
+                                 self._fanOutConcurrency).get_result()
+
+        logged = []
+        sent = queued = 0
+        failures = []
+        for (contact, toNumber), result in zip(recipients, results):
+            if isinstance(result, SmsException):
+                failures.append(toPrettyNumber(toNumber) + " (" + result.value + ")")
+                continue
+            if result:
+                sent += 1
+            else:
+                queued += 1
+            logged.append(self._log(LogItem.FROM_OWNER, contact, body, toNumber, channel))
+
+        report = "Sent to " + str(sent) + " of " + str(len(recipients)) + " recipients."
+        if queued:
+            report += " " + str(queued) + " queued to send later."
+        if failures:
+            report += " Failed: " + ", ".join(failures)
+        self.sendMessageToOwner(report)
+        ndb.Future.wait_all(logged)
+
+    @ndb.tasklet
+    def _mapAsync(self, function, items, concurrency):
+        """ Call 'function', which returns a Future, for each of 'items', with at most 'concurrency' running at once.
+
+        Returns a Future for the list of results, in the same order as items.
+        An XmppVoiceMailException raised for an item is returned as its result.
+        """
+        results = [None] * len(items)
+        remaining = list(enumerate(items))
+
+        @ndb.tasklet
+        def worker():
+            while remaining:
+                index, item = remaining.pop(0)
+                try:
+                    results[index] = yield function(item)
+                except XmppVoiceMailException as e:
+                    results[index] = e
+
+        yield [worker() for i in range(min(concurrency, len(items)))]
+        raise ndb.Return(results)
 
 
     def sendXmppInvite(self, nickname):
@@ -271,53 +454,105 @@ class XmppVoiceMail:
 
     _messageRegex = re.compile(r"^([^:]*):(.*)$")
 
-    def _getNumberAndBody(self, contact, body):
-        """Get the destination contact and the message body from a message.
-        
-        The message will be either to the default sender, in which case
-        the body will be of the format "number:message", or else the message
-        will be to a nickname, and the body will just be the message.
+    def _getRecipientsAndBody(self, defaultSender, body):
+        """Get the recipients and the message body from a message to the default sender.
+
+        The body will be of the format "recipients:message", where recipients
+        is a comma separated list of phone numbers, contact names, and names
+        of BroadcastLists.
+
+        This returns the tuple (recipients, body), where recipients is a list
+        of (contact, toNumber) for each number to send the message to, and
+        body is the message content.  contact is the Contact to log the
+        message under; for plain numbers, that's defaultSender.
 
-        This returns the tuple (toNumber, body), where toNumber
-        is the SMS number to send this message to, and body is the message
-        content.
-        
         Raises InvalidParametersException if there are any errors in the input.
         """
-        
-        if not contact.isDefaultSender():
-            toNumber = contact.normalizedPhoneNumber
-            
-        else:
-            # Parse the phone number and body out of the message
-            match = self._messageRegex.match(body)
-            if not match:
-                raise InvalidParametersException("Use 'number:message' to send an SMS.")
+        # Parse the recipients and body out of the message
+        match = self._messageRegex.match(body)
+        if not match:
+            raise InvalidParametersException("Use 'number:message' or 'number,number,...:message' to send an SMS.")
 
-            toNumber = match.group(1)
-            if not validateNumber(toNumber):
-                raise InvalidParametersException("Invalid number: " + match.group(1))
+        names = [name.strip() for name in match.group(1).split(",")]
+        recipients = self._getRecipientsAsync(names, defaultSender).get_result()
+        if not recipients:
+            raise InvalidParametersException("No one to send to.")
 
-            toNumber = toNormalizedNumber(toNumber)
-            body = match.group(2).strip()
-                    
-        return (toNumber, body)
+        return (recipients, match.group(2).strip())
 
+    @ndb.tasklet
+    def _getRecipientsAsync(self, names, defaultSender, expandLists=True):
+        """ Returns [(contact, toNumber)] for a list of numbers, contact names and list names.
 
-    def _ownerXmppPresent(self, fromJid):
-        xmppOnline = False
-        if self._owner.xmppEnabled():
-            if self._owner.jid.endswith("@gmail.com"):
-                # This always shows the user online in the dev environment, so fall back on the DB for dev.
-                xmppOnline = self._communications.getXmppPresence(self._owner.jid, fromJid)
+        Each number appears at most once, in the order first given.
+        """
+        names = [name for name in names if name]
+        lookupNames = [name for name in names if not validateNumber(name)]
+
+        # Look up names as contacts and as lists at the same time.
+        contacts = yield [Contact.getByNameAsync(name) for name in lookupNames]
+        lists = [None] * len(lookupNames)
+        if expandLists:
+            lists = yield [BroadcastList.getByNameAsync(name) for name in lookupNames]
+        contactsByName = dict(zip(lookupNames, contacts))
+        listsByName = dict(zip(lookupNames, lists))
+
+        answer = []
+        seenNumbers = set()
+        for name in names:
+            if name in contactsByName:
+                contact = contactsByName[name]
+                if contact and not contact.isDefaultSender():
+                    found = [(contact, contact.normalizedPhoneNumber)]
+                elif listsByName[name]:
+                    found = yield self._getRecipientsAsync(listsByName[name].members, defaultSender,
+                                                           expandLists=False)
+                elif expandLists:
+                    raise InvalidParametersException("Unknown number, contact or list: " + name)
+                else:
+                    raise InvalidParametersException("Unknown contact in list: " + name)
             else:
-                user = XmppUser.getByJid(self._owner.jid)
-                if user:
-                    xmppOnline = user.presence
+                found = [(defaultSender, toNormalizedNumber(name))]
+
+            for contact, toNumber in found:
+                if not toNumber in seenNumbers:
+                    seenNumbers.add(toNumber)
+                    answer.append((contact, toNumber))
+
+        raise ndb.Return(answer)
+
+
+    def _getStoredPresenceAsync(self):
+        """ Look up the owner's presence in the DB, as last reported by XMPP.
+
+        The result is None if we ask the XMPP service for the owner's presence instead.
+        This is only looked up once per request.
+        """
+        return requestcontext.get().getCached(("storedPresence", self._owner.jid),
+                                              self._lookupStoredPresenceAsync)
+
+    @ndb.tasklet
+    def _lookupStoredPresenceAsync(self):
+        xmppOnline = None
+        if not self._owner.xmppEnabled():
+            xmppOnline = False
+        elif not self._owner.jid.endswith("@gmail.com"):
+            user = yield XmppUser.getByJidAsync(self._owner.jid)
+            xmppOnline = user.presence if user else False
+        raise ndb.Return(xmppOnline)
+
+    def _ownerXmppPresent(self, fromJid, storedPresence=None):
+        if not storedPresence:
+            storedPresence = self._getStoredPresenceAsync()
+
+        xmppOnline = storedPresence.get_result()
+        if xmppOnline is None:
+            # This always shows the user online in the dev environment, so fall back on the DB for dev.
+            xmppOnline = self._communications.getXmppPresence(self._owner.jid, fromJid)
                 
         return xmppOnline
     
-    def sendMessageToOwner(self, message, contact=None, fromNumber=None):
+    def sendMessageToOwner(self, message, contact=None, fromNumber=None, storedPresence=None):
         """
         Send a message to the user who owns this XmppVoiceMail account.
 
@@ -326,6 +561,9 @@ class XmppVoiceMail:
         fromNumber is the phone number to send the message from if contact is
         the default sender.
 
+        storedPresence is the Future from _getStoredPresenceAsync(), if the
+        caller has already started looking up the owner's presence.
+
         Returns True on success, False on failure.
         """
         answer = False
@@ -335,16 +573,19 @@ class XmppVoiceMail:
             contact = defaultSender
 
         fromJid = contact.name  + "@" + self._APP_ID + ".appspotchat.com"
-        xmppOnline = self._ownerXmppPresent(fromJid)
+        xmppOnline = self._ownerXmppPresent(fromJid, storedPresence)
                 
         sendByEmail = self._owner.emailEnabled() and ( (not xmppOnline) or \
                       ((not contact.subscribed) and (not defaultSender.subscribed)) ) 
                 
         if sendByEmail:
-            self.sendEmailMessageToOwner(
-                subject=message,
-                fromContact=contact,
-                fromNumber=fromNumber)
+            if self._digestWindow:
+                self._queueDigestItem(message, contact, fromNumber)
+            else:
+                self.sendEmailMessageToOwner(
+                    subject=message,
+                    fromContact=contact,
+                    fromNumber=fromNumber)
             answer = True
              
         elif self._owner.xmppEnabled():
@@ -369,35 +610,95 @@ class XmppVoiceMail:
         if fromContact.isDefaultSender() and fromNumber:
             message = toPrettyNumber(fromNumber) + ": " + message
 
-        logging.debug("Sending XMPP message to " + self._owner.jid + ": " + message)
+        log.debug("xmpp.send", to=self._owner.jid, fromContact=fromContact.name, length=len(message))
 
         fromJid = fromContact.name + "@" + self._APP_ID + ".appspotchat.com"
         return self._communications.sendXmppMessage(fromJid, self._owner.jid, message)
 
 
-    def sendEmailMessageToOwner(self, subject, body=None, fromContact=None, fromNumber=None):
-        if not body:
-            body = ""
+    def _getEmailSender(self, fromContact=None, fromNumber=None):
+        """ Returns (fromName, fromAddress) for an email from fromContact or fromNumber.
 
+        fromAddress is the part before the "@"; replies to it go to the same place.
+        """
         if not fromContact:
             fromContact = Contact.getDefaultSender()
 
         fromName = fromContact.name
         if fromNumber:
             fromAddress = stripNumber(toNormalizedNumber(fromNumber))
-        elif not fromContact.isDefaultSender():
-            fromContact.normalizedPhoneNumber
         else:
             fromAddress = fromName
-            
-        logging.debug("Sending eMail message to " + self._owner.emailAddress + ": " + subject)
 
-        fromAddress = '"' + fromName + '" <' + fromAddress + "@" + self._APP_ID + ".appspotmail.com>"
+        return (fromName, fromAddress)
+
+    def _formatEmailSender(self, fromName, fromAddress):
+        return '"' + fromName + '" <' + self._getEmailAddress(fromAddress) + ">"
+
+    def _getEmailAddress(self, fromAddress):
+        return fromAddress + "@" + self._APP_ID + ".appspotmail.com"
+
+    def sendEmailMessageToOwner(self, subject, body=None, fromContact=None, fromNumber=None):
+        if not body:
+            body = ""
+
+        fromName, fromAddress = self._getEmailSender(fromContact, fromNumber)
+
+        log.debug("email.send", to=self._owner.emailAddress, fromName=fromName, length=len(body))
+
+        self._communications.sendMail(
+            sender=self._formatEmailSender(fromName, fromAddress),
+            to=self._owner.emailAddress,
+            subject=subject,
+            body=body)
+
+    def _queueDigestItem(self, message, fromContact=None, fromNumber=None):
+        """ Save a message to send to the owner in the next email digest. """
+        fromName, fromAddress = self._getEmailSender(fromContact, fromNumber)
+        if fromNumber and ((not fromContact) or fromContact.isDefaultSender()):
+            # Name strangers by their number, rather than all as the default sender.
+            fromName = toPrettyNumber(fromNumber)
+
+        item = DigestItem(fromName=fromName, fromAddress=fromAddress, message=message)
+        digest.queueDigestItem(self._owner.phoneNumber, self._digestWindow, item)
+
+    def sendDigest(self, window):
+        """ Send the owner one email with all the messages saved for the digest up to 'window'.
+
+        Messages are grouped by who they're from, and each group says where to
+        send a reply.  If they're all from one sender, the email comes from
+        that sender, so the owner can just hit reply.
+        """
+        items = digest.getItems(window)
+        if not items:
+            return
+
+        groups = digest.groupItems(items)
+        if len(groups) == 1:
+            fromName, fromAddress, senderItems = groups[0]
+        else:
+            fromName, fromAddress = self._getEmailSender()
+
+        if len(items) == 1:
+            subject = items[0].message
+        else:
+            subject = str(len(items)) + " messages from " + ", ".join(group[0] for group in groups)
+
+        body = ""
+        for groupName, groupAddress, senderItems in groups:
+            body += groupName + " - reply to " + self._getEmailAddress(groupAddress) + "\n"
+            for item in senderItems:
+                body += "  " + item.created.strftime("%H:%M") + " UTC  " + item.message + "\n"
+            body += "\n"
+
+        log.debug("digest.send", to=self._owner.emailAddress, messages=len(items))
+
         self._communications.sendMail(
-            sender=fromAddress,
+            sender=self._formatEmailSender(fromName, fromAddress),
             to=self._owner.emailAddress,
             subject=subject,
             body=body)
+        digest.deleteItems(items)
 
     def sendSMS(self, contact, toNumber, body):
         """ Send an SMS message,
@@ -412,11 +713,100 @@ class XmppVoiceMail:
         if not contact:
             displayName, contact = self.getDisplayNameAndContact(toNumber)
             
-        self._log(LogItem.FROM_OWNER, displayName, body)
+        logged = self._log(LogItem.FROM_OWNER, displayName, body, toNumber, trafficrollup.WEB)
         try:
-            self._communications.sendSMS(self._owner.phoneNumber, toNumber, body)
+            self._sendSMSRateLimited(toNumber, body)
         except SmsException as e:
             self._log(LogItem.TO_OWNER, displayName, "Could not send message: " + e.value)
+        logged.get_result()
+
+    def _sendSMSRateLimited(self, toNumber, body):
+        """ Send an SMS message, or queue it to send later.
+
+        Messages are queued if we're sending too fast, or if sending fails
+        with an error that might go away if we retry.
+
+        Returns True if the message was sent now, or False if it was queued.
+
+        Raises SmsException if the message can't be sent.
+        """
+        return self._sendSMSRateLimitedAsync(toNumber, body).get_result()
+
+    @ndb.tasklet
+    def _sendSMSRateLimitedAsync(self, toNumber, body):
+        pendingSms = PendingSms(ownerNumber=self._owner.phoneNumber, toNumber=toNumber, body=body)
+
+        delay = self._rateLimiter.reserve(toNumber)
+        if delay > 0:
+            log.info("sms.queue", to=toNumber, delay=delay)
+            smsqueue.queueSms(pendingSms, delay)
+            requestcontext.get().count("smsQueued")
+            raise ndb.Return(False)
+
+        try:
+            yield self._communications.sendSMSAsync(self._owner.phoneNumber, toNumber, body)
+        except SmsException as e:
+            if not e.isRetryable():
+                raise
+            log.warn("sms.retry", to=toNumber, error=e.value)
+            pendingSms.attempts = 1
+            pendingSms.lastError = e.value
+            smsqueue.queueSms(pendingSms, smsqueue.getRetryDelay(pendingSms.attempts))
+            requestcontext.get().count("smsQueued")
+            raise ndb.Return(False)
+
+        requestcontext.get().count("smsSent")
+        raise ndb.Return(True)
+
+    def sendPendingSMS(self, pendingSmsId):
+        """ Send an SMS message which was queued by _sendSMSRateLimited.
+
+        If the message has failed before, the owner gets a single report once
+        it has either been sent or we've given up on it.
+        """
+        pendingSms = PendingSms.get_by_id(int(pendingSmsId))
+        if not pendingSms:
+            # Already sent.
+            return
+
+        if pendingSms.attempts > 0:
+            # Retries have to wait their turn behind other messages.
+            delay = self._rateLimiter.reserve(pendingSms.toNumber)
+            if delay > 0:
+                smsqueue.queueSms(pendingSms, delay)
+                return
+
+        try:
+            self._communications.sendSMS(self._owner.phoneNumber, pendingSms.toNumber, pendingSms.body)
+        except SmsException as e:
+            pendingSms.attempts += 1
+            pendingSms.lastError = e.value
+            if e.isRetryable() and pendingSms.attempts < smsqueue.MAX_SEND_ATTEMPTS:
+                log.warn("sms.retry", to=pendingSms.toNumber, attempts=pendingSms.attempts, error=e.value)
+                smsqueue.queueSms(pendingSms, smsqueue.getRetryDelay(pendingSms.attempts))
+            else:
+                pendingSms.delete()
+                self._reportPendingSMS(pendingSms,
+                    "Could not send message after " + str(pendingSms.attempts) + " attempts: " + e.value)
+            return
+
+        pendingSms.delete()
+        if pendingSms.attempts > 0:
+            self._reportPendingSMS(pendingSms,
+                "Message sent after " + str(pendingSms.attempts + 1) + " attempts.")
+
+    def _reportPendingSMS(self, pendingSms, report):
+        displayName, contact = self.getDisplayNameAndContact(pendingSms.toNumber)
+        self._log(LogItem.TO_OWNER, displayName, report)
+        self.sendMessageToOwner(report, contact, pendingSms.toNumber)
+
+    def getSMSRateStatus(self, toNumber=None):
+        """ Returns the state of the outbound SMS rate limiter. """
+        return self._rateLimiter.getStatus(toNumber)
+
+    def getSMSGatewayStatus(self):
+        """ Returns the health of each SMS gateway, in the order they'd be tried. """
+        return self._communications.getSMSGatewayStatus()
             
 
     